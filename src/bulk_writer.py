@@ -0,0 +1,187 @@
+"""
+Ghi DataFrame hàng loạt vào PostgreSQL
+- Backend 'copy': serialize từng khối DataFrame ra buffer CSV trong bộ nhớ và gửi bằng COPY FROM STDIN.
+  Bảng đích được tạo với kiểu cột tường minh dưới tên tạm (shadow) rồi hoán đổi trong cùng một transaction.
+- Backend 'to_sql': giữ nguyên cách cũ (pandas INSERT multi-row) để so sánh hiệu năng.
+"""
+
+import io
+import time
+import pandas as pd
+from pandas.api import types as ptypes
+from config import get_db_engine, get_raw_connection, SCHEMA_STAGING, STAGING_WRITER_CONFIG
+from instrumentation import record_io
+
+WRITER_BACKENDS = ('copy', 'to_sql')
+SHADOW_SUFFIX = '__new'
+
+# CÁC HÀM HỖ TRỢ
+def quote_ident(name):
+    """Đặt tên cột trong dấu nháy kép (an toàn với tên viết hoa/ký tự đặc biệt)"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+def infer_pg_type(dtype):
+    """Ánh xạ kiểu dữ liệu pandas -> kiểu cột PostgreSQL"""
+    if ptypes.is_bool_dtype(dtype):
+        return 'BOOLEAN'
+    if ptypes.is_integer_dtype(dtype):
+        return 'BIGINT'
+    if ptypes.is_float_dtype(dtype):
+        return 'DOUBLE PRECISION'
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return 'TIMESTAMPTZ'
+    if ptypes.is_datetime64_any_dtype(dtype):
+        return 'TIMESTAMP'
+    if ptypes.is_timedelta64_dtype(dtype):
+        return 'INTERVAL'
+    return 'TEXT'
+
+def build_column_types(df, column_types=None):
+    """Xác định kiểu cột cho bảng đích (ưu tiên kiểu được chỉ định tường minh)"""
+    column_types = column_types or {}
+    return {col: column_types.get(col, infer_pg_type(df[col].dtype)) for col in df.columns}
+
+def copy_dataframe(cur, full_table_name, df):
+    """Serialize một khối DataFrame ra CSV trong bộ nhớ và gửi bằng COPY"""
+    buffer = io.StringIO()
+    # '\N' đại diện cho NULL để phân biệt với chuỗi rỗng ''
+    df.to_csv(buffer, index=False, header=False, na_rep='\\N')
+    size = buffer.tell()
+    buffer.seek(0)
+
+    columns = ', '.join(quote_ident(c) for c in df.columns)
+    start = time.perf_counter()
+    cur.copy_expert(
+        f"COPY {full_table_name} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+        buffer
+    )
+    # Kết nối psycopg2 thô không qua sự kiện của engine -> tự báo DB time, số dòng (command status) và byte
+    record_io(rows_out=cur.rowcount, bytes_out=size, db_seconds=time.perf_counter() - start, statements=1)
+    return len(df)
+
+def swap_table(cur, schema, table_name, shadow_name):
+    """Thay bảng cũ bằng bảng shadow (phải gọi bên trong transaction đang mở)"""
+    cur.execute(f"DROP TABLE IF EXISTS {schema}.{table_name}")
+    cur.execute(f"ALTER TABLE {schema}.{shadow_name} RENAME TO {table_name}")
+
+def iter_chunks(df, chunk_rows):
+    """Chia DataFrame thành các khối liên tiếp (DataFrame rỗng -> đúng một khối rỗng mang cấu trúc cột)"""
+    if df.empty:
+        yield df
+        return
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+# CÁC BACKEND GHI
+def write_dataframe_chunks(chunks, table_name, schema=SCHEMA_STAGING, column_types=None, swap=True):
+    """
+    Ghi một luồng các khối DataFrame vào bảng đích bằng COPY.
+    Khối đầu tiên quyết định cấu trúc bảng (kể cả khối rỗng -> bảng 0 dòng vẫn được tạo và hoán đổi).
+    Bảng cũ chỉ bị thay thế khi toàn bộ dữ liệu đã ghi xong; luồng không có khối nào thì giữ nguyên bảng cũ.
+    :param swap: False -> ghi thẳng vào table_name (khi table_name đã là bảng shadow do nơi gọi tự hoán đổi)
+    """
+    shadow_name = f"{table_name}{SHADOW_SUFFIX}" if swap else table_name
+    full_shadow = f"{schema}.{shadow_name}"
+    total = 0
+
+    conn = get_raw_connection()
+    try:
+        with conn.cursor() as cur:
+            created = False
+            for chunk in chunks:
+                if not created:
+                    types = build_column_types(chunk, column_types)
+                    cols_ddl = ',\n    '.join(f"{quote_ident(c)} {t}" for c, t in types.items())
+                    cur.execute(f"DROP TABLE IF EXISTS {full_shadow}")
+                    cur.execute(f"CREATE TABLE {full_shadow} (\n    {cols_ddl}\n)")
+                    created = True
+                if len(chunk):
+                    total += copy_dataframe(cur, full_shadow, chunk)
+
+            if created and swap:
+                swap_table(cur, schema, table_name, shadow_name)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    return total
+
+def write_with_copy(df, table_name, schema=SCHEMA_STAGING, column_types=None, chunk_rows=None, swap=True):
+    """Backend 'copy': ghi DataFrame theo từng khối bằng COPY FROM STDIN"""
+    chunk_rows = chunk_rows or STAGING_WRITER_CONFIG['chunk_rows']
+    return write_dataframe_chunks(iter_chunks(df, chunk_rows), table_name, schema, column_types, swap)
+
+def replace_rows(df, table_name, key_column, schema=SCHEMA_STAGING, keys=None):
+    """
+    Thay các dòng có key_column nằm trong df bằng dữ liệu mới (DELETE + COPY trong một transaction).
+    Bảng đích phải tồn tại và có đủ các cột của df. Dùng khi chỉ tính lại một phần bảng.
+    :param keys: danh sách key cần xóa; mặc định là các key có trong df. Truyền vào khi có key
+                 được yêu cầu tính lại nhưng không còn dòng kết quả (dòng cũ của chúng cũng phải bị xóa).
+    """
+    full_table_name = f"{schema}.{table_name}"
+    if keys is None:
+        keys = df[key_column].astype(str).unique().tolist()
+    else:
+        keys = [str(k) for k in keys]
+    conn = get_raw_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DELETE FROM {full_table_name} WHERE {quote_ident(key_column)} = ANY(%s)",
+                        (keys,))
+            total = copy_dataframe(cur, full_table_name, df) if len(df) else 0
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return total
+
+def write_with_to_sql(df, table_name, schema=SCHEMA_STAGING):
+    """Backend 'to_sql': INSERT multi-row qua pandas (cách cũ)"""
+    engine = get_db_engine()
+    df.to_sql(table_name, engine, schema=schema,
+              if_exists='replace', index=False,
+              method='multi', chunksize=2000)
+    return len(df)
+
+def write_dataframe(df, table_name, schema=SCHEMA_STAGING, backend=None, column_types=None):
+    """
+    Ghi DataFrame vào bảng (thay thế bảng cũ) bằng backend được chọn.
+    :param backend: 'copy' hoặc 'to_sql' (mặc định lấy từ STAGING_WRITER_CONFIG)
+    """
+    backend = backend or STAGING_WRITER_CONFIG['backend']
+    if backend == 'copy':
+        return write_with_copy(df, table_name, schema, column_types)
+    if backend == 'to_sql':
+        return write_with_to_sql(df, table_name, schema)
+    raise ValueError(f"Backend không hợp lệ: {backend}. Chọn một trong {WRITER_BACKENDS}")
+
+# SO SÁNH HIỆU NĂNG
+def benchmark_writers(df, table_name, schema=SCHEMA_STAGING, backends=WRITER_BACKENDS):
+    """
+    Ghi cùng một DataFrame bằng từng backend vào bảng tạm và so sánh thời gian.
+    Bảng tạm bị xóa sau khi đo.
+    """
+    print(f"SO SÁNH BACKEND GHI ({len(df):,} dòng)")
+    results = {}
+    for backend in backends:
+        bench_table = f"{table_name}_bench_{backend}"
+        start = time.perf_counter()
+        write_dataframe(df, bench_table, schema, backend=backend)
+        elapsed = time.perf_counter() - start
+        results[backend] = elapsed
+        print(f"  {backend:8s}: {elapsed:8.2f}s ({len(df) / elapsed if elapsed > 0 else 0:,.0f} dòng/s)")
+
+        conn = get_raw_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"DROP TABLE IF EXISTS {schema}.{bench_table}")
+            conn.commit()
+        finally:
+            conn.close()
+
+    return pd.Series(results, name='seconds')
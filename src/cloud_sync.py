@@ -0,0 +1,458 @@
+"""
+Đồng bộ Warehouse lên Cloud (Postgres -> Parquet -> GCS -> BigQuery)
+- Đọc từng bảng bằng server-side cursor (fetchmany) -> bộ nhớ chỉ giữ 1 row group tại một thời điểm.
+- Ghi Parquet nén theo từng row group có kích thước cố định vào thư mục tạm.
+- Schema BigQuery được suy ra từ kiểu cột trong Postgres (không dùng autodetect).
+- Nhiều bảng được xuất + upload + load song song.
+- Tầng upload/load tách thành backend: 'gcp' (thật) hoặc 'local' (giả lập GCS/BigQuery trên đĩa).
+- Chỉ đẩy phần thay đổi: fingerprint rẻ (số dòng + tổng hash của khóa và các cột mốc, không sắp xếp)
+  của từng bảng/tháng được tính trong SQL và lưu ở bảng manifest. Bảng không đổi bị bỏ qua;
+  bảng Fact chỉ đẩy lại các tháng thay đổi.
+- Trước lần load toàn bộ, bảng BigQuery có phân vùng/schema khác (vd: bảng cũ tạo từ CSV autodetect)
+  bị xóa để load tạo lại đúng cấu hình.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import text
+from config import get_db_engine, get_raw_connection, SCHEMA_WAREHOUSE, CLOUD_SYNC_CONFIG
+from bulk_writer import quote_ident
+from instrumentation import run_tracked, record_io
+
+# Các bảng Warehouse được đẩy lên BigQuery
+WAREHOUSE_SYNC_TABLES = [
+    "warehouse.fact_orders",
+    "warehouse.fact_order_items",
+    "warehouse.dim_sellers",
+    "warehouse.dim_customers",
+    "warehouse.dim_products"
+]
+
+# keys + watermark_columns: các cột đưa vào fingerprint. Bảng Fact chỉ hash khóa và các cột mốc thay đổi
+# khi đơn được cập nhật (trạng thái, ngày giao, review) thay vì cả dòng; bảng Dim nhỏ, không có cột mốc
+# -> hash cả dòng. Bảng Fact có thêm cột phân vùng theo tháng (cả trong BigQuery).
+SYNC_TABLE_SPECS = {
+    "warehouse.fact_orders": {
+        'keys': ['order_id'], 'partition_column': 'order_purchase_timestamp',
+        'watermark_columns': ['order_purchase_timestamp', 'order_status', 'order_delivered_carrier_date',
+                              'order_delivered_customer_date', 'item_count', 'review_count']
+    },
+    "warehouse.fact_order_items": {
+        'keys': ['order_id', 'order_item_id'], 'partition_column': 'shipping_limit_date',
+        'watermark_columns': ['shipping_limit_date']
+    },
+    "warehouse.dim_sellers": {'keys': ['seller_id']},
+    "warehouse.dim_customers": {'keys': ['customer_id']},
+    "warehouse.dim_products": {'keys': ['product_id']}
+}
+
+MANIFEST_TABLE = f"{SCHEMA_WAREHOUSE}.cloud_sync_manifest"
+WHOLE_TABLE = ''             # partition_key của bảng không phân vùng
+NULL_PARTITION = '__NULL__'  # Phân vùng của các dòng có cột phân vùng NULL (cùng tên với BigQuery)
+
+# Kiểu Postgres -> (kiểu Arrow, kiểu BigQuery, biểu thức ép kiểu khi SELECT)
+# NUMERIC được đọc ra dạng double để tránh Decimal của Python (chậm và không cần cho phân tích).
+PG_TYPE_MAP = {
+    'smallint': (pa.int64(), 'INT64', None),
+    'integer': (pa.int64(), 'INT64', None),
+    'bigint': (pa.int64(), 'INT64', None),
+    'real': (pa.float64(), 'FLOAT64', None),
+    'double precision': (pa.float64(), 'FLOAT64', None),
+    'numeric': (pa.float64(), 'FLOAT64', 'double precision'),
+    'boolean': (pa.bool_(), 'BOOL', None),
+    'date': (pa.date32(), 'DATE', None),
+    'timestamp without time zone': (pa.timestamp('us'), 'DATETIME', None),
+    'timestamp with time zone': (pa.timestamp('us', tz='UTC'), 'TIMESTAMP', None),
+}
+DEFAULT_TYPE = (pa.string(), 'STRING', 'text')
+
+# CÁC HÀM HỖ TRỢ
+def get_column_types(conn, full_table_name):
+    """Danh sách (tên cột, kiểu Postgres) theo thứ tự định nghĩa"""
+    schema, table = full_table_name.split('.')
+    rows = conn.execute(text("""
+        SELECT column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = :schema AND table_name = :table
+        ORDER BY ordinal_position
+    """), {'schema': schema, 'table': table})
+    return [(r[0], r[1]) for r in rows]
+
+def build_sync_schema(column_types):
+    """
+    Suy ra schema Arrow, schema BigQuery (list dict name/type/mode) và câu SELECT có ép kiểu
+    từ danh sách cột Postgres.
+    """
+    fields, bq_schema, select_cols = [], [], []
+    for name, pg_type in column_types:
+        arrow_type, bq_type, cast = PG_TYPE_MAP.get(pg_type, DEFAULT_TYPE)
+        fields.append(pa.field(name, arrow_type))
+        bq_schema.append({'name': name, 'type': bq_type, 'mode': 'NULLABLE'})
+        col = quote_ident(name)
+        select_cols.append(f"{col}::{cast} AS {col}" if cast else col)
+    return pa.schema(fields), bq_schema, ', '.join(select_cols)
+
+def export_table_to_parquet(full_table_name, local_path, row_group_rows=None, compression=None,
+                            where=None, params=None):
+    """
+    Stream một bảng Postgres ra file Parquet.
+    Mỗi lần fetchmany trả về tối đa row_group_rows dòng và được ghi thành một row group.
+    :param where: Điều kiện lọc (cú pháp tham số psycopg2, vd: chỉ một tháng của bảng Fact)
+    Trả về (số dòng, schema BigQuery).
+    """
+    row_group_rows = row_group_rows or CLOUD_SYNC_CONFIG['row_group_rows']
+    compression = compression or CLOUD_SYNC_CONFIG['compression']
+
+    with get_db_engine().connect() as conn:
+        column_types = get_column_types(conn, full_table_name)
+    if not column_types:
+        raise ValueError(f"Không tìm thấy bảng {full_table_name}")
+    arrow_schema, bq_schema, select_cols = build_sync_schema(column_types)
+
+    rows = 0
+    conn = get_raw_connection()
+    try:
+        # Cursor có tên -> psycopg2 tạo server-side cursor, dữ liệu được kéo về theo từng khối
+        with conn.cursor(name=f"sync_{full_table_name.split('.')[-1]}") as cur:
+            cur.itersize = row_group_rows
+            cur.execute(f"SELECT {select_cols} FROM {full_table_name}"
+                        + (f" WHERE {where}" if where else ""), params)
+            with pq.ParquetWriter(local_path, arrow_schema, compression=compression) as writer:
+                while True:
+                    batch = cur.fetchmany(row_group_rows)
+                    if not batch:
+                        break
+                    columns = list(zip(*batch))
+                    arrays = [pa.array(col, type=field.type) for col, field in zip(columns, arrow_schema)]
+                    writer.write_table(pa.Table.from_arrays(arrays, schema=arrow_schema),
+                                       row_group_size=row_group_rows)
+                    rows += len(batch)
+        conn.commit()
+    finally:
+        conn.close()
+
+    return rows, bq_schema
+
+# MANIFEST & FINGERPRINT
+def ensure_manifest_table(conn):
+    """Tạo bảng manifest nếu chưa có"""
+    conn.execute(text(f"""
+    CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+        table_name VARCHAR(200) NOT NULL,
+        partition_key VARCHAR(20) NOT NULL,
+        row_count BIGINT NOT NULL,
+        fingerprint CHAR(32),
+        schema_hash CHAR(32) NOT NULL,
+        synced_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (table_name, partition_key)
+    )
+    """))
+
+def compute_schema_hash(column_types):
+    """Hash của danh sách cột + kiểu (schema đổi -> phải đẩy lại toàn bộ bảng)"""
+    return hashlib.md5(repr(column_types).encode('utf-8')).hexdigest()
+
+def partition_filter(partition_column, partition_key):
+    """Điều kiện WHERE (tham số psycopg2) chọn đúng một tháng của bảng Fact"""
+    col = quote_ident(partition_column)
+    if partition_key == NULL_PARTITION:
+        return f"{col} IS NULL", None
+    return (f"{col} >= to_date(%(p)s, 'YYYYMM') AND {col} < to_date(%(p)s, 'YYYYMM') + interval '1 month'",
+            {'p': partition_key})
+
+def compute_fingerprints(conn, full_table_name, spec):
+    """
+    Tính fingerprint trong Postgres: số dòng + md5 của tổng hashtextextended(khóa, cột mốc) từng dòng.
+    Phép cộng không phụ thuộc thứ tự nên không phải sắp xếp cả bảng; bảng có watermark_columns
+    chỉ đọc khóa và các cột đó (bảng không có -> hash cả dòng).
+    Bảng Fact được tính riêng cho từng tháng của cột phân vùng.
+    Trả về dict {partition_key: (row_count, fingerprint)}.
+    """
+    if 'watermark_columns' in spec:
+        columns = spec['keys'] + [c for c in spec['watermark_columns'] if c not in spec['keys']]
+        row_expr = f"ROW({', '.join(f't.{quote_ident(c)}' for c in columns)})::text"
+    else:
+        row_expr = "t::text"
+    partition_column = spec.get('partition_column')
+    partition_expr = (
+        f"COALESCE(to_char(t.{quote_ident(partition_column)}, 'YYYYMM'), '{NULL_PARTITION}')"
+        if partition_column else f"'{WHOLE_TABLE}'"
+    )
+    rows = conn.execute(text(f"""
+        SELECT {partition_expr} AS partition_key,
+               COUNT(*) AS row_count,
+               md5(SUM(hashtextextended({row_expr}, 0)::numeric)::text) AS fingerprint
+        FROM {full_table_name} t
+        GROUP BY 1
+    """))
+    fingerprints = {r[0]: (r[1], r[2]) for r in rows}
+    # Bảng rỗng vẫn cần một bản ghi để phân biệt với "chưa từng đồng bộ"
+    if not partition_column and not fingerprints:
+        fingerprints[WHOLE_TABLE] = (0, None)
+    return fingerprints
+
+def get_manifest(conn, full_table_name):
+    """Fingerprint của lần đồng bộ trước: ({partition_key: (row_count, fingerprint)}, schema_hash)"""
+    rows = conn.execute(text(f"""
+        SELECT partition_key, row_count, fingerprint, schema_hash
+        FROM {MANIFEST_TABLE} WHERE table_name = :name
+    """), {'name': full_table_name}).fetchall()
+    schema_hash = rows[0][3] if rows else None
+    return {r[0]: (r[1], r[2].strip() if r[2] else None) for r in rows}, schema_hash
+
+def save_manifest(full_table_name, fingerprints, schema_hash):
+    """Ghi đè manifest của một bảng bằng fingerprint vừa đồng bộ thành công"""
+    with get_db_engine().begin() as conn:
+        conn.execute(text(f"DELETE FROM {MANIFEST_TABLE} WHERE table_name = :name"), {'name': full_table_name})
+        if fingerprints:
+            conn.execute(text(f"""
+                INSERT INTO {MANIFEST_TABLE} (table_name, partition_key, row_count, fingerprint, schema_hash)
+                VALUES (:name, :partition_key, :row_count, :fingerprint, :schema_hash)
+            """), [
+                {'name': full_table_name, 'partition_key': key, 'row_count': count,
+                 'fingerprint': fp, 'schema_hash': schema_hash}
+                for key, (count, fp) in fingerprints.items()
+            ])
+
+def plan_table_sync(current, previous, schema_hash, previous_schema_hash, partitioned, force_full=False):
+    """
+    So sánh fingerprint hiện tại với manifest để quyết định cách đồng bộ.
+    Tháng thay đổi và tháng mới đều được ghi bằng WRITE_TRUNCATE lên partition decorator: nếu lần đồng bộ
+    lỗi giữa chừng (manifest chưa cập nhật), lần sau ghi đè lại đúng các tháng đó mà không nhân đôi dòng.
+    :return: dict {'action': 'skip' | 'full' | 'partitions', 'truncate', 'delete'}
+    """
+    plan = {'action': 'skip', 'truncate': [], 'delete': []}
+    if force_full or not previous or schema_hash != previous_schema_hash:
+        plan['action'] = 'full'
+        return plan
+
+    if not partitioned:
+        if current != previous:
+            plan['action'] = 'full'
+        return plan
+
+    plan['truncate'] = sorted(k for k in current if current[k] != previous.get(k))
+    plan['delete'] = sorted(k for k in previous if k not in current)
+    if plan['truncate'] or plan['delete']:
+        plan['action'] = 'partitions'
+    return plan
+
+# CÁC BACKEND UPLOAD/LOAD
+class GcpSyncBackend:
+    """Upload lên GCS và load vào BigQuery bằng các hàm trong data_loading"""
+
+    def __init__(self):
+        # Import tại đây để backend 'local' chạy được mà không cần thư viện Google Cloud
+        import data_loading
+        import config
+        self.loader = data_loading
+        self.bucket = config.GCS_BUCKET_NAME
+
+    def ensure_dataset(self, dataset):
+        self.loader.create_bq_dataset(dataset)
+
+    def upload(self, local_path, blob_name):
+        if not self.loader.upload_to_gcs(local_path, blob_name):
+            raise RuntimeError(f"Upload {local_path} lên GCS thất bại")
+        return f"gs://{self.bucket}/{blob_name}"
+
+    def load(self, uri, dataset, table, schema, write_disposition='WRITE_TRUNCATE', partition_field=None):
+        if not self.loader.load_gcs_to_bigquery(uri, dataset, table, source_format='PARQUET',
+                                                schema=schema, write_disposition=write_disposition,
+                                                partition_field=partition_field):
+            raise RuntimeError(f"Load {uri} vào BigQuery thất bại")
+
+    def prepare_table(self, dataset, table, schema, partition_field=None):
+        if not self.loader.reset_bq_table_if_incompatible(dataset, table, schema, partition_field):
+            raise RuntimeError(f"Không kiểm tra/tạo lại được bảng BigQuery {table}")
+
+    def delete_partition(self, dataset, table, partition_key):
+        if not self.loader.delete_bq_partition(dataset, table, partition_key):
+            raise RuntimeError(f"Xóa phân vùng {table}${partition_key} thất bại")
+
+class LocalSyncBackend:
+    """
+    Giả lập GCS/BigQuery trên đĩa để thử nghiệm không cần tài khoản Cloud:
+    - upload: chép file vào <root>/gcs/<blob>
+    - load: kiểm tra schema rồi ghi vào <root>/bigquery/<dataset>/<table>/<phân vùng>.parquet
+      ('table$YYYYMM' giống partition decorator của BigQuery; không có decorator = cả bảng)
+    """
+
+    def __init__(self, root=None):
+        self.root = os.path.abspath(root or CLOUD_SYNC_CONFIG['local_dir'])
+        self.loads = []
+
+    def _table_dir(self, dataset, table):
+        return os.path.join(self.root, 'bigquery', dataset, table)
+
+    def ensure_dataset(self, dataset):
+        os.makedirs(os.path.join(self.root, 'bigquery', dataset), exist_ok=True)
+
+    def upload(self, local_path, blob_name):
+        target = os.path.join(self.root, 'gcs', blob_name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(local_path, target)
+        return target
+
+    def prepare_table(self, dataset, table, schema, partition_field=None):
+        """Không cần làm gì: load WRITE_TRUNCATE cả bảng đã xóa thư mục của bảng cũ"""
+
+    def load(self, uri, dataset, table, schema, write_disposition='WRITE_TRUNCATE', partition_field=None):
+        file_columns = pq.read_schema(uri).names
+        schema_columns = [f['name'] for f in schema]
+        if file_columns != schema_columns:
+            raise ValueError(f"Schema không khớp khi load {table}: {file_columns} != {schema_columns}")
+
+        table_name, _, partition_key = table.partition('$')
+        table_dir = self._table_dir(dataset, table_name)
+        if write_disposition == 'WRITE_TRUNCATE':
+            if partition_key:
+                self.delete_partition(dataset, table_name, partition_key)
+            else:
+                shutil.rmtree(table_dir, ignore_errors=True)
+        os.makedirs(table_dir, exist_ok=True)
+
+        prefix = partition_key or 'all'
+        existing = [f for f in os.listdir(table_dir) if f.startswith(f"{prefix}.")]
+        target = os.path.join(table_dir, f"{prefix}.{len(existing)}.parquet")
+        shutil.copyfile(uri, target)
+        rows = pq.ParquetFile(target).metadata.num_rows
+        self.loads.append({'dataset': dataset, 'table': table, 'rows': rows,
+                           'write_disposition': write_disposition})
+
+    def delete_partition(self, dataset, table, partition_key):
+        table_dir = self._table_dir(dataset, table)
+        if os.path.isdir(table_dir):
+            for f in os.listdir(table_dir):
+                if f.startswith(f"{partition_key}."):
+                    os.remove(os.path.join(table_dir, f))
+        self.loads.append({'dataset': dataset, 'table': f"{table}${partition_key}", 'rows': 0,
+                           'write_disposition': 'DELETE'})
+
+def get_sync_backend(name=None):
+    """Tạo backend theo tên ('gcp' hoặc 'local')"""
+    name = name or CLOUD_SYNC_CONFIG['backend']
+    if name == 'gcp':
+        return GcpSyncBackend()
+    if name == 'local':
+        return LocalSyncBackend()
+    raise ValueError(f"Backend đồng bộ không hợp lệ: {name}. Chọn 'gcp' hoặc 'local'")
+
+# HÀM CHẠY CHÍNH
+def _export_and_load(full_table_name, backend, dataset, work_dir, target, write_disposition,
+                     partition_field=None, where=None, params=None):
+    """
+    Xuất (một phần) bảng ra Parquet, upload và load vào bảng/phân vùng đích. Trả về (dòng, byte).
+    Load cả bảng (không có decorator) -> trước đó kiểm tra phân vùng/schema của bảng đích.
+    """
+    file_name = f"{target.replace('$', '_')}.parquet"
+    local_path = os.path.join(work_dir, file_name)
+    rows, bq_schema = export_table_to_parquet(full_table_name, local_path, where=where, params=params)
+    size = os.path.getsize(local_path)
+    record_io(rows_in=rows, rows_out=rows, bytes_out=size)
+    uri = backend.upload(local_path, f"{CLOUD_SYNC_CONFIG['gcs_prefix']}{file_name}")
+    if '$' not in target:
+        backend.prepare_table(dataset, target, bq_schema, partition_field)
+    backend.load(uri, dataset, target, bq_schema, write_disposition, partition_field)
+    os.remove(local_path)
+    return rows, size
+
+def sync_table(full_table_name, backend, dataset, work_dir, force_full=False):
+    """
+    Đồng bộ một bảng theo kế hoạch từ manifest:
+    - 'skip': fingerprint không đổi -> không làm gì.
+    - 'full': lần đầu / schema đổi / bảng Dim thay đổi -> đẩy toàn bộ (WRITE_TRUNCATE).
+    - 'partitions': bảng Fact -> tháng thay đổi hoặc tháng mới WRITE_TRUNCATE (ghi lại được nhiều lần),
+      tháng không còn dữ liệu bị xóa (qua partition decorator table$YYYYMM).
+    Manifest chỉ được cập nhật khi toàn bộ bảng đồng bộ thành công.
+    Trả về dict thống kê.
+    """
+    table_name = full_table_name.split('.')[-1]
+    spec = SYNC_TABLE_SPECS[full_table_name]
+    partition_column = spec.get('partition_column')
+
+    start = time.perf_counter()
+    with get_db_engine().begin() as conn:
+        ensure_manifest_table(conn)
+        schema_hash = compute_schema_hash(get_column_types(conn, full_table_name))
+        current = compute_fingerprints(conn, full_table_name, spec)
+        previous, previous_schema_hash = get_manifest(conn, full_table_name)
+
+    plan = plan_table_sync(current, previous, schema_hash, previous_schema_hash,
+                           partitioned=bool(partition_column), force_full=force_full)
+    rows, size = 0, 0
+
+    if plan['action'] == 'full':
+        rows, size = _export_and_load(full_table_name, backend, dataset, work_dir, table_name,
+                                      'WRITE_TRUNCATE', partition_column)
+    elif plan['action'] == 'partitions':
+        for key in plan['truncate']:
+            where, params = partition_filter(partition_column, key)
+            r, b = _export_and_load(full_table_name, backend, dataset, work_dir, f"{table_name}${key}",
+                                    'WRITE_TRUNCATE', partition_column, where, params)
+            rows += r
+            size += b
+        for key in plan['delete']:
+            backend.delete_partition(dataset, table_name, key)
+
+    if plan['action'] != 'skip':
+        save_manifest(full_table_name, current, schema_hash)
+
+    return {
+        'action': plan['action'],
+        'partitions': len(plan['truncate']) + len(plan['delete']),
+        'rows': rows, 'bytes': size, 'seconds': time.perf_counter() - start
+    }
+
+def sync_warehouse(tables=None, backend=None, dataset=None, max_workers=None, force_full=False):
+    """
+    Đồng bộ các bảng Warehouse lên Cloud, nhiều bảng cùng lúc (chỉ phần thay đổi).
+    :param tables: Danh sách bảng (mặc định WAREHOUSE_SYNC_TABLES)
+    :param backend: Tên backend hoặc đối tượng backend (mặc định theo CLOUD_SYNC_CONFIG)
+    :param force_full: Bỏ qua manifest, đẩy lại toàn bộ các bảng
+    :return: dict {bảng: {'action', 'partitions', 'rows', 'bytes', 'seconds'}} (bảng lỗi không có trong kết quả)
+    """
+    print("\n Bắt đầu đồng bộ Data Warehouse lên Cloud (Parquet)...")
+
+    tables = tables or WAREHOUSE_SYNC_TABLES
+    dataset = dataset or CLOUD_SYNC_CONFIG['dataset']
+    max_workers = max_workers or CLOUD_SYNC_CONFIG['max_workers']
+    if backend is None or isinstance(backend, str):
+        backend = get_sync_backend(backend)
+
+    backend.ensure_dataset(dataset)
+    stats = {}
+    start = time.perf_counter()
+
+    with tempfile.TemporaryDirectory(prefix='olist_sync_') as work_dir:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(run_tracked, f"sync:{table}", sync_table,
+                                table, backend, dataset, work_dir, force_full): table
+                for table in tables
+            }
+            for future in as_completed(futures):
+                table = futures[future]
+                try:
+                    stats[table] = future.result()
+                    s = stats[table]
+                    if s['action'] == 'skip':
+                        print(f"  -> {table:30s}: không đổi, bỏ qua")
+                        continue
+                    detail = f" | {s['partitions']} phân vùng" if s['action'] == 'partitions' else " | toàn bộ"
+                    print(f"  -> {table:30s}: {s['rows']:>10,} dòng | "
+                          f"{s['bytes'] / 1024 / 1024:7.2f} MB | {s['seconds']:6.2f}s{detail}")
+                except Exception as e:
+                    print(f"Không thể đồng bộ bảng {table}: {e}")
+
+    print(f"  Đồng bộ {len(stats)}/{len(tables)} bảng trong {time.perf_counter() - start:.2f}s")
+    return stats
+
+if __name__ == "__main__":
+    sync_warehouse()
@@ -3,7 +3,10 @@ File cấu hình cơ sở dữ liệu cho ETL
 Cập nhật: Đồng bộ với quy trình ELT/ETL Hybrid mới nhất
 """
 import os
-from sqlalchemy import create_engine
+import threading
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
 
 # Cấu hình kết nối PostgreSQL
 DB_CONFIG = {
@@ -20,9 +23,155 @@ DB_CONNECTION_STRING = (
     f"@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['database']}"
 )
 
-def get_db_engine():
-    """Tạo và trả về đối tượng kết nối (engine) đến cơ sở dữ liệu"""
-    return create_engine(DB_CONNECTION_STRING)
+# Cấu hình Connection Pool (dùng chung cho toàn bộ tiến trình)
+DB_POOL_CONFIG = {
+    'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+    'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+    'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '30')),        # Giây chờ tối đa khi pool cạn
+    'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),      # Tạo lại kết nối sau N giây
+    'pool_pre_ping': True,                                          # Kiểm tra kết nối còn sống trước khi dùng
+    'statement_timeout_ms': int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '0'))  # 0 = không giới hạn
+}
+
+class PoolMetrics:
+    """Bộ đếm checkout/checkin và thời gian chờ kết nối của một pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connects = 0          # Số kết nối DBAPI mới (TCP + xác thực)
+            self.checkouts = 0
+            self.checkins = 0
+            self.in_use = 0
+            self.max_in_use = 0
+            self.total_wait_s = 0.0
+            self.max_wait_s = 0.0
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.total_wait_s += seconds
+            self.max_wait_s = max(self.max_wait_s, seconds)
+
+    def record_connect(self):
+        with self._lock:
+            self.connects += 1
+
+    def record_checkout(self):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def record_checkin(self):
+        with self._lock:
+            self.checkins += 1
+            self.in_use = max(self.in_use - 1, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'total_wait_s': round(self.total_wait_s, 4),
+                'max_wait_s': round(self.max_wait_s, 4),
+                'avg_wait_ms': round(1000 * self.total_wait_s / self.checkouts, 3) if self.checkouts else 0.0
+            }
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool đo thời gian chờ lấy kết nối (phản ánh tranh chấp khi chạy song song)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.metrics.record_wait(time.perf_counter() - start)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+_ENGINES = {}
+_ENGINE_LOCK = threading.Lock()
+
+def _create_pooled_engine(**overrides):
+    """Tạo engine với pool có đo đạc theo DB_POOL_CONFIG"""
+    pool_config = {**DB_POOL_CONFIG, **overrides}
+    statement_timeout_ms = pool_config.pop('statement_timeout_ms')
+
+    connect_args = {}
+    if statement_timeout_ms:
+        connect_args['options'] = f"-c statement_timeout={statement_timeout_ms}"
+
+    engine = create_engine(
+        DB_CONNECTION_STRING,
+        poolclass=InstrumentedQueuePool,
+        connect_args=connect_args,
+        **pool_config
+    )
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_conn, conn_record):
+        engine.pool.metrics.record_connect()
+
+    @event.listens_for(engine, 'checkout')
+    def _on_checkout(dbapi_conn, conn_record, conn_proxy):
+        engine.pool.metrics.record_checkout()
+
+    @event.listens_for(engine, 'checkin')
+    def _on_checkin(dbapi_conn, conn_record):
+        engine.pool.metrics.record_checkin()
+
+    return engine
+
+def get_db_engine(name='default', **pool_overrides):
+    """
+    Trả về engine dùng chung của tiến trình (tạo một lần, tái sử dụng pool kết nối).
+    :param name: Tên engine trong registry (dùng tên khác nếu cần pool với cấu hình riêng)
+    :param pool_overrides: Ghi đè DB_POOL_CONFIG khi engine được tạo lần đầu
+    """
+    with _ENGINE_LOCK:
+        engine = _ENGINES.get(name)
+        if engine is None:
+            engine = _create_pooled_engine(**pool_overrides)
+            _ENGINES[name] = engine
+        return engine
+
+def get_raw_connection(name='default'):
+    """Lấy kết nối psycopg2 từ pool (dùng cho COPY FROM STDIN / COPY TO STDOUT). Gọi close() để trả về pool."""
+    return get_db_engine(name).raw_connection()
+
+def get_pool_metrics(name='default'):
+    """Số liệu checkout/chờ kết nối của pool"""
+    engine = _ENGINES.get(name)
+    return engine.pool.metrics.snapshot() if engine is not None else {}
+
+def print_pool_metrics(name='default'):
+    """In số liệu pool kết nối"""
+    metrics = get_pool_metrics(name)
+    if not metrics:
+        return
+    print(f"  Pool '{name}': {metrics['connects']} kết nối mới | {metrics['checkouts']} lượt checkout | "
+          f"tối đa {metrics['max_in_use']} đồng thời | chờ TB {metrics['avg_wait_ms']} ms, "
+          f"tối đa {metrics['max_wait_s']}s")
+
+def dispose_engines():
+    """Đóng toàn bộ pool kết nối (gọi khi kết thúc tiến trình hoặc sau khi fork)"""
+    with _ENGINE_LOCK:
+        for engine in _ENGINES.values():
+            engine.dispose()
+        _ENGINES.clear()
 
 # Định nghĩa các schema
 SCHEMA_RAW = 'raw_data'
@@ -60,6 +209,7 @@ TABLES = {
         'dim_products': f'{SCHEMA_WAREHOUSE}.dim_products',
         'dim_sellers': f'{SCHEMA_WAREHOUSE}.dim_sellers',
         'dim_date': f'{SCHEMA_WAREHOUSE}.dim_date',
+        'zip_centroid': f'{SCHEMA_WAREHOUSE}.zip_centroid',
         
         # Aggregate tables (Reporting)
         'agg_daily_sales': f'{SCHEMA_WAREHOUSE}.agg_daily_sales',
@@ -68,11 +218,23 @@ TABLES = {
         'agg_state_performance': f'{SCHEMA_WAREHOUSE}.agg_state_performance',
         
         # Analysis tables (ML & Advanced Analytics)
+        'seller_evaluation': f'{SCHEMA_WAREHOUSE}.seller_evaluation',
         'customer_summary': f'{SCHEMA_WAREHOUSE}.customer_summary',
         'seller_scorecard': f'{SCHEMA_WAREHOUSE}.seller_scorecard',           
+        'seller_features': f'{SCHEMA_WAREHOUSE}.seller_features',
+        'seller_snapshots': f'{SCHEMA_WAREHOUSE}.seller_snapshots',
         'logistics_analytics': f'{SCHEMA_WAREHOUSE}.logistics_analytics',     
         'review_analysis_dataset': f'{SCHEMA_WAREHOUSE}.review_analysis_dataset',
-        'product_associations': f'{SCHEMA_WAREHOUSE}.product_associations'
+        'product_associations': f'{SCHEMA_WAREHOUSE}.product_associations',
+
+        # NLP tables (Review text)
+        'nlp_bad_review': f'{SCHEMA_WAREHOUSE}.nlp_bad_review',
+        'nlp_good_review': f'{SCHEMA_WAREHOUSE}.nlp_good_review',
+        'nlp_review_tokens': f'{SCHEMA_WAREHOUSE}.nlp_review_tokens',
+        'review_topics': f'{SCHEMA_WAREHOUSE}.review_topics',
+
+        # Sổ ghi các lần chạy pipeline (instrumentation.py)
+        'pipeline_runs': f'{SCHEMA_WAREHOUSE}.pipeline_runs'
     }
 }
 
@@ -87,6 +249,202 @@ BUSINESS_RULES = {
     'max_delivery_days': 365
 }
 
+# Cấu hình nạp dữ liệu thô (CSV -> raw_data)
+RAW_DATA_DIR = os.getenv('RAW_DATA_DIR', os.path.join(os.path.dirname(__file__), '..', 'data'))
+
+# Ánh xạ key bảng raw -> tên file CSV gốc của bộ dữ liệu Olist
+RAW_CSV_FILES = {
+    'customers': 'olist_customers_dataset.csv',
+    'orders': 'olist_orders_dataset.csv',
+    'order_items': 'olist_order_items_dataset.csv',
+    'products': 'olist_products_dataset.csv',
+    'sellers': 'olist_sellers_dataset.csv',
+    'reviews': 'olist_order_reviews_dataset.csv',
+    'geolocation': 'olist_geolocation_dataset.csv',
+    'payments': 'olist_order_payments_dataset.csv',
+    'product_category_name_translation': 'product_category_name_translation.csv'
+}
+
+INGESTION_CONFIG = {
+    'copy_buffer_size': 8 * 1024 * 1024,  # Số byte đọc mỗi lần khi stream file vào COPY
+    'max_workers': int(os.getenv('INGESTION_WORKERS', '4'))
+}
+
+# Cấu hình ghi dữ liệu vào Staging
+# backend: 'copy' (COPY FROM STDIN + hoán đổi bảng) hoặc 'to_sql' (pandas INSERT multi-row, cách cũ)
+STAGING_WRITER_CONFIG = {
+    'backend': os.getenv('STAGING_WRITER', 'copy'),
+    'chunk_rows': 50000  # Số dòng serialize vào buffer cho mỗi lệnh COPY
+}
+
+# Chế độ làm sạch Staging: 'pandas' (xử lý trong Python) hoặc 'sql' (CREATE TABLE AS SELECT trong Database)
+CLEANING_MODE = os.getenv('CLEANING_MODE', 'pandas')
+
+# Bộ lập lịch DAG cho các bước dựng Warehouse/Aggregate
+DAG_CONFIG = {
+    'max_workers': int(os.getenv('DAG_MAX_WORKERS', '4'))  # Nên <= pool_size + max_overflow
+}
+
+# Chế độ làm mới bảng Fact: 'full' (DROP + CREATE TABLE AS) hoặc 'incremental' (upsert theo watermark)
+REFRESH_MODE = os.getenv('REFRESH_MODE', 'full')
+
+INCREMENTAL_CONFIG = {
+    # Lùi watermark N ngày để bắt các đơn cũ vừa đổi trạng thái / ngày giao
+    'lookback_days': int(os.getenv('INCREMENTAL_LOOKBACK_DAYS', '30'))
+}
+
+# Đo đạc pipeline: mỗi lần chạy ghi vào warehouse.pipeline_runs và một báo cáo JSON trong report_dir
+# Bước bị coi là chậm đi (regression) nếu wall time > regression_ratio lần lần chạy thành công trước
+# và chênh lệch tối thiểu regression_min_seconds giây
+INSTRUMENTATION_CONFIG = {
+    'report_dir': os.getenv('PIPELINE_REPORT_DIR', os.path.join(os.path.dirname(__file__), '..', 'reports')),
+    'write_ledger': os.getenv('PIPELINE_LEDGER', 'on') == 'on',
+    'regression_ratio': float(os.getenv('PIPELINE_REGRESSION_RATIO', '1.5')),
+    'regression_min_seconds': float(os.getenv('PIPELINE_REGRESSION_MIN_SECONDS', '1.0'))
+}
+
+# Bố cục vật lý các bảng Warehouse (xem warehouse_layout.py)
+# mode: 'optimized' (khóa, index sau khi nạp, phân vùng Fact theo tháng, ANALYZE) hoặc 'plain' (bảng heap như cũ)
+WAREHOUSE_LAYOUT_CONFIG = {
+    'mode': os.getenv('WAREHOUSE_LAYOUT', 'optimized'),
+    # Hoán đổi bảng shadow: chờ khóa tối đa lock_timeout rồi thử lại, để truy vấn đọc không bị xếp hàng sau lệnh RENAME
+    'swap_lock_timeout': os.getenv('WAREHOUSE_SWAP_LOCK_TIMEOUT', '5s'),
+    'swap_retries': int(os.getenv('WAREHOUSE_SWAP_RETRIES', '3'))
+}
+
+# Đồng bộ Warehouse lên Cloud (Postgres -> Parquet -> GCS -> BigQuery)
+# backend: 'gcp' (GCS + BigQuery thật) hoặc 'local' (ghi ra thư mục local_dir, dùng để thử nghiệm)
+CLOUD_SYNC_CONFIG = {
+    'backend': os.getenv('CLOUD_SYNC_BACKEND', 'gcp'),
+    'dataset': 'olist_analytics',
+    'gcs_prefix': 'warehouse/',
+    'row_group_rows': 100000,  # Số dòng mỗi lần fetch từ server-side cursor = 1 row group Parquet
+    'compression': 'snappy',
+    'max_workers': int(os.getenv('CLOUD_SYNC_WORKERS', '4')),
+    'local_dir': os.getenv('CLOUD_SYNC_LOCAL_DIR', os.path.join(os.path.dirname(__file__), '..', 'cloud_sync_local'))
+}
+
+# Upload lên Google Cloud Storage
+# STORAGE_BACKEND: 'gcs' (thật) hoặc 'local' (giả lập bucket trong LOCAL_STORAGE_DIR, dùng để thử nghiệm/benchmark)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'gcs')
+LOCAL_STORAGE_DIR = os.getenv('LOCAL_STORAGE_DIR', os.path.join(os.path.dirname(__file__), '..', 'local_storage'))
+
+GCS_UPLOAD_CONFIG = {
+    'chunk_size': 8 * 1024 * 1024,             # Kích thước mỗi khối resumable upload (bội số của 256 KB)
+    'composite_threshold': 64 * 1024 * 1024,   # File lớn hơn ngưỡng này được chia phần và upload song song
+    'composite_parts': 8,                      # Số phần (GCS compose tối đa 32 phần)
+    'max_workers': 8,
+    'max_retries': 5,
+    'backoff_base': 1.0,   # Giây chờ lần thử lại đầu tiên, nhân đôi sau mỗi lần
+    'backoff_max': 30.0
+}
+
+# Bảng logistics_analytics (khoảng cách Seller -> Customer) và bảng tâm zip (zip_centroid)
+# distance_method: 'numpy' (Haversine vector hóa trong Python) hoặc 'sql' (tính trong Database)
+LOGISTICS_CONFIG = {
+    'distance_method': os.getenv('LOGISTICS_DISTANCE_METHOD', 'numpy'),
+    # Khung tọa độ hợp lệ của Brazil, loại các điểm geolocation lỗi (nằm ngoài lãnh thổ)
+    'lat_range': (-34.0, 5.5),
+    'lng_range': (-74.0, -34.0)
+}
+
+# Chấm điểm Seller (chuyển từ notebook seller_management.ipynb)
+SELLER_SCORING_CONFIG = {
+    # Trọng số lấy từ feature importance của Random Forest (nhãn = cụm KMeans K=4)
+    'weights': {
+        'log_gmv': 0.2478,
+        'log_orders': 0.2281,
+        'avg_rating': 0.3288,
+        'late_shipment_rate': 0.1142,
+        'avg_prep_time_hours': 0.0812
+    },
+    'positive_features': ['log_gmv', 'log_orders', 'avg_rating'],           # Càng cao càng tốt
+    'negative_features': ['late_shipment_rate', 'avg_prep_time_hours'],     # Càng thấp càng tốt
+    'segment_labels': ['Bronze', 'Silver', 'Gold', 'Platinum'],
+    # Bộ lọc Seller "ma": ngừng bán > inactive_days hoặc < min_orders đơn, trừ người mới (<= new_seller_days)
+    'inactive_days': 180,
+    'new_seller_days': 60,
+    'min_orders': 2,
+    # Nguồn đặc trưng: 'feature_store' (warehouse.seller_features) hoặc 'items' (tính lại từ seller_evaluation)
+    'feature_source': os.getenv('SELLER_FEATURE_SOURCE', 'feature_store')
+}
+
+# Snapshot lịch sử của Seller (tính đặc trưng + hạng tại nhiều mốc thời gian trong một lượt, để backtest)
+SNAPSHOT_CONFIG = {
+    'months': int(os.getenv('SNAPSHOT_MONTHS', '24')),   # Số snapshot cuối tháng gần nhất
+    'verify_dates': 3                                     # Số mốc được đối chiếu với cách tính lọc-rồi-gộp
+}
+
+# Mô hình Seller (KMeans + Random Forest cho trọng số, Ward cho chân dung) và kho lưu mô hình đã huấn luyện
+MODEL_STORE_DIR = os.getenv('MODEL_STORE_DIR', os.path.join(os.path.dirname(__file__), '..', 'models'))
+
+SCORING_MODEL_CONFIG = {
+    'n_clusters': 4,       # K đã chọn từ Elbow/Silhouette/DBI trong notebook
+    'n_init': 10,
+    'rf_estimators': 100,
+    'random_state': 42
+}
+
+PERSONA_CONFIG = {
+    'features': ['avg_weight_g', 'category_diversity', 'market_reach',
+                 'avg_distance_km', 'avg_order_value', 'avg_freight_ratio'],
+    # Các biến phân phối lệch được log1p trước khi chuẩn hóa
+    'log_features': ['avg_weight_g', 'category_diversity', 'market_reach',
+                     'avg_distance_km', 'avg_order_value'],
+    'n_clusters': 7,
+    # Thuật toán phân cụm: 'ward' (chính xác, O(n²)), 'minibatch_ward' (micro-cluster + Ward trên tâm), 'birch'
+    'method': os.getenv('PERSONA_METHOD', 'ward'),
+    'n_micro_clusters': 500,     # Số micro-cluster của MiniBatchKMeans trước khi gộp bằng Ward
+    'batch_size': 4096,
+    'birch_threshold': 0.5,      # Bán kính tối đa của subcluster BIRCH (trên dữ liệu đã chuẩn hóa)
+    'exact_max_rows': 30000,     # Vượt ngưỡng này 'ward' tự chuyển sang 'minibatch_ward'
+    'random_state': 42
+}
+
+# Chọn số cụm K (Elbow / Silhouette / Davies-Bouldin) chạy song song, có cache theo hash ma trận đặc trưng
+MODEL_SELECTION_CONFIG = {
+    'k_range': (2, 10),                # K từ 2 đến 10 (bao gồm hai đầu)
+    'n_init': 10,
+    'random_state': 42,
+    'max_workers': int(os.getenv('MODEL_SELECTION_WORKERS', '4')),
+    # 'sample': silhouette trên mẫu phân tầng theo cụm; 'chunked': toàn bộ dữ liệu, tính theo khối
+    'silhouette_mode': os.getenv('SILHOUETTE_MODE', 'sample'),
+    'sample_size': 10000,
+    'working_memory_mb': 256,          # Bộ nhớ tối đa cho mỗi khối ma trận khoảng cách ('chunked')
+    'cache_dir': os.path.join(MODEL_STORE_DIR, 'k_selection')
+}
+
+# Tiền xử lý văn bản review cho các notebook NLP (LDA, wordcloud)
+NLP_CONFIG = {
+    'sources': {'bad': 'nlp_bad_review', 'good': 'nlp_good_review'},   # Nhãn -> bảng warehouse
+    'chunk_rows': 20000,            # Số review mỗi khối đọc từ server-side cursor / gửi cho một process
+    'max_workers': int(os.getenv('NLP_WORKERS', '4')),
+    'stopword_language': 'portuguese',
+    # Stop words bổ sung theo nguồn: từ vô nghĩa trong review tốt (notebook nlp_review_good.ipynb).
+    # Không áp dụng cho review xấu vì 'entrega', 'prazo'... chính là từ khóa phàn nàn.
+    'extra_stopwords': {
+        'good': ['produto', 'entrega', 'prazo', 'antes', 'chegou', 'recomendo', 'muito', 'bom',
+                 'bem', 'tido', 'fazer', 'loja', 'vendedor']
+    }
+}
+
+# Mô hình chủ đề (LDA online) trên văn bản review đã làm sạch, theo từng nguồn của NLP_CONFIG
+TOPIC_MODEL_CONFIG = {
+    'models': {
+        # Chủ đề phàn nàn (notebook nlp_analysis.ipynb)
+        'bad': {'n_components': 4, 'max_df': 0.9, 'min_df': 25, 'max_features': None},
+        # Chủ đề khen ngợi (notebook nlp_review_good.ipynb)
+        'good': {'n_components': 10, 'max_df': 0.9, 'min_df': 5, 'max_features': 2000}
+    },
+    'batch_size': 4096,          # Số review mỗi mini-batch của online variational Bayes
+    'learning_offset': 10.0,
+    'learning_decay': 0.7,
+    'max_iter': 10,              # Số vòng qua dữ liệu khi huấn luyện lần đầu
+    'assign_chunk_rows': 20000,  # Số review mỗi khối khi gán chủ đề
+    'top_words': 10,
+    'random_state': 42
+}
+
 # Google cloud config
 GCP_KEY_PATH = os.path.join(os.path.dirname(__file__), 'D:/do_an/Olist_seller_management/gcp_key.json')
 GCS_BUCKET_NAME = 'olist-seller-evaluation'
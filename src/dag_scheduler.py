@@ -0,0 +1,192 @@
+"""
+Bộ lập lịch DAG cho các bước dựng bảng (Warehouse / Aggregate)
+- Mỗi bước khai báo bảng đầu vào (inputs) và bảng đầu ra (outputs).
+- Bước B phụ thuộc bước A nếu B đọc một bảng mà A tạo ra.
+- Các bước độc lập chạy song song trên thread pool giới hạn (mỗi luồng lấy kết nối riêng từ pool).
+- Một bước lỗi chỉ dừng các bước phía sau nó, các nhánh khác vẫn chạy tiếp.
+- Cuối cùng in báo cáo thời gian và đường găng (critical path).
+- Mỗi bước chạy trong instrumentation.track_step: số liệu được gom vào lần chạy pipeline_run đang mở.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from config import DAG_CONFIG
+from instrumentation import run_tracked
+
+class Step:
+    """Một bước trong DAG: hàm dựng bảng + các bảng nó đọc/ghi"""
+
+    def __init__(self, name, func, inputs=(), outputs=()):
+        self.name = name
+        self.func = func
+        self.inputs = set(inputs)
+        self.outputs = set(outputs)
+
+    def __repr__(self):
+        return f"Step({self.name!r})"
+
+# CÁC HÀM HỖ TRỢ
+def resolve_dependencies(steps):
+    """
+    Xác định các bước phụ thuộc của từng bước dựa trên inputs/outputs.
+    Bảng đầu vào không do bước nào tạo ra được coi là đã có sẵn (vd: staging.*).
+    """
+    producers = {}
+    for step in steps:
+        for table in step.outputs:
+            if table in producers:
+                raise ValueError(f"Bảng {table} được tạo bởi nhiều bước: "
+                                 f"{producers[table]} và {step.name}")
+            producers[table] = step.name
+
+    deps = {
+        step.name: {producers[t] for t in step.inputs if t in producers and producers[t] != step.name}
+        for step in steps
+    }
+
+    # Kiểm tra chu trình bằng thuật toán Kahn
+    remaining = {name: set(d) for name, d in deps.items()}
+    while remaining:
+        ready = [name for name, d in remaining.items() if not d]
+        if not ready:
+            raise ValueError(f"DAG có chu trình giữa các bước: {sorted(remaining)}")
+        for name in ready:
+            del remaining[name]
+        for d in remaining.values():
+            d.difference_update(ready)
+
+    return deps
+
+def descendants(deps, name):
+    """Tất cả các bước (trực tiếp hoặc gián tiếp) phụ thuộc vào bước name"""
+    children = {}
+    for child, parents in deps.items():
+        for parent in parents:
+            children.setdefault(parent, set()).add(child)
+
+    found, stack = set(), [name]
+    while stack:
+        for child in children.get(stack.pop(), ()):
+            if child not in found:
+                found.add(child)
+                stack.append(child)
+    return found
+
+def critical_path(deps, results):
+    """Chuỗi bước dài nhất (theo tổng thời gian chạy) qua các bước đã thực thi"""
+    finish = {}
+
+    def longest(name):
+        if name not in finish:
+            own = results[name]['seconds']
+            parents = [p for p in deps[name] if results[p]['status'] != 'skipped']
+            best = max(parents, key=longest, default=None)
+            finish[name] = (own + (longest(best)[0] if best else 0.0), best)
+        return finish[name]
+
+    executed = [n for n, r in results.items() if r['status'] != 'skipped']
+    if not executed:
+        return [], 0.0
+
+    end = max(executed, key=lambda n: longest(n)[0])
+    total = longest(end)[0]
+    path = []
+    while end is not None:
+        path.append(end)
+        end = finish[end][1]
+    return path[::-1], total
+
+def print_dag_report(deps, results, wall_seconds):
+    """In bảng thời gian từng bước và đường găng"""
+    print("\n  BÁO CÁO THỜI GIAN DAG:")
+    ordered = sorted(results.items(), key=lambda kv: (kv[1]['start'] is None, kv[1]['start'] or 0))
+    for name, r in ordered:
+        if r['status'] == 'skipped':
+            print(f"    {name:30s} {'-':>8s} {'-':>8s} {'-':>8s}  BỎ QUA (phụ thuộc lỗi)")
+        else:
+            print(f"    {name:30s} {r['start']:7.2f}s {r['end']:7.2f}s {r['seconds']:7.2f}s  {r['status'].upper()}")
+
+    path, path_seconds = critical_path(deps, results)
+    serial_seconds = sum(r['seconds'] for r in results.values())
+    print(f"\n  Đường găng ({path_seconds:.2f}s): {' -> '.join(path)}")
+    print(f"  Thời gian thực: {wall_seconds:.2f}s | Nếu chạy tuần tự: {serial_seconds:.2f}s"
+          f" | Tăng tốc: {serial_seconds / wall_seconds if wall_seconds > 0 else 1:.2f}x")
+
+# HÀM CHẠY CHÍNH
+def run_dag(steps, max_workers=None, parallel=True):
+    """
+    Chạy các bước theo thứ tự phụ thuộc.
+    :param max_workers: Số bước chạy đồng thời tối đa (mặc định DAG_CONFIG)
+    :param parallel: False -> chạy lần lượt từng bước (1 worker)
+    :return: dict {tên bước: {'status', 'result', 'start', 'end', 'seconds', 'error'}}
+    """
+    deps = resolve_dependencies(steps)
+    by_name = {step.name: step for step in steps}
+    max_workers = (max_workers or DAG_CONFIG['max_workers']) if parallel else 1
+
+    results = {
+        name: {'status': 'pending', 'result': None, 'start': None, 'end': None,
+               'seconds': 0.0, 'error': None}
+        for name in by_name
+    }
+    dag_start = time.perf_counter()
+
+    def execute(step):
+        results[step.name]['start'] = time.perf_counter() - dag_start
+        return run_tracked(step.name, step.func)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+
+        def submit_ready():
+            for name, r in results.items():
+                if r['status'] == 'pending' and all(results[d]['status'] == 'success' for d in deps[name]):
+                    r['status'] = 'running'
+                    running[executor.submit(execute, by_name[name])] = name
+
+        submit_ready()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                r = results[name]
+                r['end'] = time.perf_counter() - dag_start
+                r['seconds'] = r['end'] - (r['start'] or r['end'])
+                try:
+                    r['result'] = future.result()
+                    r['status'] = 'success'
+                except Exception as e:
+                    r['status'] = 'failed'
+                    r['error'] = e
+                    print(f"  Bước {name} lỗi: {e}")
+                    for child in descendants(deps, name):
+                        if results[child]['status'] == 'pending':
+                            results[child]['status'] = 'skipped'
+            submit_ready()
+
+    print_dag_report(deps, results, time.perf_counter() - dag_start)
+    return results
+
+def results_to_stats(results):
+    """
+    Chuyển kết quả DAG về dạng {bảng: số dòng} như các hàm run_* trước đây.
+    Bước lỗi/bị bỏ qua -> None (không báo thành 0 dòng); bước thành công không trả về số dòng -> 0.
+    """
+    return {name: ((r['result'] if r['result'] is not None else 0) if r['status'] == 'success' else None)
+            for name, r in results.items()}
+
+def format_stat(count):
+    """Số dòng để in trong bảng tổng kết (None -> LỖI)"""
+    return f"{count:,} dòng" if count is not None else "LỖI / BỎ QUA"
+
+def has_failures(results):
+    """Có bước nào lỗi hoặc bị bỏ qua không"""
+    return any(r['status'] in ('failed', 'skipped') for r in results.values())
+
+def raise_for_failures(results):
+    """Ném lỗi nếu có bước lỗi hoặc bị bỏ qua (gọi sau khi đã in tổng kết và ghi sổ)"""
+    failed = {name: r['error'] for name, r in results.items() if r['status'] == 'failed'}
+    skipped = [name for name, r in results.items() if r['status'] == 'skipped']
+    if failed or skipped:
+        detail = '; '.join(f"{name}: {error}" for name, error in failed.items())
+        raise RuntimeError(f"{len(failed)} bước lỗi ({detail}), {len(skipped)} bước bị bỏ qua: {skipped}")
@@ -6,124 +6,395 @@ Tổng hợp dữ liệu (Tối ưu hóa ELT/ETL Hybrid)
 - CẬP NHẬT: Đọc Geolocation từ Staging thay vì Raw.
 """
 
+import time
 import pandas as pd
 import numpy as np
 from sqlalchemy import text
-from config import get_db_engine, SCHEMA_WAREHOUSE
-from datetime import timedelta
+import config
+from config import get_db_engine, print_pool_metrics, SCHEMA_WAREHOUSE
+from datetime import timedelta, datetime
+from bulk_writer import write_with_copy
+from dag_scheduler import Step, run_dag, results_to_stats, has_failures, raise_for_failures
+from instrumentation import pipeline_run, record_io
+from seller_features import refresh_seller_features
+from text_pipeline import build_review_tokens
+from topic_model import run_topic_modeling
+from geo_index import EARTH_RADIUS_KM, ZIP_CENTROID_TABLE, create_zip_centroid, get_zip_index, zip_prefix_sql
+from data_transformation import TRANSFORMATION_STEPS, create_warehouse_schema, sync_warehouse_to_cloud
+from warehouse_layout import create_table_as, publish_shadow, shadow_table_name
+from incremental import (
+    CHANGE_LOG_TABLE, table_exists, get_watermark, get_watermark_updated_at,
+    set_watermark
+)
 
 def execute_sql_elt(task_name, sql_query):
-    """Hàm chạy SQL thuần"""
+    """
+    Dựng lại bảng warehouse.{task_name} từ câu SELECT (lỗi được in ra rồi ném tiếp cho bộ lập lịch DAG).
+    Bảng được dựng dưới dạng shadow, có index + ANALYZE theo warehouse_layout rồi mới hoán đổi vào chỗ bảng cũ.
+    """
     print(f"Đang tạo bảng {task_name}...")
     engine = get_db_engine()
     try:
-        with engine.begin() as conn:
-            conn.execute(text(sql_query))
-        
-        # Đếm số dòng
-        count = pd.read_sql(f"SELECT COUNT(1) FROM {SCHEMA_WAREHOUSE}.{task_name}", engine).iloc[0,0]
+        # Số dòng lấy từ command status của lệnh nạp, không quét lại bảng
+        count = create_table_as(f"{SCHEMA_WAREHOUSE}.{task_name}", sql_query, engine=engine)
         print(f"   -> Hoàn tất. Bảng {task_name} có {count:,} dòng.")
         return count
     except Exception as e:
         print(f"   ERROR creating {task_name}: {e}")
-        return 0
+        raise
 
-def create_agg_daily_sales():
-    print("Đang tạo agg_daily_sales...")
-    
-    sql = """
-    DROP TABLE IF EXISTS warehouse.agg_daily_sales;
-    CREATE TABLE warehouse.agg_daily_sales AS (
-        WITH daily_data AS (
-            SELECT 
-                fo.order_purchase_timestamp::date as date,
-                SUM(fo.total_amount) as revenue,
-                COUNT(DISTINCT fo.order_id) as orders,
-                -- Đếm người dùng thực tế (Unique ID) thay vì customer_id đơn thuần
-                COUNT(DISTINCT c.customer_unique_id) as customers
-            FROM warehouse.fact_orders fo
-            JOIN warehouse.dim_customers c ON fo.customer_id = c.customer_id
-            WHERE fo.order_status IN ('delivered', 'shipped', 'invoiced')
-            GROUP BY 1
-        ),
-        date_range AS (
-            SELECT generate_series(MIN(date), MAX(date), '1 day'::interval)::date as d
-            FROM daily_data
-        )
-        SELECT 
-            dr.d as date,
-            COALESCE(dd.revenue, 0) as revenue,
-            COALESCE(dd.orders, 0) as orders,
-            COALESCE(dd.customers, 0) as customers
-        FROM date_range dr
-        LEFT JOIN daily_data dd ON dr.d = dd.date
-        ORDER BY dr.d
-    );
-    """
-    return execute_sql_elt('agg_daily_sales', sql)
-
-def create_agg_product_performance():
-    sql = """
-    DROP TABLE IF EXISTS warehouse.agg_product_performance;
-    CREATE TABLE warehouse.agg_product_performance AS (
+# CÂU SELECT CỦA CÁC BẢNG AGGREGATE (dùng chung cho dựng lại toàn bộ và kiểm tra tăng dần)
+AGG_DAILY_SALES_SQL = """
+    WITH daily_data AS (
         SELECT 
-            oi.product_id,
-            SUM(oi.price) as revenue,
-            COUNT(*) as quantity,
-            COUNT(DISTINCT oi.order_id) as order_count,
-            RANK() OVER (ORDER BY SUM(oi.price) DESC) as rank
-        FROM staging.order_items_cleaned oi
-        JOIN warehouse.fact_orders fo ON oi.order_id = fo.order_id
+            fo.order_purchase_timestamp::date as date,
+            SUM(fo.total_amount) as revenue,
+            COUNT(DISTINCT fo.order_id) as orders,
+            -- Đếm người dùng thực tế (Unique ID) thay vì customer_id đơn thuần
+            COUNT(DISTINCT c.customer_unique_id) as customers
+        FROM warehouse.fact_orders fo
+        JOIN warehouse.dim_customers c ON fo.customer_id = c.customer_id
         WHERE fo.order_status IN ('delivered', 'shipped', 'invoiced')
-        GROUP BY oi.product_id
-    );
-    """
-    return execute_sql_elt('agg_product_performance', sql)
+        GROUP BY 1
+    ),
+    date_range AS (
+        SELECT generate_series(MIN(date), MAX(date), '1 day'::interval)::date as d
+        FROM daily_data
+    )
+    SELECT 
+        dr.d as date,
+        COALESCE(dd.revenue, 0) as revenue,
+        COALESCE(dd.orders, 0) as orders,
+        COALESCE(dd.customers, 0) as customers
+    FROM date_range dr
+    LEFT JOIN daily_data dd ON dr.d = dd.date
+    ORDER BY dr.d
+"""
 
-def create_agg_category_performance():
-    sql = """
-    DROP TABLE IF EXISTS warehouse.agg_category_performance;
-    CREATE TABLE warehouse.agg_category_performance AS (
-        SELECT 
-            p.category_english as category,
-            SUM(oi.price) as revenue,
-            COUNT(DISTINCT oi.order_id) as orders,
-            ROUND(AVG(oi.price)::numeric, 2) as avg_price
-        FROM staging.order_items_cleaned oi
-        JOIN warehouse.dim_products p ON oi.product_id = p.product_id
-        JOIN warehouse.fact_orders fo ON oi.order_id = fo.order_id
-        WHERE fo.order_status IN ('delivered', 'shipped', 'invoiced')
-        GROUP BY p.category_english
-        ORDER BY revenue DESC
-    );
-    """
-    return execute_sql_elt('agg_category_performance', sql)
+AGG_PRODUCT_PERFORMANCE_SQL = """
+    SELECT 
+        oi.product_id,
+        SUM(oi.price) as revenue,
+        COUNT(*) as quantity,
+        COUNT(DISTINCT oi.order_id) as order_count,
+        RANK() OVER (ORDER BY SUM(oi.price) DESC) as rank
+    FROM staging.order_items_cleaned oi
+    JOIN warehouse.fact_orders fo ON oi.order_id = fo.order_id
+    WHERE fo.order_status IN ('delivered', 'shipped', 'invoiced')
+    GROUP BY oi.product_id
+"""
 
-def create_agg_state_performance():
-    sql = """
-    DROP TABLE IF EXISTS warehouse.agg_state_performance;
-    CREATE TABLE warehouse.agg_state_performance AS (
+AGG_CATEGORY_PERFORMANCE_SQL = """
+    SELECT 
+        p.category_english as category,
+        SUM(oi.price) as revenue,
+        COUNT(DISTINCT oi.order_id) as orders,
+        ROUND(AVG(oi.price)::numeric, 2) as avg_price
+    FROM staging.order_items_cleaned oi
+    JOIN warehouse.dim_products p ON oi.product_id = p.product_id
+    JOIN warehouse.fact_orders fo ON oi.order_id = fo.order_id
+    WHERE fo.order_status IN ('delivered', 'shipped', 'invoiced')
+    GROUP BY p.category_english
+    ORDER BY revenue DESC
+"""
+
+AGG_STATE_PERFORMANCE_SQL = """
+    SELECT 
+        c.customer_state as state,
+        SUM(fo.total_amount) as revenue,
+        COUNT(DISTINCT fo.order_id) as orders,
+        ROUND(AVG(fo.actual_delivery_days)::numeric, 2) as avg_delivery_days
+    FROM warehouse.fact_orders fo
+    JOIN warehouse.dim_customers c ON fo.customer_id = c.customer_id
+    WHERE fo.order_status IN ('delivered', 'shipped', 'invoiced')
+    GROUP BY c.customer_state
+    ORDER BY revenue DESC
+"""
+
+# CẬP NHẬT TĂNG DẦN: chỉ tính lại các phân vùng (ngày/sản phẩm/danh mục/bang) bị ảnh hưởng.
+# Các câu lệnh chạy sau khi bảng tạm agg_changes (các dòng nhật ký mới) đã được tạo.
+AGG_DAILY_SALES_REFRESH = [
+    """
+    CREATE TEMP TABLE affected_dates ON COMMIT DROP AS
+    SELECT purchase_date AS date FROM agg_changes WHERE purchase_date IS NOT NULL
+    UNION
+    SELECT fo.order_purchase_timestamp::date
+    FROM warehouse.fact_orders fo JOIN agg_changes ch ON fo.order_id = ch.order_id
+    """,
+    "DELETE FROM warehouse.agg_daily_sales WHERE date IN (SELECT date FROM affected_dates)",
+    """
+    INSERT INTO warehouse.agg_daily_sales (date, revenue, orders, customers)
+    SELECT 
+        ad.date,
+        COALESCE(dd.revenue, 0),
+        COALESCE(dd.orders, 0),
+        COALESCE(dd.customers, 0)
+    FROM affected_dates ad
+    LEFT JOIN (
         SELECT 
-            c.customer_state as state,
+            fo.order_purchase_timestamp::date as date,
             SUM(fo.total_amount) as revenue,
             COUNT(DISTINCT fo.order_id) as orders,
-            ROUND(AVG(fo.actual_delivery_days)::numeric, 2) as avg_delivery_days
+            COUNT(DISTINCT c.customer_unique_id) as customers
         FROM warehouse.fact_orders fo
         JOIN warehouse.dim_customers c ON fo.customer_id = c.customer_id
         WHERE fo.order_status IN ('delivered', 'shipped', 'invoiced')
-        GROUP BY c.customer_state
-        ORDER BY revenue DESC
-    );
+          AND fo.order_purchase_timestamp >= (SELECT MIN(date) FROM affected_dates)
+          AND fo.order_purchase_timestamp < (SELECT MAX(date) FROM affected_dates) + 1
+          AND fo.order_purchase_timestamp::date IN (SELECT date FROM affected_dates)
+        GROUP BY 1
+    ) dd ON ad.date = dd.date
+    """,
+    # Giữ chuỗi ngày liên tục giữa ngày có đơn đầu tiên và cuối cùng (như bản dựng lại toàn bộ)
+    """
+    DELETE FROM warehouse.agg_daily_sales
+    WHERE orders = 0
+      AND (date < (SELECT MIN(date) FROM warehouse.agg_daily_sales WHERE orders > 0)
+           OR date > (SELECT MAX(date) FROM warehouse.agg_daily_sales WHERE orders > 0))
+    """,
+    """
+    INSERT INTO warehouse.agg_daily_sales (date, revenue, orders, customers)
+    SELECT g::date, 0, 0, 0
+    FROM generate_series(
+        (SELECT MIN(date) FROM warehouse.agg_daily_sales),
+        (SELECT MAX(date) FROM warehouse.agg_daily_sales),
+        '1 day'::interval
+    ) g
+    WHERE NOT EXISTS (SELECT 1 FROM warehouse.agg_daily_sales a WHERE a.date = g::date)
+    """
+]
+
+AGG_AFFECTED_PRODUCTS = """
+    CREATE TEMP TABLE affected_products ON COMMIT DROP AS
+    SELECT product_id FROM agg_changes WHERE product_id IS NOT NULL
+    UNION
+    SELECT oi.product_id
+    FROM staging.order_items_cleaned oi JOIN agg_changes ch ON oi.order_id = ch.order_id
+"""
+
+AGG_PRODUCT_PERFORMANCE_REFRESH = [
+    AGG_AFFECTED_PRODUCTS,
+    """
+    DELETE FROM warehouse.agg_product_performance
+    WHERE product_id IN (SELECT product_id FROM affected_products)
+    """,
+    """
+    INSERT INTO warehouse.agg_product_performance (product_id, revenue, quantity, order_count, rank)
+    SELECT 
+        oi.product_id,
+        SUM(oi.price),
+        COUNT(*),
+        COUNT(DISTINCT oi.order_id),
+        NULL
+    FROM staging.order_items_cleaned oi
+    JOIN warehouse.fact_orders fo ON oi.order_id = fo.order_id
+    WHERE fo.order_status IN ('delivered', 'shipped', 'invoiced')
+      AND oi.product_id IN (SELECT product_id FROM affected_products)
+    GROUP BY oi.product_id
+    """,
+    # Chỉ ghi lại hạng của các sản phẩm có thứ hạng thực sự thay đổi
+    """
+    UPDATE warehouse.agg_product_performance a
+    SET rank = r.new_rank
+    FROM (
+        SELECT product_id, RANK() OVER (ORDER BY revenue DESC) AS new_rank
+        FROM warehouse.agg_product_performance
+    ) r
+    WHERE a.product_id = r.product_id
+      AND a.rank IS DISTINCT FROM r.new_rank
+    """
+]
+
+AGG_CATEGORY_PERFORMANCE_REFRESH = [
+    AGG_AFFECTED_PRODUCTS,
+    """
+    CREATE TEMP TABLE affected_categories ON COMMIT DROP AS
+    SELECT DISTINCT p.category_english AS category
+    FROM warehouse.dim_products p JOIN affected_products ap ON p.product_id = ap.product_id
+    """,
+    """
+    DELETE FROM warehouse.agg_category_performance a
+    WHERE EXISTS (SELECT 1 FROM affected_categories ac WHERE ac.category IS NOT DISTINCT FROM a.category)
+    """,
+    """
+    INSERT INTO warehouse.agg_category_performance (category, revenue, orders, avg_price)
+    SELECT 
+        p.category_english,
+        SUM(oi.price),
+        COUNT(DISTINCT oi.order_id),
+        ROUND(AVG(oi.price)::numeric, 2)
+    FROM staging.order_items_cleaned oi
+    JOIN warehouse.dim_products p ON oi.product_id = p.product_id
+    JOIN warehouse.fact_orders fo ON oi.order_id = fo.order_id
+    WHERE fo.order_status IN ('delivered', 'shipped', 'invoiced')
+      AND EXISTS (SELECT 1 FROM affected_categories ac
+                  WHERE ac.category IS NOT DISTINCT FROM p.category_english)
+    GROUP BY p.category_english
+    """
+]
+
+AGG_STATE_PERFORMANCE_REFRESH = [
+    """
+    CREATE TEMP TABLE affected_states ON COMMIT DROP AS
+    SELECT DISTINCT c.customer_state AS state
+    FROM warehouse.dim_customers c
+    WHERE c.customer_id IN (
+        SELECT customer_id FROM agg_changes WHERE customer_id IS NOT NULL
+        UNION
+        SELECT fo.customer_id FROM warehouse.fact_orders fo JOIN agg_changes ch ON fo.order_id = ch.order_id
+    )
+    """,
     """
-    return execute_sql_elt('agg_state_performance', sql)
+    DELETE FROM warehouse.agg_state_performance a
+    WHERE EXISTS (SELECT 1 FROM affected_states s WHERE s.state IS NOT DISTINCT FROM a.state)
+    """,
+    """
+    INSERT INTO warehouse.agg_state_performance (state, revenue, orders, avg_delivery_days)
+    SELECT 
+        c.customer_state,
+        SUM(fo.total_amount),
+        COUNT(DISTINCT fo.order_id),
+        ROUND(AVG(fo.actual_delivery_days)::numeric, 2)
+    FROM warehouse.fact_orders fo
+    JOIN warehouse.dim_customers c ON fo.customer_id = c.customer_id
+    WHERE fo.order_status IN ('delivered', 'shipped', 'invoiced')
+      AND EXISTS (SELECT 1 FROM affected_states s WHERE s.state IS NOT DISTINCT FROM c.customer_state)
+    GROUP BY c.customer_state
+    """
+]
+
+AGG_DEFINITIONS = {
+    'agg_daily_sales': (AGG_DAILY_SALES_SQL, AGG_DAILY_SALES_REFRESH, ['date']),
+    'agg_product_performance': (AGG_PRODUCT_PERFORMANCE_SQL, AGG_PRODUCT_PERFORMANCE_REFRESH, ['product_id']),
+    'agg_category_performance': (AGG_CATEGORY_PERFORMANCE_SQL, AGG_CATEGORY_PERFORMANCE_REFRESH, ['category']),
+    'agg_state_performance': (AGG_STATE_PERFORMANCE_SQL, AGG_STATE_PERFORMANCE_REFRESH, ['state']),
+}
+
+# Bảng Fact mà các aggregate đọc: nếu một trong số này vừa dựng lại toàn bộ thì aggregate cũng dựng lại
+AGG_SOURCE_FACTS = ['warehouse.fact_orders', 'warehouse.fact_order_items']
+
+# Bảng Dim mà từng aggregate đọc: Dim không ghi nhật ký thay đổi, nên khi nội dung Dim đổi
+# (track_dim_change đánh dấu full_rebuild) thì aggregate đó dựng lại toàn bộ
+AGG_SOURCE_DIMS = {
+    'agg_daily_sales': ['warehouse.dim_customers'],
+    'agg_category_performance': ['warehouse.dim_products'],
+    'agg_state_performance': ['warehouse.dim_customers'],
+}
+
+def build_aggregate(task_name, mode=None):
+    """
+    Dựng một bảng aggregate.
+    - 'full': dựng lại toàn bộ vào bảng shadow rồi hoán đổi (execute_sql_elt).
+    - 'incremental': đọc các dòng mới trong nhật ký thay đổi (etl_order_changes) từ lần chạy trước,
+      xóa và tính lại đúng các phân vùng bị ảnh hưởng rồi cập nhật watermark.
+      Tự động quay về dựng lại toàn bộ nếu chưa có watermark, Fact vừa được dựng lại toàn bộ
+      hoặc Dim mà aggregate đọc vừa thay đổi nội dung.
+    """
+    select_sql, refresh_statements, _ = AGG_DEFINITIONS[task_name]
+    full_table_name = f"{SCHEMA_WAREHOUSE}.{task_name}"
+    engine = get_db_engine()
+
+    with engine.begin() as conn:
+        watermark = get_watermark(conn, full_table_name) if table_exists(conn, full_table_name) else None
+        refreshed_at = get_watermark_updated_at(conn, full_table_name)
+        sources = AGG_SOURCE_FACTS + AGG_SOURCE_DIMS.get(task_name, [])
+        rebuilt_at = [get_watermark_updated_at(conn, f"{source}:full_rebuild") for source in sources]
+        latest_change = conn.execute(text(f"SELECT MAX(changed_at) FROM {CHANGE_LOG_TABLE}")).scalar()
+
+    needs_full = (
+        (mode or config.REFRESH_MODE) != 'incremental'
+        or watermark is None
+        or any(r is not None and r > refreshed_at for r in rebuilt_at)
+    )
+
+    if needs_full:
+        count = execute_sql_elt(task_name, select_sql)
+        with engine.begin() as conn:
+            set_watermark(conn, full_table_name, 'changed_at', latest_change or datetime.min)
+        return count
+
+    print(f"Đang cập nhật tăng dần {task_name}...")
+    if latest_change is None or latest_change <= watermark:
+        print(f"   -> Không có thay đổi mới. Bỏ qua {task_name}.")
+        return 0
+
+    try:
+        with engine.begin() as conn:
+            changed = conn.execute(text(f"""
+                CREATE TEMP TABLE agg_changes ON COMMIT DROP AS
+                SELECT order_id, customer_id, purchase_date, product_id
+                FROM {CHANGE_LOG_TABLE}
+                WHERE changed_at > :since AND changed_at <= :until
+            """), {'since': watermark, 'until': latest_change}).rowcount
+            written = 0
+            for statement in refresh_statements:
+                written += max(conn.execute(text(statement)).rowcount, 0)
+            set_watermark(conn, full_table_name, 'changed_at', latest_change)
+        record_io(rows_in=changed, rows_out=written)
+        print(f"   -> Hoàn tất. Đã tính lại {task_name} cho {changed:,} thay đổi.")
+        return changed
+    except Exception as e:
+        print(f"   ERROR refreshing {task_name}: {e}")
+        raise
+
+def verify_incremental_aggregates(tables=None):
+    """
+    So sánh các bảng aggregate hiện tại (sau khi cập nhật tăng dần) với kết quả dựng lại toàn bộ.
+    Cột số thực được làm tròn 6 chữ số để bỏ qua sai số do thứ tự cộng.
+    Trả về dict {bảng: số dòng khác biệt}.
+    """
+    print("KIỂM TRA AGGREGATE TĂNG DẦN SO VỚI DỰNG LẠI TOÀN BỘ")
+    engine = get_db_engine()
+    results = {}
+
+    for task_name in tables or AGG_DEFINITIONS.keys():
+        select_sql, _, key_columns = AGG_DEFINITIONS[task_name]
+        full_table_name = f"{SCHEMA_WAREHOUSE}.{task_name}"
+
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE TEMP TABLE agg_expected ON COMMIT DROP AS {select_sql}"))
+            column_types = conn.execute(text("""
+                SELECT column_name, data_type FROM information_schema.columns
+                WHERE table_schema = :schema AND table_name = :table
+                ORDER BY ordinal_position
+            """), {'schema': SCHEMA_WAREHOUSE, 'table': task_name}).fetchall()
+            normalized = ', '.join(
+                f"ROUND({c}::numeric, 6) AS {c}" if t in ('double precision', 'numeric', 'real') else c
+                for c, t in column_types
+            )
+            diff = conn.execute(text(f"""
+                SELECT COUNT(*) FROM (
+                    (SELECT {normalized} FROM {full_table_name}
+                     EXCEPT ALL SELECT {normalized} FROM agg_expected)
+                    UNION ALL
+                    (SELECT {normalized} FROM agg_expected
+                     EXCEPT ALL SELECT {normalized} FROM {full_table_name})
+                ) d
+            """)).scalar()
+
+        results[task_name] = diff
+        status = "KHỚP" if diff == 0 else f"KHÁC {diff:,} dòng"
+        print(f"  {task_name:30s}: {status}")
+
+    return results
+
+def create_agg_daily_sales(mode=None):
+    return build_aggregate('agg_daily_sales', mode)
+
+def create_agg_product_performance(mode=None):
+    return build_aggregate('agg_product_performance', mode)
+
+def create_agg_category_performance(mode=None):
+    return build_aggregate('agg_category_performance', mode)
+
+def create_agg_state_performance(mode=None):
+    return build_aggregate('agg_state_performance', mode)
 
 def create_seller_evaluation():
     """
         Đang tạo bảng đầu vào cho seller_evaluation
     """
     sql_query = """
-    DROP TABLE IF EXISTS warehouse.seller_evaluation;
-    CREATE TABLE warehouse.seller_evaluation AS (
         SELECT 
             oi.seller_id,
             oi.order_id,
@@ -148,14 +419,93 @@ def create_seller_evaluation():
         LEFT JOIN staging.reviews_cleaned r ON fo.order_id = r.order_id
 
         WHERE fo.order_status IS NOT NULL
-    );
     """
     return execute_sql_elt('seller_evaluation', sql_query)
 
+# LOGISTICS: khoảng cách Seller -> Customer theo tâm (centroid) của zip prefix (warehouse.zip_centroid)
+# Mỗi dòng là một cặp (đơn hàng, seller): một đơn có thể gồm sản phẩm của nhiều seller
+LOGISTICS_PAIRS_SQL = """
+    SELECT DISTINCT
+        oi.order_id,
+        oi.seller_id,
+        s.seller_zip_code_prefix,
+        c.customer_zip_code_prefix
+    FROM warehouse.fact_order_items oi
+    JOIN warehouse.fact_orders fo ON oi.order_id = fo.order_id
+    JOIN warehouse.dim_customers c ON fo.customer_id = c.customer_id
+    JOIN warehouse.dim_sellers s ON oi.seller_id = s.seller_id
+"""
+
+def _logistics_with_numpy():
+    """Cặp đơn-seller lấy từ DB, tọa độ tra trong ZipCentroidIndex, khoảng cách tính bằng NumPy, ghi bằng COPY"""
+    print("Đang tạo bảng logistics_analytics (NumPy)...")
+    pairs = pd.read_sql(LOGISTICS_PAIRS_SQL, get_db_engine())
+    record_io(rows_in=len(pairs))
+    pairs['distance_km'] = get_zip_index().distance_km(
+        pairs['seller_zip_code_prefix'].to_numpy(), pairs['customer_zip_code_prefix'].to_numpy()
+    )
+
+    # Ghi thẳng vào bảng shadow rồi hoán đổi như các bảng dựng bằng SQL
+    full_table_name = f"{SCHEMA_WAREHOUSE}.logistics_analytics"
+    count = write_with_copy(pairs, shadow_table_name(full_table_name).split('.')[-1],
+                            schema=SCHEMA_WAREHOUSE, swap=False)
+    publish_shadow(full_table_name)
+    print(f"   -> Hoàn tất. Bảng logistics_analytics có {count:,} dòng.")
+    return count
+
+def _logistics_with_sql():
+    """Toàn bộ phép tính (kể cả Haversine) chạy trong Database bằng CREATE TABLE AS (qua bảng shadow)"""
+    sql = f"""
+        WITH pairs AS ({LOGISTICS_PAIRS_SQL})
+        SELECT 
+            p.order_id,
+            p.seller_id,
+            p.seller_zip_code_prefix,
+            p.customer_zip_code_prefix,
+            2 * {EARTH_RADIUS_KM} * asin(sqrt(
+                power(sin(radians(cz.lat - sz.lat) / 2), 2)
+                + cos(radians(sz.lat)) * cos(radians(cz.lat)) * power(sin(radians(cz.lng - sz.lng) / 2), 2)
+            )) as distance_km
+        FROM pairs p
+        LEFT JOIN {ZIP_CENTROID_TABLE} sz ON {zip_prefix_sql('p.seller_zip_code_prefix')} = sz.zip_prefix
+        LEFT JOIN {ZIP_CENTROID_TABLE} cz ON {zip_prefix_sql('p.customer_zip_code_prefix')} = cz.zip_prefix
+    """
+    return execute_sql_elt('logistics_analytics', sql)
+
+def create_logistics_analytics(method=None):
+    """
+    Bảng khoảng cách giao hàng cho từng cặp (order_id, seller_id).
+    Cặp có zip không tìm thấy trong geolocation có distance_km = NULL.
+    :param method: 'numpy' hoặc 'sql' (mặc định LOGISTICS_CONFIG)
+    """
+    method = method or config.LOGISTICS_CONFIG['distance_method']
+    if method == 'numpy':
+        return _logistics_with_numpy()
+    if method == 'sql':
+        return _logistics_with_sql()
+    raise ValueError(f"Phương pháp không hợp lệ: {method}. Chọn 'numpy' hoặc 'sql'")
+
+def benchmark_logistics_methods():
+    """Chạy cả hai phương pháp, so sánh thời gian và độ lệch khoảng cách giữa hai kết quả"""
+    print("SO SÁNH PHƯƠNG PHÁP TÍNH LOGISTICS_ANALYTICS")
+    engine = get_db_engine()
+    timings, results = {}, {}
+    for method in ('numpy', 'sql'):
+        start = time.perf_counter()
+        create_logistics_analytics(method)
+        timings[method] = time.perf_counter() - start
+        results[method] = pd.read_sql(
+            "SELECT order_id, seller_id, distance_km FROM warehouse.logistics_analytics", engine
+        ).set_index(['order_id', 'seller_id'])['distance_km'].sort_index()
+
+    max_diff = (results['numpy'] - results['sql']).abs().max()
+    for method, seconds in timings.items():
+        print(f"  {method:6s}: {seconds:7.2f}s ({len(results[method]) / seconds if seconds > 0 else 0:,.0f} dòng/s)")
+    print(f"  Độ lệch khoảng cách lớn nhất: {max_diff:.2e} km")
+    return {'seconds': timings, 'max_abs_diff_km': max_diff}
+
 def create_seller_segmentation():
     sql = """
-    DROP TABLE IF EXISTS warehouse.seller_segmentation;
-    CREATE TABLE warehouse.seller_segmentation AS (
         WITH order_metrics AS (
             -- Bước 1: Tổng hợp số liệu theo từng Đơn hàng (Order Level) trước
             SELECT 
@@ -168,7 +518,8 @@ def create_seller_segmentation():
             FROM warehouse.fact_order_items oi
             JOIN warehouse.fact_orders fo ON oi.order_id = fo.order_id
             JOIN warehouse.dim_customers c ON fo.customer_id = c.customer_id
-            LEFT JOIN warehouse.logistics_analytics la ON oi.order_id = la.order_id
+            LEFT JOIN warehouse.logistics_analytics la 
+                ON oi.order_id = la.order_id AND oi.seller_id = la.seller_id
             WHERE fo.order_status = 'delivered'
             GROUP BY oi.seller_id, oi.order_id
         ),
@@ -197,47 +548,142 @@ def create_seller_segmentation():
         FROM order_metrics om
         LEFT JOIN item_metrics im ON om.seller_id = im.seller_id
         GROUP BY om.seller_id
-    );
     """
     return execute_sql_elt('seller_segmentation', sql)
 
 def create_nlp_bad_review():
     sql = """
-    DROP TABLE IF EXISTS warehouse.nlp_bad_review;
-    CREATE TABLE warehouse.nlp_bad_review AS (
-        SELECT review_score, review_comment_message
+        SELECT review_id, review_score, review_comment_message
         FROM staging.reviews_cleaned
         WHERE review_score IN (1,2) AND review_comment_message IS NOT NULL
-    );
     """
     return execute_sql_elt('nlp_bad_review', sql)
 
 def create_nlp_good_review():
     sql = """
-    DROP TABLE IF EXISTS warehouse.nlp_good_review;
-    CREATE TABLE warehouse.nlp_good_review AS (
-        SELECT review_score, review_comment_message
+        SELECT review_id, review_score, review_comment_message
         FROM staging.reviews_cleaned
         WHERE review_score IN (4,5) AND review_comment_message IS NOT NULL
-    );
     """
     return execute_sql_elt('nlp_good_review', sql)
 
+# DAG CÁC BƯỚC TỔNG HỢP
+# Các bảng agg_* (build_aggregate) đọc nhật ký thay đổi và dấu full_rebuild của cả hai bảng Fact
+# (AGG_SOURCE_FACTS): phải chờ cả hai upsert commit xong, nếu không watermark MAX(changed_at) có thể
+# vượt qua các dòng nhật ký của fact_order_items commit muộn hơn và bỏ sót chúng vĩnh viễn
+AGGREGATION_STEPS = [
+    Step('agg_daily_sales', create_agg_daily_sales,
+         inputs=AGG_SOURCE_FACTS + ['warehouse.dim_customers'],
+         outputs=['warehouse.agg_daily_sales']),
+    Step('agg_product_performance', create_agg_product_performance,
+         inputs=AGG_SOURCE_FACTS + ['staging.order_items_cleaned'],
+         outputs=['warehouse.agg_product_performance']),
+    Step('agg_category_performance', create_agg_category_performance,
+         inputs=AGG_SOURCE_FACTS + ['staging.order_items_cleaned', 'warehouse.dim_products'],
+         outputs=['warehouse.agg_category_performance']),
+    Step('agg_state_performance', create_agg_state_performance,
+         inputs=AGG_SOURCE_FACTS + ['warehouse.dim_customers'],
+         outputs=['warehouse.agg_state_performance']),
+    Step('seller_evaluation', create_seller_evaluation,
+         inputs=['warehouse.fact_order_items', 'warehouse.fact_orders', 'staging.reviews_cleaned'],
+         outputs=['warehouse.seller_evaluation']),
+    Step('seller_features', refresh_seller_features,
+         inputs=['warehouse.fact_order_items', 'warehouse.fact_orders', 'staging.reviews_cleaned'],
+         outputs=['warehouse.seller_features']),
+    Step('zip_centroid', create_zip_centroid,
+         inputs=['staging.geolocation'], outputs=['warehouse.zip_centroid']),
+    Step('logistics_analytics', create_logistics_analytics,
+         inputs=['warehouse.fact_order_items', 'warehouse.fact_orders', 'warehouse.dim_customers',
+                 'warehouse.dim_sellers', 'warehouse.zip_centroid'],
+         outputs=['warehouse.logistics_analytics']),
+    Step('seller_segmentation', create_seller_segmentation,
+         inputs=['warehouse.fact_order_items', 'warehouse.fact_orders', 'warehouse.dim_customers',
+                 'warehouse.dim_products', 'warehouse.logistics_analytics'],
+         outputs=['warehouse.seller_segmentation']),
+    Step('nlp_bad_review', create_nlp_bad_review,
+         inputs=['staging.reviews_cleaned'], outputs=['warehouse.nlp_bad_review']),
+    Step('nlp_good_review', create_nlp_good_review,
+         inputs=['staging.reviews_cleaned'], outputs=['warehouse.nlp_good_review']),
+    Step('nlp_review_tokens', build_review_tokens,
+         inputs=['warehouse.nlp_bad_review', 'warehouse.nlp_good_review'],
+         outputs=['warehouse.nlp_review_tokens']),
+    Step('review_topics', run_topic_modeling,
+         inputs=['warehouse.nlp_review_tokens'], outputs=['warehouse.review_topics']),
+]
+
 # MAIN 
-def run_aggregation():
+def run_aggregation(parallel=True, max_workers=None):
     print("\nTỔNG HỢP DỮ LIỆU")
-    
-    create_agg_daily_sales()
-    create_agg_product_performance()
-    create_agg_category_performance()
-    create_agg_state_performance()
-    create_seller_evaluation()
-    create_seller_segmentation()
-    create_nlp_bad_review()
-    create_nlp_good_review()
 
+    with pipeline_run('aggregation'):
+        create_warehouse_schema()
+
+        results = run_dag(AGGREGATION_STEPS, max_workers=max_workers, parallel=parallel)
+        stats = results_to_stats(results)
+        print_pool_metrics()
+
+    raise_for_failures(results)
     print("\nHoàn tất quy trình tổng hợp.")
+    return stats
+
+def run_warehouse_build(parallel=True, max_workers=None, sync_to_cloud=True):
+    """
+    Dựng Warehouse và các bảng tổng hợp trong cùng một DAG:
+    các bảng agg_* bắt đầu ngay khi fact/dim mà chúng cần đã xong, không chờ toàn bộ giai đoạn biến đổi.
+    """
+    print("\nDỰNG WAREHOUSE & TỔNG HỢP (DAG)")
+    with pipeline_run('warehouse_build'):
+        create_warehouse_schema()
+
+        results = run_dag(TRANSFORMATION_STEPS + AGGREGATION_STEPS, max_workers=max_workers, parallel=parallel)
+        stats = results_to_stats(results)
+        print_pool_metrics()
+
+        if sync_to_cloud and has_failures(results):
+            print("\n Có bước lỗi/bị bỏ qua -> không đồng bộ Warehouse lên cloud.")
+        elif sync_to_cloud:
+            sync_warehouse_to_cloud(get_db_engine())
+
+    raise_for_failures(results)
+    return stats
+
+
+# Các bước xử lý văn bản review chạy bằng Python và cache tăng dần, không phụ thuộc bố cục bảng Fact
+LAYOUT_BENCHMARK_EXCLUDE = ('nlp_review_tokens', 'review_topics')
+
+def benchmark_warehouse_layout(modes=('plain', 'optimized'), max_workers=None):
+    """
+    So sánh thời gian giai đoạn tổng hợp giữa bố cục Warehouse cũ (bảng heap) và bố cục mới
+    (khóa, index, phân vùng theo tháng, ANALYZE): với mỗi bố cục dựng lại toàn bộ fact/dim
+    rồi chạy các bước tổng hợp (dựng lại toàn bộ), in thời gian từng bước và tổng.
+    """
+    print("SO SÁNH BỐ CỤC WAREHOUSE (GIAI ĐOẠN TỔNG HỢP)")
+    steps = [s for s in AGGREGATION_STEPS if s.name not in LAYOUT_BENCHMARK_EXCLUDE]
+    original_mode, original_refresh = config.WAREHOUSE_LAYOUT_CONFIG['mode'], config.REFRESH_MODE
+    config.REFRESH_MODE = 'full'
+    create_warehouse_schema()
+
+    timings = {}
+    try:
+        for mode in modes:
+            config.WAREHOUSE_LAYOUT_CONFIG['mode'] = mode
+            print(f"\n  [{mode}] Dựng lại fact/dim...")
+            run_dag(TRANSFORMATION_STEPS, max_workers=max_workers)
+            print(f"  [{mode}] Chạy giai đoạn tổng hợp...")
+            start = time.perf_counter()
+            results = run_dag(steps, max_workers=max_workers)
+            timings[mode] = {'total': time.perf_counter() - start,
+                             **{name: r['seconds'] for name, r in results.items()}}
+    finally:
+        config.WAREHOUSE_LAYOUT_CONFIG['mode'], config.REFRESH_MODE = original_mode, original_refresh
+
+    report = pd.DataFrame(timings)
+    print("\n  Thời gian (giây):")
+    print(report.round(2).to_string())
+    if len(modes) == 2:
+        before, after = report.loc['total', modes[0]], report.loc['total', modes[1]]
+        print(f"  Tăng tốc giai đoạn tổng hợp: {before / after if after > 0 else 1:.2f}x")
+    return report
 
-    
 if __name__ == "__main__":
     run_aggregation()
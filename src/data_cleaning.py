@@ -3,58 +3,89 @@ Làm sạch dữ liệu (Staging Layer)
 - Tích hợp logic xử lý kiểu dữ liệu (từ data_executed cũ)
 - Loại bỏ dòng trùng lặp (Deduplication)
 - Xử lý giá trị thiếu và quy tắc nghiệp vụ
+- Hai chế độ thực thi (CLEANING_MODE):
+    + 'pandas': đọc bảng raw vào Python, làm sạch bằng pandas rồi ghi lại.
+    + 'sql': diễn đạt cùng quy tắc bằng CREATE TABLE AS SELECT, dữ liệu không rời Database.
 """
 
 import pandas as pd
-from config import get_db_engine, TABLES, BUSINESS_RULES, SCHEMA_STAGING
+from sqlalchemy import text
+from config import get_db_engine, print_pool_metrics, TABLES, BUSINESS_RULES, SCHEMA_STAGING, CLEANING_MODE
+from bulk_writer import write_dataframe, SHADOW_SUFFIX
+from instrumentation import pipeline_run, run_tracked, record_io
 
 # CÁC HÀM HỖ TRỢ
-def save_to_staging(df, table_name):
-    """Lưu DataFrame vào Schema Staging với cấu hình tối ưu"""
+def save_to_staging(df, table_name, backend=None):
+    """
+    Lưu DataFrame vào Schema Staging với cấu hình tối ưu
+    :param backend: 'copy' (mặc định) hoặc 'to_sql' - xem STAGING_WRITER_CONFIG
+    """
     if df.empty:
         print(f"   Cảnh báo: Bảng {table_name} rỗng sau khi làm sạch!")
         return 0
-        
-    engine = get_db_engine()
+
     print(f"  -> Đang lưu {len(df):,} dòng vào staging.{table_name}...", end=' ')
-    
-    # Dùng method='multi' để tăng tốc insert
-    df.to_sql(table_name, engine, schema=SCHEMA_STAGING, 
-              if_exists='replace', index=False, 
-              method='multi', chunksize=2000)
+
+    # COPY FROM STDIN + hoán đổi bảng trong một transaction
+    write_dataframe(df, table_name, schema=SCHEMA_STAGING, backend=backend)
     print("Xong!")
     return len(df)
 
+def execute_staging_sql(table_name, select_sql, params=None):
+    """
+    Tạo bảng Staging ngay trong Database bằng CREATE TABLE AS SELECT.
+    Bảng được tạo dưới tên shadow rồi hoán đổi trong cùng một transaction.
+    """
+    print(f"  -> Đang tạo staging.{table_name} bằng SQL...", end=' ')
+    engine = get_db_engine()
+    shadow_name = f"{table_name}{SHADOW_SUFFIX}"
+
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {SCHEMA_STAGING}.{shadow_name}"))
+        result = conn.execute(
+            text(f"CREATE TABLE {SCHEMA_STAGING}.{shadow_name} AS {select_sql}"),
+            params or {}
+        )
+        count = result.rowcount
+        record_io(rows_out=count)
+        conn.execute(text(f"DROP TABLE IF EXISTS {SCHEMA_STAGING}.{table_name}"))
+        conn.execute(text(f"ALTER TABLE {SCHEMA_STAGING}.{shadow_name} RENAME TO {table_name}"))
+
+    print(f"Xong! ({count:,} dòng)")
+    return count
+
+def read_raw_table(raw_table_key):
+    """Đọc toàn bộ một bảng Raw vào DataFrame"""
+    engine = get_db_engine()
+    query = f"SELECT * FROM {TABLES['raw'][raw_table_key]}"
+    df = pd.read_sql(query, engine)
+    record_io(rows_in=len(df))
+    return df
+
 def copy_raw_to_staging(raw_table_key, staging_table_name):
     """Sao chép bảng đơn giản từ Raw -> Staging (Customers, Sellers, etc.)"""
     print(f"Sao chép {raw_table_key} -> staging.{staging_table_name}...")
-    engine = get_db_engine()
-    
+
     # Đọc từ Raw
-    query = f"SELECT * FROM {TABLES['raw'][raw_table_key]}"
-    df = pd.read_sql(query, engine)
-    
+    df = read_raw_table(raw_table_key)
+
     # Lưu sang Staging
     return save_to_staging(df, staging_table_name)
 
-# CÁC HÀM XỬ LÝ CHÍNH
-def clean_reviews():
-    """
-    Xử lý bảng Reviews:
-    1. Ép kiểu datetime & numeric.
-    2. DEDUPLICATION: Loại bỏ review_id trùng (giữ bản ghi mới nhất).
-    3. Xử lý NULL.
-    """
-    print("Đang làm sạch bảng reviews...")
-    engine = get_db_engine()
-    
-    # Đọc Raw Data
-    query = f"SELECT * FROM {TABLES['raw']['reviews']}"
-    df = pd.read_sql(query, engine)
-    print(f"  Số dòng ban đầu: {len(df):,}")
+def copy_raw_to_staging_sql(raw_table_key, staging_table_name):
+    """Sao chép bảng đơn giản từ Raw -> Staging ngay trong Database"""
+    print(f"Sao chép {raw_table_key} -> staging.{staging_table_name} (SQL)...")
+    return execute_staging_sql(staging_table_name, f"SELECT * FROM {TABLES['raw'][raw_table_key]}")
+
+# QUY TẮC LÀM SẠCH (PANDAS)
+# Products: cột mô tả -> fill 0, cột kích thước -> fill Median
+PRODUCT_TEXT_NUMERIC_COLS = ['product_name_lenght', 'product_description_lenght', 'product_photos_qty']
+PRODUCT_DIM_COLS = ['product_weight_g', 'product_length_cm', 'product_height_cm', 'product_width_cm']
 
+def transform_reviews(df):
+    """Áp dụng quy tắc làm sạch Reviews lên DataFrame"""
     # Ép kiểu dữ liệu
-    df['review_score'] = pd.to_numeric(df['review_score'], errors='coerce') 
+    df['review_score'] = pd.to_numeric(df['review_score'], errors='coerce')
     df['review_creation_date'] = pd.to_datetime(df['review_creation_date'], errors='coerce')
     df['review_answer_timestamp'] = pd.to_datetime(df['review_answer_timestamp'], errors='coerce')
 
@@ -67,35 +98,21 @@ def clean_reviews():
     # Giữ lại dòng cuối cùng (mới nhất) cho mỗi review_id
     initial_count = len(df)
     df = df.drop_duplicates(subset=['review_id'], keep='last')
-    
+
     if len(df) < initial_count:
         print(f"  -> Đã loại bỏ {initial_count - len(df):,} review trùng lặp.")
 
     # Điền giá trị thiếu cho text
     df['review_comment_title'] = df['review_comment_title'].fillna('')
     df['review_comment_message'] = df['review_comment_message'].fillna('')
+    return df
 
-    return save_to_staging(df, 'reviews_cleaned')
-
-
-def clean_orders():
-    """
-    Xử lý bảng Orders:
-    1. Ép kiểu 5 cột datetime.
-    2. Lọc trạng thái đơn hàng.
-    3. Kiểm tra logic thời gian (Ngày giao > Ngày mua...).
-    """
-    print("Đang làm sạch bảng orders...")
-    engine = get_db_engine()
-    
-    query = f"SELECT * FROM {TABLES['raw']['orders']}"
-    df = pd.read_sql(query, engine)
-    print(f"  Số dòng ban đầu: {len(df):,}")
-
+def transform_orders(df):
+    """Áp dụng quy tắc làm sạch Orders lên DataFrame"""
     # Ép kiểu datetime
     date_cols = [
-        'order_purchase_timestamp', 'order_approved_at', 
-        'order_delivered_carrier_date', 'order_delivered_customer_date', 
+        'order_purchase_timestamp', 'order_approved_at',
+        'order_delivered_carrier_date', 'order_delivered_customer_date',
         'order_estimated_delivery_date'
     ]
     for col in date_cols:
@@ -104,120 +121,292 @@ def clean_orders():
     # Lọc trạng thái
     valid_statuses = BUSINESS_RULES['valid_order_statuses']
     df = df[df['order_status'].isin(valid_statuses)]
-    
+
     # Loại bỏ đơn 'delivered' nhưng thiếu ngày giao
     invalid_delivered = (
-        (df['order_status'] == 'delivered') & 
+        (df['order_status'] == 'delivered') &
         (df['order_delivered_customer_date'].isna())
     )
     df = df[~invalid_delivered]
-    
+
     # Logic thời gian: Ngày mua > Ngày giao
     invalid_dates = (
-        (df['order_delivered_customer_date'].notna()) & 
+        (df['order_delivered_customer_date'].notna()) &
         (df['order_purchase_timestamp'] > df['order_delivered_customer_date'])
     )
     df = df[~invalid_dates]
-    
+
     # Logic thời gian: Ngày dự kiến < Ngày mua
     invalid_estimate = (
-        (df['order_estimated_delivery_date'].notna()) & 
+        (df['order_estimated_delivery_date'].notna()) &
         (df['order_estimated_delivery_date'] < df['order_purchase_timestamp'])
     )
-    df = df[~invalid_estimate]
-    
-    return save_to_staging(df, 'orders_cleaned')
+    return df[~invalid_estimate]
 
-
-def clean_order_items():
-    """
-    Xử lý bảng Order Items:
-    1. Ép kiểu shipping_limit_date.
-    2. Sao chép sang Staging.
-    """
-    print("Đang làm sạch bảng order_items...")
-    engine = get_db_engine()
-    
-    query = f"SELECT * FROM {TABLES['raw']['order_items']}"
-    df = pd.read_sql(query, engine)
-    
+def transform_order_items(df):
+    """Áp dụng quy tắc làm sạch Order Items lên DataFrame"""
     df['shipping_limit_date'] = pd.to_datetime(df['shipping_limit_date'], errors='coerce')
-    
+
     # Đảm bảo numeric
     df['price'] = pd.to_numeric(df['price'], errors='coerce').fillna(0)
     df['freight_value'] = pd.to_numeric(df['freight_value'], errors='coerce').fillna(0)
-    
-    return save_to_staging(df, 'order_items_cleaned')
-
-
-def clean_products():
-    """
-    Xử lý bảng Products:
-    1. Ép kiểu số cho kích thước/trọng lượng.
-    2. Điền giá trị thiếu (Median).
-    3. Fix giá trị <= 0.
-    """
-    print("Đang làm sạch bảng products...")
-    engine = get_db_engine()
-
-    query = f"SELECT * FROM {TABLES['raw']['products']}"
-    df = pd.read_sql(query, engine)
+    return df
 
+def transform_products(df):
+    """Áp dụng quy tắc làm sạch Products lên DataFrame"""
     # Xử lý tên danh mục
     if 'product_category_name' in df.columns:
         df['product_category_name'] = df['product_category_name'].fillna('unknown').astype(str)
 
     # Chuẩn hóa các cột số (Logic kết hợp)
     # Các cột text description -> fill 0
-    text_numeric_cols = ['product_name_lenght', 'product_description_lenght', 'product_photos_qty']
-    for col in text_numeric_cols:
+    for col in PRODUCT_TEXT_NUMERIC_COLS:
         if col in df.columns:
             df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
 
     # Các cột kích thước -> fill Median
-    dim_cols = ['product_weight_g', 'product_length_cm', 'product_height_cm', 'product_width_cm']
-    for col in dim_cols:
+    for col in PRODUCT_DIM_COLS:
         if col in df.columns:
             df[col] = pd.to_numeric(df[col], errors='coerce')
-            
+
             # Tính median (bỏ qua NaN)
             median_val = df[col].median() if df[col].notna().any() else 0.0
-            
+
             # Fill NaN
             df[col] = df[col].fillna(median_val)
-            
+
             # Fix giá trị <= 0
             df.loc[df[col] <= 0, col] = median_val
+    return df
+
+# QUY TẮC LÀM SẠCH (SQL - CÙNG NGỮ NGHĨA VỚI BẢN PANDAS)
+def reviews_select_sql():
+    """
+    Reviews: giữ bản ghi mới nhất cho mỗi review_id bằng DISTINCT ON.
+    Pandas sắp xếp tăng dần (NaT cuối) rồi lấy dòng cuối -> SQL sắp giảm dần với NULLS FIRST rồi lấy dòng đầu.
+    """
+    sql = f"""
+    SELECT DISTINCT ON (review_id)
+        review_id,
+        order_id,
+        review_score,
+        COALESCE(review_comment_title, '') AS review_comment_title,
+        COALESCE(review_comment_message, '') AS review_comment_message,
+        review_creation_date::TIMESTAMP AS review_creation_date,
+        review_answer_timestamp::TIMESTAMP AS review_answer_timestamp
+    FROM {TABLES['raw']['reviews']}
+    ORDER BY review_id,
+             review_answer_timestamp DESC NULLS FIRST,
+             review_creation_date DESC NULLS FIRST
+    """
+    return sql, {}
+
+def orders_select_sql():
+    """Orders: lọc trạng thái theo BUSINESS_RULES và loại bỏ các đơn sai logic thời gian"""
+    sql = f"""
+    SELECT
+        order_id,
+        customer_id,
+        order_status,
+        order_purchase_timestamp::TIMESTAMP AS order_purchase_timestamp,
+        order_approved_at::TIMESTAMP AS order_approved_at,
+        order_delivered_carrier_date::TIMESTAMP AS order_delivered_carrier_date,
+        order_delivered_customer_date::TIMESTAMP AS order_delivered_customer_date,
+        order_estimated_delivery_date::TIMESTAMP AS order_estimated_delivery_date
+    FROM {TABLES['raw']['orders']}
+    WHERE order_status = ANY(:valid_statuses)
+      -- Loại bỏ đơn 'delivered' nhưng thiếu ngày giao
+      AND NOT (order_status = 'delivered' AND order_delivered_customer_date IS NULL)
+      -- Ngày mua > Ngày giao
+      AND NOT COALESCE(order_delivered_customer_date IS NOT NULL
+                       AND order_purchase_timestamp > order_delivered_customer_date, FALSE)
+      -- Ngày dự kiến < Ngày mua
+      AND NOT COALESCE(order_estimated_delivery_date IS NOT NULL
+                       AND order_estimated_delivery_date < order_purchase_timestamp, FALSE)
+    """
+    return sql, {'valid_statuses': list(BUSINESS_RULES['valid_order_statuses'])}
+
+def order_items_select_sql():
+    """Order Items: ép kiểu ngày và thay giá trị thiếu của price/freight bằng 0"""
+    sql = f"""
+    SELECT
+        order_id,
+        order_item_id,
+        product_id,
+        seller_id,
+        shipping_limit_date::TIMESTAMP AS shipping_limit_date,
+        COALESCE(price, 0)::DOUBLE PRECISION AS price,
+        COALESCE(freight_value, 0)::DOUBLE PRECISION AS freight_value
+    FROM {TABLES['raw']['order_items']}
+    """
+    return sql, {}
+
+def products_select_sql():
+    """Products: điền 'unknown'/0 cho cột mô tả, median (percentile_cont) cho cột kích thước"""
+    medians = ',\n        '.join(
+        f"COALESCE(percentile_cont(0.5) WITHIN GROUP (ORDER BY {col}), 0) AS {col}"
+        for col in PRODUCT_DIM_COLS
+    )
+    text_cols = ',\n        '.join(
+        f"COALESCE(p.{col}, 0)::DOUBLE PRECISION AS {col}" for col in PRODUCT_TEXT_NUMERIC_COLS
+    )
+    dim_cols = ',\n        '.join(
+        f"(CASE WHEN p.{col} IS NULL OR p.{col} <= 0 THEN m.{col} ELSE p.{col} END)::DOUBLE PRECISION AS {col}"
+        for col in PRODUCT_DIM_COLS
+    )
+    sql = f"""
+    WITH medians AS (
+        SELECT
+        {medians}
+        FROM {TABLES['raw']['products']}
+    )
+    SELECT
+        p.product_id,
+        COALESCE(p.product_category_name, 'unknown') AS product_category_name,
+        {text_cols},
+        {dim_cols}
+    FROM {TABLES['raw']['products']} p
+    CROSS JOIN medians m
+    """
+    return sql, {}
+
+# CÁC HÀM XỬ LÝ CHÍNH
+def clean_reviews(mode=None):
+    """
+    Xử lý bảng Reviews:
+    1. Ép kiểu datetime & numeric.
+    2. DEDUPLICATION: Loại bỏ review_id trùng (giữ bản ghi mới nhất).
+    3. Xử lý NULL.
+    """
+    print("Đang làm sạch bảng reviews...")
+    if (mode or CLEANING_MODE) == 'sql':
+        return execute_staging_sql('reviews_cleaned', *reviews_select_sql())
+
+    # Đọc Raw Data
+    df = read_raw_table('reviews')
+    print(f"  Số dòng ban đầu: {len(df):,}")
+
+    return save_to_staging(transform_reviews(df), 'reviews_cleaned')
+
+
+def clean_orders(mode=None):
+    """
+    Xử lý bảng Orders:
+    1. Ép kiểu 5 cột datetime.
+    2. Lọc trạng thái đơn hàng.
+    3. Kiểm tra logic thời gian (Ngày giao > Ngày mua...).
+    """
+    print("Đang làm sạch bảng orders...")
+    if (mode or CLEANING_MODE) == 'sql':
+        return execute_staging_sql('orders_cleaned', *orders_select_sql())
 
-    return save_to_staging(df, 'products_cleaned')
+    df = read_raw_table('orders')
+    print(f"  Số dòng ban đầu: {len(df):,}")
+
+    return save_to_staging(transform_orders(df), 'orders_cleaned')
+
+
+def clean_order_items(mode=None):
+    """
+    Xử lý bảng Order Items:
+    1. Ép kiểu shipping_limit_date.
+    2. Sao chép sang Staging.
+    """
+    print("Đang làm sạch bảng order_items...")
+    if (mode or CLEANING_MODE) == 'sql':
+        return execute_staging_sql('order_items_cleaned', *order_items_select_sql())
 
+    df = read_raw_table('order_items')
+    return save_to_staging(transform_order_items(df), 'order_items_cleaned')
+
+
+def clean_products(mode=None):
+    """
+    Xử lý bảng Products:
+    1. Ép kiểu số cho kích thước/trọng lượng.
+    2. Điền giá trị thiếu (Median).
+    3. Fix giá trị <= 0.
+    """
+    print("Đang làm sạch bảng products...")
+    if (mode or CLEANING_MODE) == 'sql':
+        return execute_staging_sql('products_cleaned', *products_select_sql())
 
-def run_cleaning():
-    """Chạy toàn bộ quá trình làm sạch và đẩy vào Staging"""
-    print("LÀM SẠCH & CHUẨN HÓA DỮ LIỆU (RAW -> STAGING)")
+    df = read_raw_table('products')
+    return save_to_staging(transform_products(df), 'products_cleaned')
+
+# KIỂM TRA TƯƠNG ĐƯƠNG PANDAS <-> SQL
+PARITY_CHECKS = {
+    'orders': (transform_orders, orders_select_sql, ['order_id']),
+    'reviews': (transform_reviews, reviews_select_sql, ['review_id']),
+    'order_items': (transform_order_items, order_items_select_sql, ['order_id', 'order_item_id']),
+    'products': (transform_products, products_select_sql, ['product_id']),
+}
+
+def verify_sql_parity(tables=None):
+    """
+    So sánh kết quả của chế độ pandas và chế độ SQL trên cùng dữ liệu raw.
+    Không ghi gì vào Staging. Trả về dict {bảng: True/False}.
+    """
+    print("KIỂM TRA TƯƠNG ĐƯƠNG GIỮA CHẾ ĐỘ PANDAS VÀ SQL")
+    engine = get_db_engine()
+    results = {}
+
+    for table in tables or PARITY_CHECKS.keys():
+        transform, select_sql, keys = PARITY_CHECKS[table]
+
+        df_pandas = transform(read_raw_table(table))
+        sql, params = select_sql()
+        with engine.connect() as conn:
+            df_sql = pd.read_sql(text(sql), conn, params=params)
+
+        df_pandas = df_pandas.sort_values(keys).reset_index(drop=True)
+        df_sql = df_sql[df_pandas.columns].sort_values(keys).reset_index(drop=True)
+
+        try:
+            pd.testing.assert_frame_equal(df_pandas, df_sql, check_dtype=False)
+            results[table] = True
+            print(f"  {table:15s}: KHỚP ({len(df_sql):,} dòng)")
+        except AssertionError as e:
+            results[table] = False
+            print(f"  {table:15s}: KHÁC BIỆT -> {e}")
+
+    return results
+
+
+def run_cleaning(mode=None):
+    """
+    Chạy toàn bộ quá trình làm sạch và đẩy vào Staging
+    :param mode: 'pandas' hoặc 'sql' (mặc định lấy từ CLEANING_MODE)
+    """
+    mode = mode or CLEANING_MODE
+    print(f"LÀM SẠCH & CHUẨN HÓA DỮ LIỆU (RAW -> STAGING) - chế độ {mode}")
 
     stats = {}
-    
-    # Nhóm Copy trực tiếp (Các bảng 'tĩnh' hoặc ít lỗi)
-    # Đảm bảo key khớp với config TABLES['raw']
-    stats['customers'] = copy_raw_to_staging('customers', 'customers_cleaned')
-    stats['sellers'] = copy_raw_to_staging('sellers', 'sellers_cleaned')
-    stats['geolocation'] = copy_raw_to_staging('geolocation', 'geolocation') 
-    stats['payments'] = copy_raw_to_staging('payments', 'payments_cleaned')
-    stats['translation'] = copy_raw_to_staging('product_category_name_translation', 'product_category_name_translation')
-    
-    # Nhóm Xử lý Logic Phức tạp 
-    stats['order_items'] = clean_order_items() 
-    stats['orders'] = clean_orders()
-    stats['products'] = clean_products()
-    stats['reviews'] = clean_reviews()
-    
+    copy_fn = copy_raw_to_staging_sql if mode == 'sql' else copy_raw_to_staging
+
+    with pipeline_run('cleaning'):
+        # Nhóm Copy trực tiếp (Các bảng 'tĩnh' hoặc ít lỗi)
+        # Đảm bảo key khớp với config TABLES['raw']
+        stats['customers'] = run_tracked('customers', copy_fn, 'customers', 'customers_cleaned')
+        stats['sellers'] = run_tracked('sellers', copy_fn, 'sellers', 'sellers_cleaned')
+        stats['geolocation'] = run_tracked('geolocation', copy_fn, 'geolocation', 'geolocation')
+        stats['payments'] = run_tracked('payments', copy_fn, 'payments', 'payments_cleaned')
+        stats['translation'] = run_tracked('translation', copy_fn, 'product_category_name_translation',
+                                           'product_category_name_translation')
+
+        # Nhóm Xử lý Logic Phức tạp
+        stats['order_items'] = run_tracked('order_items', clean_order_items, mode)
+        stats['orders'] = run_tracked('orders', clean_orders, mode)
+        stats['products'] = run_tracked('products', clean_products, mode)
+        stats['reviews'] = run_tracked('reviews', clean_reviews, mode)
+
     print("\nTỔNG KẾT GIAI ĐOẠN STAGING:")
 
     for table, count in stats.items():
         print(f"  {table:20s}: {count:,} dòng")
+    print_pool_metrics()
     print("\nQuá trình chuẩn bị dữ liệu Staging hoàn tất!\n")
-    
+
     return stats
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+"""
+Nạp dữ liệu thô (CSV -> raw_data)
+- Stream từng file CSV vào bảng raw_data.* bằng COPY FROM STDIN (psycopg2).
+- Đọc file theo từng khối byte cố định -> bộ nhớ không phụ thuộc kích thước file.
+- Các bảng raw độc lập với nhau nên có thể nạp song song (mỗi luồng một kết nối).
+- Chiến lược Full Load: TRUNCATE rồi COPY trong cùng một transaction.
+"""
+
+import csv
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from config import get_raw_connection, TABLES, RAW_DATA_DIR, RAW_CSV_FILES, INGESTION_CONFIG
+from instrumentation import pipeline_run, run_tracked, record_io
+
+# CÁC HÀM HỖ TRỢ
+def read_csv_header(csv_path):
+    """Đọc dòng tiêu đề của file CSV để lấy danh sách cột cho lệnh COPY"""
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        return next(csv.reader(f))
+
+def load_csv_to_raw(table_key, csv_path, buffer_size=None):
+    """
+    Stream một file CSV vào bảng raw tương ứng.
+    Trả về dict thống kê: số dòng, thời gian, tốc độ (dòng/giây).
+    """
+    buffer_size = buffer_size or INGESTION_CONFIG['copy_buffer_size']
+    table_name = TABLES['raw'][table_key]
+    columns = ', '.join(read_csv_header(csv_path))
+
+    copy_sql = (
+        f"COPY {table_name} ({columns}) FROM STDIN "
+        f"WITH (FORMAT csv, HEADER true, ENCODING 'UTF8')"
+    )
+
+    start = time.perf_counter()
+    conn = get_raw_connection()
+    try:
+        with conn.cursor() as cur:
+            # TRUNCATE + COPY chung một transaction: lỗi giữa chừng sẽ rollback về dữ liệu cũ
+            cur.execute(f"TRUNCATE TABLE {table_name} RESTART IDENTITY")
+            with open(csv_path, 'rb') as f:
+                cur.copy_expert(copy_sql, f, size=buffer_size)
+            rows = cur.rowcount
+        conn.commit()
+        # Số dòng từ command status của COPY, byte = kích thước file CSV đã đọc
+        record_io(rows_out=rows, bytes_in=os.path.getsize(csv_path),
+                  db_seconds=time.perf_counter() - start, statements=2)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    elapsed = time.perf_counter() - start
+    return {
+        'rows': rows,
+        'seconds': elapsed,
+        'rows_per_sec': rows / elapsed if elapsed > 0 else 0.0
+    }
+
+def _ingest_one(table_key, data_dir, buffer_size):
+    """Nạp một bảng và in kết quả (dùng chung cho chế độ tuần tự và song song)"""
+    csv_path = os.path.join(data_dir, RAW_CSV_FILES[table_key])
+    result = run_tracked(table_key, load_csv_to_raw, table_key, csv_path, buffer_size)
+    print(f"  -> {table_key:35s}: {result['rows']:>10,} dòng | "
+          f"{result['seconds']:6.2f}s | {result['rows_per_sec']:>12,.0f} dòng/s")
+    return result
+
+# HÀM CHẠY CHÍNH
+def run_ingestion(data_dir=None, tables=None, parallel=True, max_workers=None, buffer_size=None):
+    """
+    Nạp toàn bộ (hoặc một phần) các file CSV vào schema raw_data.
+    :param data_dir: Thư mục chứa 9 file CSV của Olist
+    :param tables: Danh sách key bảng cần nạp (mặc định: tất cả)
+    :param parallel: Nạp song song các bảng độc lập
+    :param max_workers: Số luồng tối đa khi chạy song song
+    """
+    print("NẠP DỮ LIỆU THÔ (CSV -> RAW_DATA) BẰNG COPY")
+
+    data_dir = data_dir or RAW_DATA_DIR
+    tables = tables or list(RAW_CSV_FILES.keys())
+    max_workers = max_workers or INGESTION_CONFIG['max_workers']
+
+    stats, errors = {}, {}
+    start = time.perf_counter()
+
+    with pipeline_run('ingestion'):
+        if parallel and len(tables) > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(_ingest_one, key, data_dir, buffer_size): key
+                    for key in tables
+                }
+                for future in as_completed(futures):
+                    key = futures[future]
+                    try:
+                        stats[key] = future.result()
+                    except Exception as e:
+                        print(f"  LỖI khi nạp {key}: {e}")
+                        errors[key] = e
+        else:
+            for key in tables:
+                try:
+                    stats[key] = _ingest_one(key, data_dir, buffer_size)
+                except Exception as e:
+                    print(f"  LỖI khi nạp {key}: {e}")
+                    errors[key] = e
+
+        total_rows = sum(s['rows'] for s in stats.values())
+        elapsed = time.perf_counter() - start
+
+        print("\nTỔNG KẾT GIAI ĐOẠN NẠP DỮ LIỆU THÔ:")
+        for key in tables:
+            print(f"  {key:35s}: " + (f"{stats[key]['rows']:,} dòng" if key in stats else "LỖI"))
+        print(f"  Tổng cộng {total_rows:,} dòng trong {elapsed:.2f}s "
+              f"({total_rows / elapsed if elapsed > 0 else 0:,.0f} dòng/s)\n")
+
+    # Bảng lỗi không bị báo thành 0 dòng: các bảng khác vẫn được nạp, sau đó dừng pipeline
+    if errors:
+        raise RuntimeError(f"Không nạp được {len(errors)} bảng: "
+                           + '; '.join(f"{key}: {e}" for key, e in errors.items()))
+    return stats
+
+if __name__ == "__main__":
+    run_ingestion()
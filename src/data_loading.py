@@ -1,5 +1,14 @@
 import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core import exceptions as api_exceptions
 from google.cloud import storage, bigquery
 from google.cloud.exceptions import NotFound
 from google.oauth2 import service_account
@@ -9,45 +18,269 @@ import config
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Client được tạo một lần cho mỗi process và dùng chung giữa các luồng
+_CLIENTS = {}
+_CLIENT_LOCK = threading.Lock()
+
+# Các lỗi tạm thời đáng thử lại (mạng chập chờn, GCS/BigQuery quá tải)
+RETRYABLE_ERRORS = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.InternalServerError,
+    api_exceptions.BadGateway,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.GatewayTimeout,
+    ConnectionError,
+    TimeoutError,
+)
+
+# GIẢ LẬP GCS TRÊN ĐĨA (STORAGE_BACKEND = 'local')
+class LocalBlob:
+    """Blob giả lập: lưu thành file <root>/<bucket>/<name>, hỗ trợ các hàm upload/compose/delete dùng ở đây"""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = None
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.path, self.name)
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path) if self.exists() else None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def upload_from_file(self, file_obj, size=None):
+        # Ghi theo từng khối chunk_size giống resumable upload; ghi ra file tạm rồi đổi tên (nguyên tử)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        block = self.chunk_size or 1024 * 1024
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        remaining = size
+        with open(tmp_path, 'wb') as out:
+            while remaining is None or remaining > 0:
+                data = file_obj.read(block if remaining is None else min(block, remaining))
+                if not data:
+                    break
+                out.write(data)
+                if remaining is not None:
+                    remaining -= len(data)
+        os.replace(tmp_path, self.path)
+
+    def upload_from_filename(self, filename):
+        with open(filename, 'rb') as f:
+            self.upload_from_file(f)
+
+    def compose(self, sources):
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as out:
+            for source in sources:
+                with open(source.path, 'rb') as f:
+                    shutil.copyfileobj(f, out)
+        os.replace(tmp_path, self.path)
+
+    def delete(self):
+        os.remove(self.path)
+
+class LocalBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.root, name)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+class LocalStorageClient:
+    """Client giả lập có cùng giao diện tối thiểu với storage.Client"""
+
+    def __init__(self, root=None):
+        self.root = os.path.abspath(root or config.LOCAL_STORAGE_DIR)
+        self.project = 'local'
+
+    def bucket(self, name):
+        return LocalBucket(self, name)
+
+# CLIENT & RETRY
+def get_credentials():
+    """Đọc file Service Account một lần và dùng lại"""
+    with _CLIENT_LOCK:
+        if 'credentials' not in _CLIENTS:
+            _CLIENTS['credentials'] = service_account.Credentials.from_service_account_file(config.GCP_KEY_PATH)
+        return _CLIENTS['credentials']
+
 def get_gcs_client():
-    """Tạo kết nối tới GCS bằng Service Account"""
+    """Client GCS dùng chung (hoặc client giả lập khi STORAGE_BACKEND = 'local')"""
+    if 'gcs' in _CLIENTS:
+        return _CLIENTS['gcs']
     try:
-        credentials = service_account.Credentials.from_service_account_file(config.GCP_KEY_PATH)
-        client = storage.Client(credentials=credentials)
-        return client
+        if config.STORAGE_BACKEND == 'local':
+            client = LocalStorageClient()
+        else:
+            client = storage.Client(credentials=get_credentials())
+        with _CLIENT_LOCK:
+            return _CLIENTS.setdefault('gcs', client)
     except Exception as e:
         logger.error(f"Failed to create GCS client: {e}")
         raise
 
 def get_bq_client():
-    """Tạo kết nối tới BigQuery bằng Service Account"""
+    """Client BigQuery dùng chung"""
+    if 'bq' in _CLIENTS:
+        return _CLIENTS['bq']
     try:
-        credentials = service_account.Credentials.from_service_account_file(config.GCP_KEY_PATH)
+        credentials = get_credentials()
         client = bigquery.Client(credentials=credentials, project=credentials.project_id)
-        return client
+        with _CLIENT_LOCK:
+            return _CLIENTS.setdefault('bq', client)
     except Exception as e:
         logger.error(f"Failed to create BigQuery client: {e}")
         raise
 
-def upload_to_gcs(local_file_path, destination_blob_name):
+def reset_clients():
+    """Xóa client đã cache (vd: sau khi đổi STORAGE_BACKEND hoặc file key)"""
+    with _CLIENT_LOCK:
+        _CLIENTS.clear()
+
+def with_retry(func, *args, description='request', **kwargs):
+    """Gọi func, thử lại với exponential backoff + jitter khi gặp lỗi tạm thời"""
+    cfg = config.GCS_UPLOAD_CONFIG
+    for attempt in range(cfg['max_retries'] + 1):
+        try:
+            return func(*args, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            if attempt == cfg['max_retries']:
+                raise
+            delay = min(cfg['backoff_max'], cfg['backoff_base'] * 2 ** attempt) * random.uniform(0.5, 1.0)
+            logger.warning(f"{description} failed ({e}), retrying in {delay:.1f}s "
+                           f"({attempt + 1}/{cfg['max_retries']})...")
+            time.sleep(delay)
+
+# UPLOAD
+def _upload_part(bucket, blob_name, local_file_path, offset, size, chunk_size):
+    """Upload một đoạn [offset, offset + size) của file thành một blob riêng"""
+    def attempt():
+        blob = bucket.blob(blob_name)
+        blob.chunk_size = chunk_size
+        with open(local_file_path, 'rb') as f:
+            f.seek(offset)
+            blob.upload_from_file(f, size=size)
+        return blob
+    return with_retry(attempt, description=f"Upload part {blob_name}")
+
+def composite_upload(bucket, local_file_path, destination_blob_name, parts=None, chunk_size=None,
+                     max_workers=None):
+    """
+    Parallel composite upload: chia file thành nhiều phần, upload song song rồi ghép lại (compose).
+    Các phần tạm luôn được xóa, kể cả khi lỗi.
+    """
+    cfg = config.GCS_UPLOAD_CONFIG
+    parts = max(1, min(parts or cfg['composite_parts'], 32))
+    chunk_size = chunk_size or cfg['chunk_size']
+    file_size = os.path.getsize(local_file_path)
+    part_size = -(-file_size // parts)
+    token = uuid.uuid4().hex[:8]
+
+    ranges = [(f"{destination_blob_name}.part-{i:02d}-{token}", offset, min(part_size, file_size - offset))
+              for i, offset in enumerate(range(0, file_size, part_size))]
+    part_blobs = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers or cfg['max_workers']) as executor:
+            futures = [executor.submit(_upload_part, bucket, name, local_file_path, offset, size, chunk_size)
+                       for name, offset, size in ranges]
+            for future in futures:
+                part_blobs.append(future.result())
+
+        destination = bucket.blob(destination_blob_name)
+        with_retry(destination.compose, part_blobs, description=f"Compose {destination_blob_name}")
+    finally:
+        for blob in part_blobs:
+            try:
+                blob.delete()
+            except Exception as e:
+                logger.warning(f"Could not delete temporary part {blob.name}: {e}")
+
+def upload_to_gcs(local_file_path, destination_blob_name, chunk_size=None, composite=None):
     """
     Upload file từ máy local lên Google Cloud Storage
+    - File nhỏ: resumable upload theo từng khối chunk_size (lỗi giữa chừng chỉ gửi lại khối hỏng).
+    - File lớn hơn composite_threshold: parallel composite upload.
+    :param composite: True/False để ép chế độ, None -> tự chọn theo kích thước file
     """
+    cfg = config.GCS_UPLOAD_CONFIG
+    chunk_size = chunk_size or cfg['chunk_size']
     try:
         client = get_gcs_client()
         bucket = client.bucket(config.GCS_BUCKET_NAME)
-        blob = bucket.blob(destination_blob_name)
+        file_size = os.path.getsize(local_file_path)
+        if composite is None:
+            composite = file_size >= cfg['composite_threshold']
+
+        logger.info(f"Uploading {local_file_path} ({file_size / 1024 / 1024:.1f} MB) to "
+                    f"gs://{config.GCS_BUCKET_NAME}/{destination_blob_name}...")
+
+        if composite:
+            composite_upload(bucket, local_file_path, destination_blob_name, chunk_size=chunk_size)
+        else:
+            def attempt():
+                blob = bucket.blob(destination_blob_name)
+                blob.chunk_size = chunk_size
+                blob.upload_from_filename(local_file_path)
+            with_retry(attempt, description=f"Upload {destination_blob_name}")
 
-        logger.info(f"Uploading {local_file_path} to gs://{config.GCS_BUCKET_NAME}/{destination_blob_name}...")
-        
-        blob.upload_from_filename(local_file_path)
-        
         logger.info("Upload to GCS successful!")
         return True
     except Exception as e:
         logger.error(f"GCS Upload failed: {e}")
         return False
 
+def benchmark_uploads(file_size_mb=256, modes=('single', 'chunked', 'composite')):
+    """
+    So sánh thời gian upload cùng một file ngẫu nhiên theo từng chế độ:
+    - 'single': một lần gửi (không đặt chunk_size, như trước đây)
+    - 'chunked': resumable upload theo chunk_size
+    - 'composite': chia phần upload song song rồi compose
+    Với STORAGE_BACKEND = 'local' nội dung file đích được kiểm tra md5 sau mỗi lần upload.
+    """
+    logger.info(f"Benchmark upload {file_size_mb} MB ({config.STORAGE_BACKEND})")
+    bucket = get_gcs_client().bucket(config.GCS_BUCKET_NAME)
+    results = {}
+
+    with tempfile.TemporaryDirectory(prefix='olist_upload_') as work_dir:
+        local_path = os.path.join(work_dir, 'bench.bin')
+        digest = hashlib.md5()
+        with open(local_path, 'wb') as f:
+            for _ in range(file_size_mb):
+                block = os.urandom(1024 * 1024)
+                digest.update(block)
+                f.write(block)
+
+        for mode in modes:
+            blob_name = f"benchmark/upload_{mode}.bin"
+            start = time.perf_counter()
+            if mode == 'single':
+                bucket.blob(blob_name).upload_from_filename(local_path)
+            else:
+                if not upload_to_gcs(local_path, blob_name, composite=(mode == 'composite')):
+                    raise RuntimeError(f"Upload mode {mode} failed")
+            elapsed = time.perf_counter() - start
+            results[mode] = elapsed
+
+            blob = bucket.blob(blob_name)
+            if isinstance(blob, LocalBlob):
+                uploaded = hashlib.md5()
+                with open(blob.path, 'rb') as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b''):
+                        uploaded.update(block)
+                if uploaded.hexdigest() != digest.hexdigest():
+                    raise AssertionError(f"Nội dung file sau upload ({mode}) không khớp")
+            blob.delete()
+            logger.info(f"  {mode:10s}: {elapsed:7.2f}s ({file_size_mb / elapsed if elapsed > 0 else 0:,.1f} MB/s)")
+
+    return results
+
 def create_bq_dataset(dataset_name, location="US"):
     """
     Tạo BigQuery Dataset nếu chưa tồn tại
@@ -56,38 +289,55 @@ def create_bq_dataset(dataset_name, location="US"):
     dataset_id = f"{client.project}.{dataset_name}"
 
     try:
-        client.get_dataset(dataset_id)
+        with_retry(client.get_dataset, dataset_id, description=f"Get dataset {dataset_id}")
         logger.info(f"Dataset {dataset_id} already exists.")
     except NotFound:
         dataset = bigquery.Dataset(dataset_id)
         dataset.location = location
-        dataset = client.create_dataset(dataset, timeout=30)
+        dataset = with_retry(client.create_dataset, dataset, timeout=30, exists_ok=True,
+                             description=f"Create dataset {dataset_id}")
         logger.info(f"Created new dataset: {dataset_id} in {location}")
 
-def load_gcs_to_bigquery(gcs_uri, dataset_id, table_id):
+def load_gcs_to_bigquery(gcs_uri, dataset_id, table_id, source_format='CSV', schema=None,
+                         write_disposition='WRITE_TRUNCATE', partition_field=None):
     """
     Load file từ GCS vào BigQuery
     :param gcs_uri: Đường dẫn file trên GCS 
     :param dataset_id: Tên dataset 
     :param table_id: Tên bảng muốn tạo 
+    :param source_format: 'CSV' hoặc 'PARQUET'
+    :param schema: List dict {'name', 'type', 'mode'}; None -> để BigQuery tự nhận diện (autodetect)
+    :param write_disposition: 'WRITE_TRUNCATE' (xóa cũ ghi mới) hoặc 'WRITE_APPEND'
+    :param partition_field: Cột phân vùng theo tháng (table_id có thể kèm decorator 'table$YYYYMM')
     """
     try:
         client = get_bq_client()
 
         # Cấu hình job load
         job_config = bigquery.LoadJobConfig(
-            source_format=bigquery.SourceFormat.CSV,
-            skip_leading_rows=1, 
-            autodetect=True,     
-            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE, # Xóa cũ ghi mới
+            source_format=getattr(bigquery.SourceFormat, source_format),
+            write_disposition=write_disposition,
         )
+        if source_format == 'CSV':
+            job_config.skip_leading_rows = 1
+        if schema:
+            job_config.schema = [
+                bigquery.SchemaField(f['name'], f['type'], mode=f.get('mode', 'NULLABLE')) for f in schema
+            ]
+        else:
+            job_config.autodetect = True
+        if partition_field:
+            job_config.time_partitioning = bigquery.TimePartitioning(
+                type_=bigquery.TimePartitioningType.MONTH, field=partition_field
+            )
 
         table_ref = f"{client.project}.{dataset_id}.{table_id}"
         
         logger.info(f"Loading {gcs_uri} into BigQuery table {table_ref}...")
         
-        load_job = client.load_table_from_uri(
-            gcs_uri, table_ref, job_config=job_config
+        load_job = with_retry(
+            client.load_table_from_uri, gcs_uri, table_ref, job_config=job_config,
+            description=f"Load job {table_ref}"
         )
 
         load_job.result()  
@@ -98,3 +348,51 @@ def load_gcs_to_bigquery(gcs_uri, dataset_id, table_id):
         logger.error(f"BigQuery Load failed: {e}")
         return False
 
+# Tên kiểu cũ (legacy SQL) mà BigQuery trả về trong schema của bảng -> tên kiểu Standard SQL
+BQ_TYPE_ALIASES = {'INTEGER': 'INT64', 'FLOAT': 'FLOAT64', 'BOOLEAN': 'BOOL', 'RECORD': 'STRUCT'}
+
+def reset_bq_table_if_incompatible(dataset_id, table_id, schema=None, partition_field=None):
+    """
+    Xóa bảng BigQuery nếu phân vùng hoặc schema khác cấu hình sắp load
+    (vd: bảng tạo trước đây từ CSV autodetect, không phân vùng -> load có time_partitioning bị từ chối
+    với lỗi "Incompatible table partitioning specification"). Load WRITE_TRUNCATE sau đó tạo lại bảng.
+    :param schema: List dict {'name', 'type'}; None -> chỉ so sánh phân vùng
+    :param partition_field: Cột phân vùng theo tháng (None -> bảng không phân vùng)
+    """
+    try:
+        client = get_bq_client()
+        table_ref = f"{client.project}.{dataset_id}.{table_id}"
+        try:
+            table = with_retry(client.get_table, table_ref, description=f"Get table {table_ref}")
+        except NotFound:
+            return True
+
+        partitioning = table.time_partitioning
+        current_partition = (partitioning.type_, partitioning.field) if partitioning else None
+        expected_partition = (bigquery.TimePartitioningType.MONTH, partition_field) if partition_field else None
+        current_schema = [(f.name, BQ_TYPE_ALIASES.get(f.field_type, f.field_type)) for f in table.schema]
+        expected_schema = [(f['name'], f['type']) for f in schema] if schema else current_schema
+
+        if current_partition != expected_partition or current_schema != expected_schema:
+            logger.info(f"Dropping {table_ref}: partitioning {current_partition} -> {expected_partition}, "
+                        f"schema changed: {current_schema != expected_schema}")
+            with_retry(client.delete_table, table_ref, not_found_ok=True, description=f"Delete table {table_ref}")
+        return True
+    except Exception as e:
+        logger.error(f"BigQuery table check failed: {e}")
+        return False
+
+def delete_bq_partition(dataset_id, table_id, partition_key):
+    """
+    Xóa một phân vùng của bảng BigQuery (partition decorator 'table$YYYYMM')
+    """
+    try:
+        client = get_bq_client()
+        partition_ref = f"{client.project}.{dataset_id}.{table_id}${partition_key}"
+        with_retry(client.delete_table, partition_ref, not_found_ok=True,
+                   description=f"Delete partition {partition_ref}")
+        logger.info(f"Deleted BigQuery partition {partition_ref}")
+        return True
+    except Exception as e:
+        logger.error(f"BigQuery partition delete failed: {e}")
+        return False
@@ -4,50 +4,64 @@ Biến đổi dữ liệu (Tối ưu hóa ELT)
 - Đã loại bỏ các bảng phân tích thừa.
 - Đã thêm ép kiểu tường minh (Type Casting) để đảm bảo Schema chuẩn.
 - CẬP NHẬT: Đọc toàn bộ dữ liệu từ Staging (bao gồm bảng translation).
+- Khóa, index, phân vùng theo tháng và ANALYZE sau khi dựng được khai báo trong warehouse_layout.py.
 """
 
-import pandas as pd
-import os
 from sqlalchemy import text
 import config
-from config import get_db_engine, SCHEMA_WAREHOUSE
-from data_loading import upload_to_gcs, load_gcs_to_bigquery, create_bq_dataset
+from config import get_db_engine, print_pool_metrics, SCHEMA_WAREHOUSE
+from cloud_sync import sync_warehouse
+from dag_scheduler import Step, run_dag, results_to_stats, format_stat, has_failures, raise_for_failures
+from instrumentation import pipeline_run, record_io
+from warehouse_layout import create_table_as, ensure_table_keys, table_key_columns, ensure_delta_partitions
+from datetime import timedelta
+from incremental import (
+    ensure_etl_tables, table_exists, get_watermark, set_watermark, max_value,
+    get_table_columns, log_full_rebuild, log_rebuild_if_changed,
+    build_upsert_sql, build_delete_missing_sql
+)
 
-def execute_elt_query(table_name, sql_query):
+def execute_elt_query(table_name, sql_query, key_columns=None):
     """
     Hàm helper để chạy lệnh tạo bảng trong DB.
-    Tự động Drop bảng cũ và Create bảng mới.
+    Bảng mới được dựng trong bảng shadow (theo bố cục trong warehouse_layout: khóa, index, phân vùng)
+    rồi hoán đổi với bảng cũ trong một transaction, người đọc không bao giờ thấy bảng dựng dở.
+    Lỗi được in ra rồi ném tiếp để bộ lập lịch DAG dừng các bước phụ thuộc.
     """
     print(f"Đang tạo bảng {table_name}...")
     engine = get_db_engine()
     
     full_table_name = f"{SCHEMA_WAREHOUSE}.{table_name}"
     
-    # Bọc query trong lệnh CREATE TABLE AS
-    create_sql = f"""
-    DROP TABLE IF EXISTS {full_table_name} CASCADE;
-    CREATE TABLE {full_table_name} AS (
-        {sql_query}
-    );
-    """
-    
     try:
-        with engine.begin() as conn:
-            conn.execute(text(create_sql))
-            
-        # Đếm số dòng để báo cáo
-        count = pd.read_sql(f"SELECT COUNT(1) FROM {full_table_name}", engine).iloc[0,0]
+        # Số dòng lấy từ command status của lệnh nạp, không quét lại bảng
+        count = create_table_as(full_table_name, sql_query, key_columns, engine)
         print(f"    Hoàn tất. Bảng {table_name} có {count:,} dòng.")
         return count
     except Exception as e:
         print(f"    LỖI khi tạo {table_name}: {e}")
-        return 0
+        raise
+
+def track_dim_change(table_name):
+    """
+    Ghi nhận thay đổi nội dung của bảng Dim vừa dựng lại: nếu khác lần trước thì đánh dấu full_rebuild
+    để agg_category/agg_state... không giữ danh mục/bang cũ (bảng Dim không đi qua nhật ký thay đổi).
+    """
+    full_table_name = f"{SCHEMA_WAREHOUSE}.{table_name}"
+    with get_db_engine().begin() as conn:
+        if log_rebuild_if_changed(conn, full_table_name):
+            print(f"    {table_name} đã thay đổi -> các aggregate phụ thuộc sẽ dựng lại toàn bộ.")
 
 def create_warehouse_schema():
-    """Tạo schema warehouse nếu chưa tồn tại"""
+    """
+    Tạo schema warehouse và các bảng ETL (watermark, nhật ký thay đổi) nếu chưa tồn tại.
+    Gọi một lần trước khi chạy DAG: các bước chạy song song không tự chạy DDL (tránh tranh chấp
+    CREATE IF NOT EXISTS và khóa ACCESS EXCLUSIVE của ALTER TABLE ở mỗi lần chạy).
+    """
     engine = get_db_engine()
     with engine.connect() as conn:
         conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {SCHEMA_WAREHOUSE}"))
+        ensure_etl_tables(conn)
         conn.commit()
     print(f" Schema {SCHEMA_WAREHOUSE} đã sẵn sàng")
 
@@ -96,7 +110,9 @@ def create_dim_customers():
         customer_state::VARCHAR(10)
     FROM staging.customers_cleaned
     """
-    return execute_elt_query('dim_customers', sql)
+    count = execute_elt_query('dim_customers', sql)
+    track_dim_change('dim_customers')
+    return count
 
 def create_dim_products():
     """
@@ -119,7 +135,9 @@ def create_dim_products():
     LEFT JOIN staging.product_category_name_translation t
         ON p.product_category_name = t.product_category_name
     """
-    return execute_elt_query('dim_products', sql)
+    count = execute_elt_query('dim_products', sql)
+    track_dim_change('dim_products')
+    return count
 
 def create_dim_sellers():
     """
@@ -135,12 +153,73 @@ def create_dim_sellers():
     """
     return execute_elt_query('dim_sellers', sql)
 
-def create_fact_order_items():
+def execute_incremental_upsert(table_name, build_sql, key_columns, watermark_column):
     """
-    Tạo bảng Fact chi tiết (Item Level) trong Warehouse.
-    Đây là bảng Bridge kết nối Order - Product - Seller.
+    Cập nhật tăng dần một bảng Fact theo high-water mark.
+    1. Tính phần delta (watermark - lookback) vào bảng tạm.
+    2. INSERT ... ON CONFLICT chỉ các dòng mới/thay đổi, xóa các dòng trong cửa sổ không còn ở nguồn.
+    3. Ghi order_id bị ảnh hưởng vào nhật ký thay đổi và lưu watermark mới.
+    Nếu bảng chưa tồn tại hoặc chưa có watermark -> dựng lại toàn bộ.
+    :param build_sql: Hàm nhận since (bool) và trả về câu SELECT (dùng tham số :since khi since=True)
     """
-    sql = """
+    print(f"Đang cập nhật tăng dần bảng {table_name}...")
+    engine = get_db_engine()
+    full_table_name = f"{SCHEMA_WAREHOUSE}.{table_name}"
+
+    with engine.begin() as conn:
+        watermark = get_watermark(conn, full_table_name) if table_exists(conn, full_table_name) else None
+
+    if watermark is None:
+        print("    Chưa có watermark -> dựng lại toàn bộ.")
+        return execute_full_rebuild(table_name, build_sql(False), key_columns, watermark_column)
+
+    since = watermark - timedelta(days=config.INCREMENTAL_CONFIG['lookback_days'])
+    delta_table = f"{table_name}_delta"
+
+    try:
+        with engine.begin() as conn:
+            ensure_table_keys(conn, full_table_name, key_columns)
+            # Bảng phân vùng: khóa gồm cả cột phân vùng, tạo trước phân vùng cho các tháng mới
+            key_columns = table_key_columns(conn, full_table_name, key_columns)
+            delta_rows = conn.execute(
+                text(f"CREATE TEMP TABLE {delta_table} ON COMMIT DROP AS {build_sql(True)}"), {'since': since}
+            ).rowcount
+            ensure_delta_partitions(conn, full_table_name, delta_table)
+            columns = get_table_columns(conn, full_table_name)
+
+            upserted = conn.execute(text(build_upsert_sql(
+                full_table_name, delta_table, columns, key_columns, table_name
+            ))).scalar()
+            deleted = conn.execute(text(build_delete_missing_sql(
+                full_table_name, delta_table, key_columns, watermark_column, table_name
+            )), {'since': since}).scalar()
+
+            set_watermark(conn, full_table_name, watermark_column,
+                          max_value(conn, full_table_name, watermark_column))
+
+        record_io(rows_in=delta_rows, rows_out=upserted + deleted)
+        print(f"    Hoàn tất. {upserted:,} dòng thêm/cập nhật, {deleted:,} dòng xóa "
+              f"(cửa sổ từ {since}).")
+        return upserted
+    except Exception as e:
+        print(f"    LỖI khi cập nhật {table_name}: {e}")
+        raise
+
+def execute_full_rebuild(table_name, sql_query, key_columns, watermark_column):
+    """Dựng lại toàn bộ bảng Fact (khóa chính được thêm trên bảng shadow trước khi hoán đổi) và đặt lại watermark"""
+    count = execute_elt_query(table_name, sql_query, key_columns)
+
+    full_table_name = f"{SCHEMA_WAREHOUSE}.{table_name}"
+    with get_db_engine().begin() as conn:
+        set_watermark(conn, full_table_name, watermark_column,
+                      max_value(conn, full_table_name, watermark_column))
+        log_full_rebuild(conn, full_table_name)
+    return count
+
+def fact_order_items_sql(since=False):
+    """Câu SELECT cho fact_order_items (since=True -> chỉ lấy các dòng có shipping_limit_date > :since)"""
+    delta_filter = "WHERE oi.shipping_limit_date > :since" if since else ""
+    return f"""
     SELECT 
         oi.order_id::VARCHAR(100),
         oi.order_item_id::INTEGER,
@@ -150,14 +229,33 @@ def create_fact_order_items():
         oi.price::DOUBLE PRECISION,
         oi.freight_value::DOUBLE PRECISION
     FROM staging.order_items_cleaned oi
+    {delta_filter}
     """
-    return execute_elt_query('fact_order_items', sql)
 
-def create_fact_orders():
+def create_fact_order_items(mode=None):
     """
-    Tạo bảng Fact chính. 
+    Tạo bảng Fact chi tiết (Item Level) trong Warehouse.
+    Đây là bảng Bridge kết nối Order - Product - Seller.
+    :param mode: 'full' (dựng lại) hoặc 'incremental' (upsert theo shipping_limit_date)
     """
-    sql = """
+    key_columns = ['order_id', 'order_item_id']
+    if (mode or config.REFRESH_MODE) == 'incremental':
+        return execute_incremental_upsert('fact_order_items', fact_order_items_sql,
+                                          key_columns, 'shipping_limit_date')
+    return execute_full_rebuild('fact_order_items', fact_order_items_sql(), key_columns, 'shipping_limit_date')
+
+def fact_orders_sql(since=False):
+    """
+    Câu SELECT cho fact_orders.
+    since=True -> chỉ tính các đơn có order_purchase_timestamp > :since
+    (kể cả phần tổng hợp items/reviews, để chi phí tỉ lệ với phần delta).
+    """
+    delta_orders = (
+        "AND order_id IN (SELECT order_id FROM staging.orders_cleaned "
+        "WHERE order_purchase_timestamp > :since)"
+    ) if since else ""
+    delta_filter = "AND o.order_purchase_timestamp > :since" if since else ""
+    return f"""
     WITH order_totals AS (
         SELECT 
             order_id,
@@ -166,6 +264,7 @@ def create_fact_orders():
             SUM(price + freight_value) AS total_amount,
             COUNT(*) AS item_count
         FROM staging.order_items_cleaned
+        WHERE TRUE {delta_orders}
         GROUP BY order_id
     ),
     order_reviews AS (
@@ -174,6 +273,7 @@ def create_fact_orders():
             AVG(review_score) AS avg_review_score,
             COUNT(*) AS review_count
         FROM staging.reviews_cleaned
+        WHERE TRUE {delta_orders}
         GROUP BY order_id
     )
     SELECT 
@@ -217,81 +317,79 @@ def create_fact_orders():
     LEFT JOIN order_totals ot ON o.order_id = ot.order_id
     LEFT JOIN order_reviews r ON o.order_id = r.order_id
     WHERE o.order_status IN ('delivered', 'shipped', 'invoiced')
+    {delta_filter}
     """
-    return execute_elt_query('fact_orders', sql)
 
-def sync_warehouse_to_cloud(engine):
+def create_fact_orders(mode=None):
     """
-    Hàm này đọc các bảng Fact/Dim vừa tạo xong trong PostgreSQL 
-    và đồng bộ chúng lên BigQuery.
+    Tạo bảng Fact chính. 
+    :param mode: 'full' (dựng lại) hoặc 'incremental' (upsert theo order_purchase_timestamp)
+    """
+    key_columns = ['order_id']
+    if (mode or config.REFRESH_MODE) == 'incremental':
+        return execute_incremental_upsert('fact_orders', fact_orders_sql,
+                                          key_columns, 'order_purchase_timestamp')
+    return execute_full_rebuild('fact_orders', fact_orders_sql(), key_columns, 'order_purchase_timestamp')
+
+def sync_warehouse_to_cloud(engine=None, backend=None):
+    """
+    Đồng bộ các bảng Fact/Dim vừa tạo xong trong PostgreSQL lên BigQuery.
+    Dữ liệu được stream ra Parquet và đẩy song song, chỉ các bảng/tháng thay đổi (xem cloud_sync.py).
+    Tham số engine được giữ để tương thích, kết nối lấy từ pool dùng chung.
+    """
+    return sync_warehouse(backend=backend)
+
+
+# DAG CÁC BƯỚC DỰNG WAREHOUSE
+# Các bảng dim/fact chỉ đọc từ Staging nên có thể chạy song song hoàn toàn
+TRANSFORMATION_STEPS = [
+    Step('dim_date', create_dim_date,
+         inputs=['staging.orders_cleaned'], outputs=['warehouse.dim_date']),
+    Step('dim_customers', create_dim_customers,
+         inputs=['staging.customers_cleaned'], outputs=['warehouse.dim_customers']),
+    Step('dim_products', create_dim_products,
+         inputs=['staging.products_cleaned', 'staging.product_category_name_translation'],
+         outputs=['warehouse.dim_products']),
+    Step('dim_sellers', create_dim_sellers,
+         inputs=['staging.sellers_cleaned'], outputs=['warehouse.dim_sellers']),
+    Step('fact_order_items', create_fact_order_items,
+         inputs=['staging.order_items_cleaned'], outputs=['warehouse.fact_order_items']),
+    Step('fact_orders', create_fact_orders,
+         inputs=['staging.orders_cleaned', 'staging.order_items_cleaned', 'staging.reviews_cleaned'],
+         outputs=['warehouse.fact_orders']),
+]
+
+def run_transformation(parallel=True, max_workers=None, sync_to_cloud=True):
+    """
+    Chạy toàn bộ các bước biến đổi dữ liệu
+    :param parallel: Chạy song song các bước độc lập theo DAG
+    :param sync_to_cloud: Đồng bộ các bảng Warehouse lên BigQuery sau khi dựng xong
     """
-    print("\n Bắt đầu đồng bộ Data Warehouse lên Google Cloud...")
-    
-    # Danh sách các bảng trong Warehouse cần đẩy đi
-    warehouse_tables = [
-        "warehouse.fact_orders",
-        "warehouse.fact_order_items",
-        "warehouse.dim_sellers",
-        "warehouse.dim_customers",
-        "warehouse.dim_products"
-    ]
-    
-    # Đảm bảo Dataset tồn tại
-    dataset_name = "olist_analytics"
-    create_bq_dataset(dataset_name)
-
-    for table_full_name in warehouse_tables:
-        try:
-            table_clean_name = table_full_name.split('.')[-1] # Lấy tên dim_sellers
-            csv_name = f"{table_clean_name}.csv"
-            
-            # 1. Extract: Đọc từ Postgres ra
-            df = pd.read_sql(f"SELECT * FROM {table_full_name}", engine)
-            df.to_csv(csv_name, index=False)
-            
-            # 2. Upload: Đẩy lên GCS
-            gcs_path = f"warehouse/{csv_name}"
-            upload_to_gcs(csv_name, gcs_path)
-            
-            # 3. Load: Đẩy vào BigQuery
-            gcs_uri = f"gs://{config.GCS_BUCKET_NAME}/{gcs_path}"
-            load_gcs_to_bigquery(gcs_uri, dataset_name, table_clean_name)
-            
-            # 4. Dọn dẹp file rác
-            if os.path.exists(csv_name):
-                os.remove(csv_name)
-                
-        except Exception as e:
-            print(f"Không thể đồng bộ bảng {table_full_name}: {e}")
-
-
-def run_transformation():
-    """Chạy toàn bộ các bước biến đổi dữ liệu"""
     print("BIẾN ĐỔI DỮ LIỆU")
 
-    create_warehouse_schema()
-    
-    stats = {}
-    
-    # Tạo bảng dimension
-    print("\n Tạo bảng Dimension")
-    stats['dim_date'] = create_dim_date()
-    stats['dim_customers'] = create_dim_customers()
-    stats['dim_products'] = create_dim_products()
-    stats['dim_sellers'] = create_dim_sellers()
-    
-    # Tạo bảng fact
-    print("\n Tạo bảng Fact")
-    stats['fact_order_items'] = create_fact_order_items()
-    stats['fact_orders'] = create_fact_orders()
-    
-    print("\n TỔNG KẾT BIẾN ĐỔI DỮ LIỆU:")
-    for table, count in stats.items():
-        print(f"  {table:30s}: {count:,} dòng")
-    
-    engine = get_db_engine()
-    sync_warehouse_to_cloud(engine)
+    with pipeline_run('transformation'):
+        create_warehouse_schema()
+
+        # Tạo bảng dimension & fact
+        print("\n Tạo bảng Dimension & Fact")
+        results = run_dag(TRANSFORMATION_STEPS, max_workers=max_workers, parallel=parallel)
+        stats = results_to_stats(results)
+
+        print("\n TỔNG KẾT BIẾN ĐỔI DỮ LIỆU:")
+        for table, count in stats.items():
+            print(f"  {table:30s}: {format_stat(count)}")
+
+        print_pool_metrics()
+
+        # Không đẩy lên cloud một Warehouse dựng dở (bảng lỗi/bị bỏ qua vẫn là bản cũ hoặc không có)
+        if sync_to_cloud and has_failures(results):
+            print("\n Có bước lỗi/bị bỏ qua -> không đồng bộ Warehouse lên cloud.")
+        elif sync_to_cloud:
+            engine = get_db_engine()
+            sync_warehouse_to_cloud(engine)
 
+    # Bước lỗi không bị báo thành 0 dòng: dừng pipeline sau khi đã ghi sổ
+    raise_for_failures(results)
     print("\n Quá trình biến đổi & đồng bộ hoàn tất!\n")
     return stats
 
@@ -0,0 +1,146 @@
+"""
+Chỉ mục tọa độ theo zip prefix
+- Bảng warehouse.zip_centroid: gộp staging.geolocation (nhiều điểm trùng cho mỗi zip) thành 1 dòng/zip:
+  tọa độ trung bình, số điểm, thành phố/bang xuất hiện nhiều nhất. Dựng 1 lần mỗi lần chạy.
+- ZipCentroidIndex: cấu trúc tra cứu trong bộ nhớ (mảng zip đã sắp xếp + cột lat/lng NumPy),
+  tra cứu theo lô bằng searchsorted thay vì quét lại bảng geolocation.
+- Hàm Haversine vector hóa dùng chung cho các đặc trưng khoảng cách.
+"""
+
+import threading
+import numpy as np
+import pandas as pd
+from config import get_db_engine, TABLES, LOGISTICS_CONFIG
+from warehouse_layout import create_table_as
+
+ZIP_CENTROID_TABLE = TABLES['warehouse']['zip_centroid']
+EARTH_RADIUS_KM = 6371.0
+
+# Chỉ mục đã nạp, dùng chung trong process (bị xóa khi bảng zip_centroid được dựng lại)
+_INDEX_CACHE = {}
+_INDEX_LOCK = threading.Lock()
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Khoảng cách Haversine (km) giữa các cặp tọa độ, tính vector hóa trên mảng NumPy"""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(a, dtype=float)) for a in (lat1, lng1, lat2, lng2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+def zip_prefix_sql(column):
+    """Biểu thức SQL chuẩn hóa zip prefix về số nguyên (giống normalize_zip_prefixes)"""
+    return f"NULLIF(regexp_replace({column}::text, '\\D', '', 'g'), '')::int"
+
+def create_zip_centroid():
+    """
+    Dựng bảng warehouse.zip_centroid (khóa chính zip_prefix dạng số nguyên,
+    để '01037' và '1037' trỏ về cùng một zip). Bỏ các điểm nằm ngoài lãnh thổ Brazil.
+    """
+    print("Đang tạo bảng zip_centroid...")
+    (lat_min, lat_max), (lng_min, lng_max) = LOGISTICS_CONFIG['lat_range'], LOGISTICS_CONFIG['lng_range']
+    engine = get_db_engine()
+    try:
+        # Dựng trong bảng shadow rồi hoán đổi: logistics đang đọc bảng cũ không bị gián đoạn
+        count = create_table_as(ZIP_CENTROID_TABLE, f"""
+                WITH points AS (
+                    SELECT
+                        {zip_prefix_sql('geolocation_zip_code_prefix')} as zip_prefix,
+                        geolocation_lat as lat,
+                        geolocation_lng as lng,
+                        geolocation_city as city,
+                        geolocation_state as state
+                    FROM staging.geolocation
+                    WHERE geolocation_lat BETWEEN {lat_min} AND {lat_max}
+                      AND geolocation_lng BETWEEN {lng_min} AND {lng_max}
+                )
+                SELECT
+                    zip_prefix,
+                    AVG(lat)::double precision as lat,
+                    AVG(lng)::double precision as lng,
+                    COUNT(*) as point_count,
+                    mode() WITHIN GROUP (ORDER BY city) as city,
+                    mode() WITHIN GROUP (ORDER BY state) as state
+                FROM points
+                WHERE zip_prefix IS NOT NULL
+                GROUP BY zip_prefix
+        """, key_columns=['zip_prefix'], engine=engine)
+    except Exception as e:
+        print(f"   ERROR creating zip_centroid: {e}")
+        raise
+
+    clear_zip_index_cache()
+    print(f"   -> Hoàn tất. Bảng zip_centroid có {count:,} dòng.")
+    return count
+
+def normalize_zip_prefixes(values):
+    """Chuyển zip prefix (chuỗi/số) về mảng int64; giá trị không hợp lệ -> -1"""
+    numeric = pd.to_numeric(pd.Series(values, copy=False), errors='coerce').to_numpy(dtype=float)
+    return np.where(np.isnan(numeric), -1, numeric).astype(np.int64)
+
+class ZipCentroidIndex:
+    """Tra cứu tọa độ/bang theo zip prefix bằng tìm kiếm nhị phân trên mảng đã sắp xếp"""
+
+    def __init__(self, prefixes, lat, lng, state=None):
+        order = np.argsort(prefixes, kind='stable')
+        self.prefixes = np.asarray(prefixes, dtype=np.int64)[order]
+        self.lat = np.asarray(lat, dtype=float)[order]
+        self.lng = np.asarray(lng, dtype=float)[order]
+        self.state = np.asarray(state, dtype=object)[order] if state is not None else None
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls(df['zip_prefix'].to_numpy(), df['lat'].to_numpy(), df['lng'].to_numpy(),
+                   df['state'].to_numpy() if 'state' in df else None)
+
+    @classmethod
+    def load(cls, engine=None):
+        """Nạp toàn bộ bảng zip_centroid (~20 nghìn dòng) vào bộ nhớ"""
+        df = pd.read_sql(f"SELECT zip_prefix, lat, lng, state FROM {ZIP_CENTROID_TABLE}",
+                         engine or get_db_engine())
+        return cls.from_frame(df)
+
+    def positions(self, zip_prefixes):
+        """Vị trí của từng zip trong chỉ mục và mặt nạ tìm thấy"""
+        keys = normalize_zip_prefixes(zip_prefixes)
+        if not len(self.prefixes):
+            return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+        pos = np.clip(np.searchsorted(self.prefixes, keys), 0, len(self.prefixes) - 1)
+        return pos, self.prefixes[pos] == keys
+
+    def lookup(self, zip_prefixes):
+        """Trả về (lat, lng) cho một lô zip; zip không có trong chỉ mục -> NaN"""
+        pos, found = self.positions(zip_prefixes)
+        if not len(self.prefixes):
+            empty = np.full(len(pos), np.nan)
+            return empty, empty.copy()
+        return np.where(found, self.lat[pos], np.nan), np.where(found, self.lng[pos], np.nan)
+
+    def states(self, zip_prefixes):
+        """Bang (state) phổ biến nhất của từng zip; không tìm thấy -> None"""
+        pos, found = self.positions(zip_prefixes)
+        if self.state is None or not len(self.prefixes):
+            return np.full(len(pos), None, dtype=object)
+        return np.where(found, self.state[pos], None)
+
+    def distance_km(self, zip_a, zip_b):
+        """Khoảng cách Haversine giữa hai lô zip (cùng độ dài); thiếu tọa độ -> NaN"""
+        lat_a, lng_a = self.lookup(zip_a)
+        lat_b, lng_b = self.lookup(zip_b)
+        return haversine_km(lat_a, lng_a, lat_b, lng_b)
+
+def get_zip_index(refresh=False):
+    """Chỉ mục dùng chung trong process (nạp lần đầu từ Database)"""
+    with _INDEX_LOCK:
+        if refresh or 'zip' not in _INDEX_CACHE:
+            _INDEX_CACHE['zip'] = ZipCentroidIndex.load()
+        return _INDEX_CACHE['zip']
+
+def clear_zip_index_cache():
+    with _INDEX_LOCK:
+        _INDEX_CACHE.clear()
+
+if __name__ == "__main__":
+    create_zip_centroid()
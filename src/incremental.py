@@ -0,0 +1,222 @@
+"""
+Hỗ trợ cập nhật tăng dần (Incremental Refresh) cho Warehouse
+- Bảng etl_watermarks: lưu mốc cao nhất (high-water mark) đã nạp cho từng bảng.
+- Bảng etl_order_changes: nhật ký các order_id vừa được thêm/sửa/xóa, để các bước phía sau
+  (aggregate, feature store) chỉ tính lại phần bị ảnh hưởng.
+- Các hàm sinh câu lệnh INSERT ... ON CONFLICT cho bước upsert.
+"""
+
+from sqlalchemy import text
+from config import SCHEMA_WAREHOUSE
+
+WATERMARK_TABLE = f"{SCHEMA_WAREHOUSE}.etl_watermarks"
+CHANGE_LOG_TABLE = f"{SCHEMA_WAREHOUSE}.etl_order_changes"
+
+# Các khóa phân vùng được ghi kèm order_id trong nhật ký thay đổi, theo bảng nguồn
+# (seller_id dùng cho feature store seller_features).
+# Các cột này không đổi sau khi đơn được tạo nên giá trị RETURNING cũng là giá trị cũ,
+# nhờ vậy bước aggregate biết cả ngày/sản phẩm/khách hàng của các dòng đã bị xóa.
+CHANGE_LOG_KEYS = {
+    'fact_orders': {
+        'customer_id': 't.customer_id',
+        'purchase_date': 't.order_purchase_timestamp::date'
+    },
+    'fact_order_items': {
+        'product_id': 't.product_id',
+        'seller_id': 't.seller_id'
+    }
+}
+
+# Các cột được thêm sau phiên bản đầu của bảng ETL (bảng cũ được bổ sung khi còn thiếu)
+ETL_ADDED_COLUMNS = {
+    WATERMARK_TABLE: {'fingerprint': 'VARCHAR(64)'},
+    CHANGE_LOG_TABLE: {
+        'customer_id': 'VARCHAR(100)',
+        'purchase_date': 'DATE',
+        'product_id': 'VARCHAR(100)',
+        'seller_id': 'VARCHAR(100)'
+    }
+}
+
+def ensure_etl_tables(conn):
+    """
+    Tạo bảng watermark và nhật ký thay đổi nếu chưa có.
+    Chỉ gọi một lần trước khi chạy DAG (create_warehouse_schema); ALTER TABLE chỉ chạy khi bảng cũ
+    còn thiếu cột, không lấy khóa ACCESS EXCLUSIVE ở mỗi lần chạy.
+    """
+    conn.execute(text(f"""
+    CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+        table_name VARCHAR(200) PRIMARY KEY,
+        watermark_column VARCHAR(100),
+        high_water_mark TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT now(),
+        fingerprint VARCHAR(64)
+    );
+    CREATE TABLE IF NOT EXISTS {CHANGE_LOG_TABLE} (
+        order_id VARCHAR(100) NOT NULL,
+        source_table VARCHAR(100) NOT NULL,
+        changed_at TIMESTAMP NOT NULL DEFAULT clock_timestamp(),
+        customer_id VARCHAR(100),
+        purchase_date DATE,
+        product_id VARCHAR(100),
+        seller_id VARCHAR(100)
+    );
+    CREATE INDEX IF NOT EXISTS etl_order_changes_changed_at_idx
+        ON {CHANGE_LOG_TABLE} (changed_at);
+    """))
+    for full_table_name, columns in ETL_ADDED_COLUMNS.items():
+        existing = set(get_table_columns(conn, full_table_name))
+        missing = [f"ADD COLUMN {name} {ddl}" for name, ddl in columns.items() if name not in existing]
+        if missing:
+            conn.execute(text(f"ALTER TABLE {full_table_name} {', '.join(missing)}"))
+
+def table_exists(conn, full_table_name):
+    """Kiểm tra bảng có tồn tại không"""
+    return conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"),
+                        {'name': full_table_name}).scalar()
+
+def get_watermark(conn, name):
+    """Lấy high-water mark đã lưu (None nếu chưa có)"""
+    return conn.execute(
+        text(f"SELECT high_water_mark FROM {WATERMARK_TABLE} WHERE table_name = :name"),
+        {'name': name}
+    ).scalar()
+
+def get_watermark_updated_at(conn, name):
+    """Thời điểm watermark được cập nhật lần cuối (None nếu chưa có)"""
+    return conn.execute(
+        text(f"SELECT updated_at FROM {WATERMARK_TABLE} WHERE table_name = :name"),
+        {'name': name}
+    ).scalar()
+
+def set_watermark(conn, name, column, value):
+    """Lưu high-water mark mới"""
+    conn.execute(text(f"""
+        INSERT INTO {WATERMARK_TABLE} (table_name, watermark_column, high_water_mark, updated_at)
+        VALUES (:name, :column, :value, now())
+        ON CONFLICT (table_name) DO UPDATE
+        SET watermark_column = EXCLUDED.watermark_column,
+            high_water_mark = EXCLUDED.high_water_mark,
+            updated_at = EXCLUDED.updated_at
+    """), {'name': name, 'column': column, 'value': value})
+
+def max_value(conn, full_table_name, column):
+    """Giá trị lớn nhất của một cột (dùng làm watermark)"""
+    return conn.execute(text(f"SELECT MAX({column}) FROM {full_table_name}")).scalar()
+
+def get_table_columns(conn, full_table_name):
+    """Danh sách cột của bảng theo đúng thứ tự định nghĩa"""
+    schema, table = full_table_name.split('.')
+    rows = conn.execute(text("""
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_schema = :schema AND table_name = :table
+        ORDER BY ordinal_position
+    """), {'schema': schema, 'table': table})
+    return [r[0] for r in rows]
+
+def get_primary_key(conn, full_table_name):
+    """Danh sách cột khóa chính (rỗng nếu bảng chưa có khóa chính)"""
+    rows = conn.execute(text("""
+        SELECT a.attname
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = to_regclass(:name) AND i.indisprimary
+        ORDER BY array_position(i.indkey::int2[], a.attnum)
+    """), {'name': full_table_name})
+    return [r[0] for r in rows]
+
+def ensure_primary_key(conn, full_table_name, key_columns):
+    """Thêm khóa chính nếu bảng chưa có (cần cho INSERT ... ON CONFLICT)"""
+    if not get_primary_key(conn, full_table_name):
+        conn.execute(text(f"ALTER TABLE {full_table_name} ADD PRIMARY KEY ({', '.join(key_columns)})"))
+
+def log_full_rebuild(conn, full_table_name):
+    """Đánh dấu bảng vừa được dựng lại toàn bộ (các bảng phía sau cũng phải dựng lại)"""
+    set_watermark(conn, f"{full_table_name}:full_rebuild", None, None)
+
+def table_fingerprint(conn, full_table_name):
+    """md5 của toàn bộ nội dung bảng, không phụ thuộc thứ tự dòng"""
+    return conn.execute(text(f"""
+        SELECT md5(COALESCE(string_agg(h, '' ORDER BY h), ''))
+        FROM (SELECT md5(t::text) AS h FROM {full_table_name} t) rows
+    """)).scalar()
+
+def log_rebuild_if_changed(conn, full_table_name):
+    """
+    So sánh dấu vân tay nội dung của một bảng Dim vừa dựng lại với lần trước.
+    Bảng Dim không có nhật ký thay đổi, nên khi nội dung khác đi (kể cả lần đầu chưa có dấu vân tay)
+    thì đánh dấu full_rebuild để các aggregate đọc bảng này dựng lại toàn bộ. Trả về True nếu có thay đổi.
+    """
+    name = f"{full_table_name}:fingerprint"
+    fingerprint = table_fingerprint(conn, full_table_name)
+    previous = conn.execute(
+        text(f"SELECT fingerprint FROM {WATERMARK_TABLE} WHERE table_name = :name"), {'name': name}
+    ).scalar()
+    if fingerprint == previous:
+        return False
+    conn.execute(text(f"""
+        INSERT INTO {WATERMARK_TABLE} (table_name, fingerprint, updated_at)
+        VALUES (:name, :fingerprint, now())
+        ON CONFLICT (table_name) DO UPDATE
+        SET fingerprint = EXCLUDED.fingerprint,
+            updated_at = EXCLUDED.updated_at
+    """), {'name': name, 'fingerprint': fingerprint})
+    log_full_rebuild(conn, full_table_name)
+    return True
+
+def _change_log_columns(source_name):
+    """Danh sách cột nhật ký và biểu thức RETURNING tương ứng cho một bảng nguồn"""
+    keys = {'order_id': 't.order_id', **CHANGE_LOG_KEYS.get(source_name, {})}
+    log_cols = ', '.join(keys)
+    returning = ', '.join(f"{expr} AS {col}" for col, expr in keys.items())
+    return log_cols, returning
+
+def build_upsert_sql(full_table_name, source_table, columns, key_columns, source_name):
+    """
+    Upsert từ bảng nguồn (delta) vào bảng đích, chỉ ghi các dòng thực sự thay đổi,
+    đồng thời ghi order_id bị ảnh hưởng vào nhật ký thay đổi. Trả về số dòng đã ghi.
+    """
+    cols = ', '.join(columns)
+    log_cols, returning = _change_log_columns(source_name)
+    non_keys = [c for c in columns if c not in key_columns]
+    set_clause = ',\n            '.join(f"{c} = EXCLUDED.{c}" for c in non_keys)
+    target_row = ', '.join(f"t.{c}" for c in non_keys)
+    excluded_row = ', '.join(f"EXCLUDED.{c}" for c in non_keys)
+
+    return f"""
+    WITH upserted AS (
+        INSERT INTO {full_table_name} AS t ({cols})
+        SELECT {cols} FROM {source_table}
+        ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET
+            {set_clause}
+        WHERE ({target_row}) IS DISTINCT FROM ({excluded_row})
+        RETURNING {returning}
+    ),
+    logged AS (
+        INSERT INTO {CHANGE_LOG_TABLE} ({log_cols}, source_table)
+        SELECT DISTINCT {log_cols}, '{source_name}' FROM upserted
+    )
+    SELECT COUNT(*) FROM upserted
+    """
+
+def build_delete_missing_sql(full_table_name, source_table, key_columns, watermark_column, source_name):
+    """
+    Xóa các dòng trong cửa sổ tăng dần không còn xuất hiện trong nguồn
+    (vd: đơn bị chuyển sang trạng thái không hợp lệ). Trả về số dòng đã xóa.
+    """
+    key_match = ' AND '.join(f"d.{k} = t.{k}" for k in key_columns)
+    log_cols, returning = _change_log_columns(source_name)
+    return f"""
+    WITH deleted AS (
+        DELETE FROM {full_table_name} t
+        WHERE t.{watermark_column} > :since
+          AND NOT EXISTS (SELECT 1 FROM {source_table} d WHERE {key_match})
+        RETURNING {returning}
+    ),
+    logged AS (
+        INSERT INTO {CHANGE_LOG_TABLE} ({log_cols}, source_table)
+        SELECT DISTINCT {log_cols}, '{source_name}' FROM deleted
+    )
+    SELECT COUNT(*) FROM deleted
+    """
@@ -0,0 +1,301 @@
+"""
+Đo đạc pipeline và sổ ghi các lần chạy (run ledger)
+- track_step(tên): bản ghi cho một bước gồm wall time, DB time (tổng thời gian các câu lệnh SQL),
+  số câu lệnh, số dòng vào/ra, byte vào/ra, RSS đỉnh và mức tăng RSS, trạng thái và lỗi.
+- Bản ghi gắn với thread đang chạy bước: DB time được cộng qua sự kiện before/after_cursor_execute
+  của engine dùng chung; COPY qua kết nối psycopg2 thô và số dòng/byte được báo bằng record_io().
+  Số dòng lấy từ command status (cursor.rowcount) của lệnh ghi, không quét lại bảng bằng COUNT.
+- pipeline_run(giai đoạn): gom các bước của một lần chạy, cuối lần chạy ghi vào warehouse.pipeline_runs
+  và một file JSON, so sánh với lần chạy thành công trước của cùng giai đoạn để thấy ngay bước chậm đi.
+- RSS đỉnh là mức cao nhất của cả process tính đến cuối bước (các bước chạy song song dùng chung process).
+"""
+
+import json
+import numbers
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+import psutil
+from sqlalchemy import event, text
+from config import get_db_engine, TABLES, INSTRUMENTATION_CONFIG
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+RUNS_TABLE = TABLES['warehouse']['pipeline_runs']
+RECORD_COLUMNS = [
+    'run_id', 'stage', 'step', 'status', 'started_at', 'finished_at', 'wall_seconds', 'db_seconds',
+    'statements', 'rows_in', 'rows_out', 'bytes_in', 'bytes_out', 'peak_rss_mb', 'rss_delta_mb', 'error'
+]
+MB = 1024 * 1024
+
+_local = threading.local()
+_run_lock = threading.Lock()
+_active_run = None
+_timed_engines = set()
+_process = psutil.Process()
+
+# BỘ NHỚ
+def rss_mb():
+    return _process.memory_info().rss / MB
+
+def peak_rss_mb():
+    """RSS cao nhất của process tính đến hiện tại (Windows: peak_wset, Unix: ru_maxrss)"""
+    info = _process.memory_info()
+    if hasattr(info, 'peak_wset'):
+        return info.peak_wset / MB
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux trả về KB, macOS trả về byte
+        return max_rss / MB if sys.platform == 'darwin' else max_rss / 1024
+    return info.rss / MB
+
+# DB TIME
+def install_db_timing(engine):
+    """Đăng ký đo thời gian từng câu lệnh trên engine (một lần cho mỗi engine)"""
+    with _run_lock:
+        if id(engine) in _timed_engines:
+            return
+        _timed_engines.add(id(engine))
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info['query_start'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop('query_start', None)
+        if start is not None:
+            record_io(db_seconds=time.perf_counter() - start, statements=1)
+
+    @event.listens_for(engine, 'handle_error')
+    def _on_error(exception_context):
+        conn = exception_context.connection
+        start = conn.info.pop('query_start', None) if conn is not None else None
+        if start is not None:
+            record_io(db_seconds=time.perf_counter() - start, statements=1)
+
+# BẢN GHI TỪNG BƯỚC
+def current_record():
+    """Bản ghi của bước đang chạy trên thread hiện tại (None nếu không có)"""
+    return getattr(_local, 'record', None)
+
+def record_io(rows_in=None, rows_out=None, bytes_in=0, bytes_out=0, db_seconds=0.0, statements=0):
+    """Cộng số dòng/byte/DB time vào bước đang chạy trên thread hiện tại (không có bước -> bỏ qua)"""
+    record = current_record()
+    if record is None:
+        return
+    if rows_in is not None:
+        record['rows_in'] = (record['rows_in'] or 0) + int(rows_in)
+    if rows_out is not None:
+        record['rows_out'] = (record['rows_out'] or 0) + int(rows_out)
+    record['bytes_in'] += int(bytes_in)
+    record['bytes_out'] += int(bytes_out)
+    record['db_seconds'] += db_seconds
+    record['statements'] += statements
+
+def record_result(result):
+    """Bước chưa báo số dòng ra -> dùng giá trị trả về (số dòng) của hàm dựng bảng"""
+    record = current_record()
+    if record is not None and record['rows_out'] is None \
+            and isinstance(result, numbers.Integral) and not isinstance(result, bool):
+        record['rows_out'] = int(result)
+
+@contextmanager
+def track_step(step, stage=None):
+    """
+    Đo một bước. Lỗi được ghi vào bản ghi (status='failed', error) rồi ném tiếp, không bị nuốt thành 0 dòng.
+    Bản ghi được thêm vào lần chạy đang mở (pipeline_run) nếu có.
+    """
+    install_db_timing(get_db_engine())
+    run = _active_run
+    record = {
+        'run_id': run['run_id'] if run else None,
+        'stage': stage or (run['stage'] if run else None),
+        'step': step, 'status': 'running', 'started_at': datetime.now(), 'finished_at': None,
+        'wall_seconds': 0.0, 'db_seconds': 0.0, 'statements': 0, 'rows_in': None, 'rows_out': None,
+        'bytes_in': 0, 'bytes_out': 0, 'peak_rss_mb': None, 'rss_delta_mb': None, 'error': None
+    }
+    previous = current_record()
+    _local.record = record
+    rss_start = rss_mb()
+    start = time.perf_counter()
+    try:
+        yield record
+        record['status'] = 'success'
+    except BaseException as e:
+        record['status'] = 'failed'
+        record['error'] = f"{type(e).__name__}: {e}"[:2000]
+        raise
+    finally:
+        record['wall_seconds'] = time.perf_counter() - start
+        record['finished_at'] = datetime.now()
+        record['peak_rss_mb'] = peak_rss_mb()
+        record['rss_delta_mb'] = rss_mb() - rss_start
+        _local.record = previous
+        if run is not None:
+            with _run_lock:
+                run['records'].append(record)
+
+def run_tracked(step, func, *args, stage=None, **kwargs):
+    """Chạy func(*args, **kwargs) trong track_step, lấy số dòng ra từ giá trị trả về nếu bước chưa báo"""
+    with track_step(step, stage):
+        result = func(*args, **kwargs)
+        record_result(result)
+        return result
+
+# SỔ GHI CÁC LẦN CHẠY
+def ensure_runs_table(conn):
+    conn.execute(text(f"""
+    CREATE TABLE IF NOT EXISTS {RUNS_TABLE} (
+        run_id TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        step TEXT NOT NULL,
+        status TEXT NOT NULL,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP,
+        wall_seconds DOUBLE PRECISION,
+        db_seconds DOUBLE PRECISION,
+        statements INTEGER,
+        rows_in BIGINT,
+        rows_out BIGINT,
+        bytes_in BIGINT,
+        bytes_out BIGINT,
+        peak_rss_mb DOUBLE PRECISION,
+        rss_delta_mb DOUBLE PRECISION,
+        error TEXT,
+        PRIMARY KEY (run_id, step)
+    );
+    CREATE INDEX IF NOT EXISTS pipeline_runs_stage_started_idx ON {RUNS_TABLE} (stage, started_at);
+    """))
+
+def previous_step_seconds(conn, stage, run_id):
+    """Wall time từng bước của lần chạy gần nhất (khác run_id) mà mọi bước đều thành công"""
+    previous_run = conn.execute(text(f"""
+        SELECT run_id FROM {RUNS_TABLE}
+        WHERE stage = :stage AND run_id <> :run_id
+        GROUP BY run_id
+        HAVING bool_and(status = 'success')
+        ORDER BY MIN(started_at) DESC
+        LIMIT 1
+    """), {'stage': stage, 'run_id': run_id}).scalar()
+    if previous_run is None:
+        return None, {}
+    rows = conn.execute(text(f"SELECT step, wall_seconds FROM {RUNS_TABLE} WHERE run_id = :run_id"),
+                        {'run_id': previous_run})
+    return previous_run, {step: seconds for step, seconds in rows}
+
+def find_regressions(records, previous, cfg=None):
+    """Các bước chậm hơn lần chạy trước quá regression_ratio lần (và quá regression_min_seconds giây)"""
+    cfg = cfg or INSTRUMENTATION_CONFIG
+    regressions = []
+    for r in records:
+        before = previous.get(r['step'])
+        if before is None or r['status'] != 'success':
+            continue
+        if r['wall_seconds'] - before >= cfg['regression_min_seconds'] \
+                and r['wall_seconds'] > cfg['regression_ratio'] * before:
+            regressions.append({'step': r['step'], 'previous_seconds': before,
+                                'wall_seconds': r['wall_seconds'], 'ratio': r['wall_seconds'] / before})
+    return regressions
+
+def write_ledger(run):
+    """Ghi các bước của lần chạy vào warehouse.pipeline_runs, trả về (run_id trước đó, {bước: giây})"""
+    engine = get_db_engine()
+    with engine.begin() as conn:
+        ensure_runs_table(conn)
+        previous = previous_step_seconds(conn, run['stage'], run['run_id'])
+        if run['records']:
+            columns = ', '.join(RECORD_COLUMNS)
+            values = ', '.join(f":{c}" for c in RECORD_COLUMNS)
+            conn.execute(text(f"INSERT INTO {RUNS_TABLE} ({columns}) VALUES ({values})"),
+                         [{c: r[c] for c in RECORD_COLUMNS} for r in run['records']])
+    return previous
+
+def write_report(run, previous_run_id, regressions, report_dir=None):
+    """Ghi báo cáo JSON của lần chạy, trả về đường dẫn file"""
+    report_dir = report_dir or INSTRUMENTATION_CONFIG['report_dir']
+    os.makedirs(report_dir, exist_ok=True)
+    path = os.path.join(report_dir, f"{run['stage']}_{run['run_id']}.json")
+    report = {
+        'run_id': run['run_id'], 'stage': run['stage'], 'status': run['status'],
+        'started_at': run['started_at'], 'finished_at': run['finished_at'],
+        'wall_seconds': run['wall_seconds'], 'previous_run_id': previous_run_id,
+        'steps': [{c: r[c] for c in RECORD_COLUMNS} for r in run['records']],
+        'regressions': regressions
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+    os.replace(tmp_path, path)
+    return path
+
+def print_run_report(run, regressions):
+    """In bảng số liệu từng bước của lần chạy"""
+    print(f"\n  BÁO CÁO ĐO ĐẠC ({run['stage']} | run_id {run['run_id']} | {run['status'].upper()}):")
+    print(f"    {'Bước':30s} {'Wall':>8s} {'DB':>8s} {'Dòng vào':>12s} {'Dòng ra':>12s} "
+          f"{'MB ra':>8s} {'RSS đỉnh':>9s}  Trạng thái")
+    for r in sorted(run['records'], key=lambda r: r['started_at']):
+        rows_in = f"{r['rows_in']:,}" if r['rows_in'] is not None else '-'
+        rows_out = f"{r['rows_out']:,}" if r['rows_out'] is not None else '-'
+        print(f"    {r['step']:30s} {r['wall_seconds']:7.2f}s {r['db_seconds']:7.2f}s {rows_in:>12s} "
+              f"{rows_out:>12s} {r['bytes_out'] / MB:8.2f} {r['peak_rss_mb']:8.0f}M  {r['status'].upper()}"
+              + (f" ({r['error']})" if r['error'] else ''))
+    for reg in regressions:
+        print(f"    CHẬM ĐI: {reg['step']} {reg['previous_seconds']:.2f}s -> {reg['wall_seconds']:.2f}s "
+              f"({reg['ratio']:.2f}x)")
+
+@contextmanager
+def pipeline_run(stage):
+    """
+    Mở một lần chạy: các bước track_step bên trong (kể cả ở thread khác) được gom lại,
+    khi kết thúc ghi sổ + báo cáo JSON. Gọi lồng nhau -> dùng chung lần chạy ngoài cùng.
+    """
+    global _active_run
+    with _run_lock:
+        if _active_run is not None:
+            nested = _active_run
+        else:
+            nested = None
+            _active_run = {
+                'run_id': f"{datetime.now():%Y%m%dT%H%M%S}_{uuid.uuid4().hex[:6]}", 'stage': stage,
+                'status': 'running', 'started_at': datetime.now(), 'finished_at': None,
+                'wall_seconds': 0.0, 'records': []
+            }
+    if nested is not None:
+        yield nested
+        return
+
+    run = _active_run
+    start = time.perf_counter()
+    try:
+        yield run
+        run['status'] = 'failed' if any(r['status'] == 'failed' for r in run['records']) else 'success'
+    except BaseException:
+        run['status'] = 'failed'
+        raise
+    finally:
+        run['wall_seconds'] = time.perf_counter() - start
+        run['finished_at'] = datetime.now()
+        with _run_lock:
+            _active_run = None
+        finish_run(run)
+
+def finish_run(run):
+    """Ghi sổ + báo cáo; lỗi khi ghi sổ chỉ được in ra để không che lỗi thật của pipeline"""
+    previous_run_id, previous = None, {}
+    if INSTRUMENTATION_CONFIG['write_ledger']:
+        try:
+            previous_run_id, previous = write_ledger(run)
+        except Exception as e:
+            print(f"  Không ghi được sổ {RUNS_TABLE}: {e}")
+    regressions = find_regressions(run['records'], previous)
+    print_run_report(run, regressions)
+    path = write_report(run, previous_run_id, regressions)
+    print(f"  Báo cáo: {path}")
@@ -0,0 +1,254 @@
+"""
+Bộ lọc đánh giá thấp do lỗi Vận chuyển (logistics bias)
+- identify_logistics_bias(row): hàm gốc từ notebook (xử lý từng dòng), giữ lại làm chuẩn đối chiếu.
+- flag_logistics_bias(df): bản vector hóa cho kết quả giống hệt hàm gốc:
+  so sánh ngày trên cả cột, tìm từ khóa bằng một regex alternation chạy trong pyarrow.compute (RE2, mã C)
+  trên cả cột comment -> không có vòng lặp Python theo từng comment (comment thực tế hầu hết là duy nhất).
+- logistics_bias_sql(): cùng logic dưới dạng biểu thức SQL (regex PostgreSQL dựng từ cùng bộ từ khóa),
+  dùng khi tính đặc trưng Seller ngay trong Database.
+- benchmark_logistics_bias(): so sánh hai cách, kiểm tra kết quả khớp và mức tăng tốc.
+"""
+
+import re
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Bộ từ khóa liên quan đến Vận chuyển (Shipper/Delivery)
+SHIPPING_KEYWORDS = [
+    'atras', 'demor', 'entreg', 'correio', 'transport', 'aguard',
+    'não receb', 'nao receb', 'não cheg', 'nao cheg', 'extravi', 'prazo'
+]
+
+# Bộ từ khóa liên quan đến Hư hỏng ngoại quan (Damage)
+DAMAGE_KEYWORDS = [
+    'danifi', 'quebr', 'amass', 'rasg', 'molha', 'abert', 'viola', 'caixa',
+    'embalagem', 'avaria'
+]
+
+def re2_keyword_pattern(keywords):
+    """Regex RE2 (tìm chuỗi con, giống toán tử `in` của hàm gốc) cho danh sách từ khóa"""
+    return '|'.join(re.sub(r'([^\w\s])', r'\\\1', kw) for kw in keywords)
+
+SHIPPING_PATTERN = re2_keyword_pattern(SHIPPING_KEYWORDS)
+DAMAGE_PATTERN = re2_keyword_pattern(DAMAGE_KEYWORDS)
+
+def pg_keyword_pattern(keywords):
+    """Regex PostgreSQL (tìm chuỗi con) cho danh sách từ khóa, thoát các ký tự đặc biệt và dấu nháy"""
+    escaped = (re.sub(r'([^\w\s])', r'\\\1', kw) for kw in keywords)
+    return '|'.join(escaped).replace("'", "''")
+
+def logistics_bias_sql(score='review_score', comment='review_comment_message',
+                       carrier='order_delivered_carrier_date', limit='shipping_limit_date',
+                       customer='order_delivered_customer_date', estimated='order_estimated_delivery_date'):
+    """
+    Biểu thức SQL (boolean, không bao giờ NULL) tương đương flag_logistics_bias.
+    Các tham số là biểu thức cột trong câu truy vấn (vd: 'r.review_score').
+    """
+    text_expr = f"lower(COALESCE({comment}, ''))"
+    seller_innocent = f"COALESCE({carrier} <= {limit}, false)"
+    carrier_late = f"COALESCE({customer} > {estimated}, false)"
+    return f"""(
+        NOT COALESCE({score} > 3, false) AND (
+            ({text_expr} ~ '{pg_keyword_pattern(SHIPPING_KEYWORDS)}' AND {carrier_late} AND {seller_innocent})
+            OR {text_expr} ~ '{pg_keyword_pattern(DAMAGE_KEYWORDS)}'
+            OR (COALESCE({comment}, '') = '' AND {carrier_late} AND {seller_innocent})
+        )
+    )"""
+
+def identify_logistics_bias(row):
+    """
+    Hàm trả về True nếu đánh giá thấp là do lỗi Vận chuyển (để loại bỏ).
+    """
+    # Chỉ xét các review tiêu cực (<= 3 sao)
+    if row['review_score'] > 3:
+        return False
+
+    # Chuẩn hóa text (lowercase)
+    comment = str(row['review_comment_message']).lower() if row['review_comment_message'] else ""
+
+    #  1. LOGIC THỜI GIAN
+    # Shipper giao trễ cho khách
+    seller_innocent = row['order_delivered_carrier_date'] <= row['shipping_limit_date']
+    carrier_late = row['order_delivered_customer_date'] > row['order_estimated_delivery_date']
+
+    is_time_fault = carrier_late and seller_innocent
+
+    # 2. LOGIC NLP
+
+    # Bộ từ khóa liên quan đến Vận chuyển (Shipper/Delivery)
+    keywords_shipping = [
+        'atras', 'demor', 'entreg', 'correio', 'transport', 'aguard',
+        'não receb', 'nao receb', 'não cheg', 'nao cheg', 'extravi','prazo'
+    ]
+
+    # Bộ từ khóa liên quan đến Hư hỏng ngoại quan (Damage)
+    keywords_damage = [
+        'danifi', 'quebr', 'amass', 'rasg', 'molha', 'abert', 'viola', 'caixa',
+        'embalagem', 'avaria'
+    ]
+
+    # Kiểm tra xem comment có chứa từ khóa không
+    has_shipping_complaint = any(kw in comment for kw in keywords_shipping)
+    has_damage_complaint = any(kw in comment for kw in keywords_damage)
+
+    # 3. QUYẾT ĐỊNH CUỐI CÙNG
+
+    # TH1: Khách chê giao chậm VÀ Thực tế có giao chậm -> Lỗi Logistics
+    if has_shipping_complaint and is_time_fault:
+        return True
+
+    # TH2: Khách chê hàng nát/móp (thường do vận chuyển) -> Lỗi Logistics
+    if has_damage_complaint:
+        return True
+
+    # TH3: Chỉ có Logic thời gian mà KHÔNG có comment (Khách vote 1 sao không lời)
+    # -> Nếu giao trễ-> Coi là lỗi Logistics
+    days_late = (row['order_delivered_customer_date'] - row['order_estimated_delivery_date']).total_seconds() / 86400
+    if comment == "" and days_late > 0 and seller_innocent:
+        return True
+
+    return False
+
+def normalize_comments(comments):
+    """
+    Chuẩn hóa comment giống hàm gốc: giá trị "falsy" (None, '') -> '', còn lại str(x).lower().
+    Chữ thường được tính bằng pyarrow (mã C); None/NaN thành null. NaN là truthy trong hàm gốc
+    (thành 'nan': không chứa từ khóa nào, không phải comment rỗng) nên chỉ cần phân biệt khi xét comment rỗng.
+    :param comments: mảng object (numpy) các comment
+    Trả về (mảng chuỗi pyarrow, mảng bool "không có comment").
+    """
+    values = np.asarray(comments, dtype=object)
+    try:
+        text = pc.utf8_lower(pa.array(values, type=pa.string(), from_pandas=True))
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Có giá trị không phải chuỗi (số...) -> str(x) như hàm gốc
+        text = pa.array([str(x).lower() if x else '' for x in values], type=pa.string())
+
+    no_comment = pc.equal(text, '').fill_null(False).to_numpy(zero_copy_only=False)
+    missing = text.is_null().to_numpy(zero_copy_only=False)
+    if missing.any():
+        no_comment = no_comment.copy()
+        no_comment[missing] = values[missing] == None  # so sánh từng phần tử: None -> rỗng, NaN -> 'nan'
+    return text, no_comment
+
+def match_keywords(text, pattern):
+    """Tìm từ khóa trên cả mảng comment bằng RE2 của pyarrow (không lặp Python theo từng giá trị)"""
+    return pc.match_substring_regex(text, pattern).fill_null(False).to_numpy(zero_copy_only=False)
+
+def flag_logistics_bias(df):
+    """
+    Bản vector hóa của identify_logistics_bias, trả về Series bool cùng index với df.
+    So sánh có NaT cho kết quả False, review_score NaN không được coi là > 3 (giống hàm gốc).
+    Comment chỉ được chuẩn hóa/tìm từ khóa trên các review tiêu cực (các dòng khác không bao giờ bị gắn cờ),
+    từ khóa vận chuyển chỉ tìm trên các dòng có lỗi thời gian.
+    """
+    if df.empty:
+        return pd.Series(False, index=df.index, dtype=bool)
+
+    negative = ~(df['review_score'] > 3).to_numpy()
+    carrier = df['order_delivered_carrier_date']
+    customer = df['order_delivered_customer_date']
+
+    seller_innocent = (carrier <= df['shipping_limit_date']).to_numpy()
+    # days_late > 0 tương đương giao cho khách sau ngày dự kiến (NaT -> NaN -> False)
+    carrier_late = (customer > df['order_estimated_delivery_date']).to_numpy()
+    is_time_fault = carrier_late & seller_innocent
+
+    rows = np.flatnonzero(negative)
+    text, no_comment = normalize_comments(df['review_comment_message'].to_numpy(dtype=object)[rows])
+    time_fault = is_time_fault[rows]
+    has_shipping = np.zeros(len(rows), dtype=bool)
+    has_shipping[time_fault] = match_keywords(text.filter(pa.array(time_fault)), SHIPPING_PATTERN)
+    has_damage = match_keywords(text, DAMAGE_PATTERN)
+
+    flags = np.zeros(len(df), dtype=bool)
+    flags[rows] = (
+        has_shipping
+        | has_damage
+        | (no_comment & carrier_late[rows] & seller_innocent[rows])
+    )
+    return pd.Series(flags, index=df.index)
+
+# SO SÁNH HIỆU NĂNG
+# Từ vựng để ghép comment giả lập: từ chứa từ khóa vận chuyển/hư hỏng lẫn với từ trung tính
+SYNTHETIC_VOCABULARY = np.array([
+    'produto', 'chegou', 'atrasado', 'entrega', 'entregue', 'correios', 'transportadora', 'aguardando',
+    'não', 'recebi', 'nao', 'chegou', 'extraviado', 'prazo', 'danificado', 'quebrado', 'amassada',
+    'rasgada', 'molhado', 'aberta', 'violada', 'caixa', 'embalagem', 'avariado', 'ótimo', 'vendedor',
+    'recomendo', 'rápida', 'bom', 'ruim', 'qualidade', 'péssimo', 'defeito', 'veio', 'errado', 'cor',
+    'tamanho', 'pedido', 'compra', 'loja', 'antes', 'depois', 'dias', 'semanas', 'ainda', 'muito',
+    'pouco', 'gostei', 'adorei', 'devolver', 'troca', 'atendimento', 'site', 'lannister', 'excelente',
+    'Produto', 'ATRASADO', 'Não', 'Veio', 'Quebrado!!', 'ok', ':(', '10/10', 'R$', 'e', 'o', 'a', 'com'
+], dtype=object)
+
+def generate_synthetic_comments(n_rows, rng, empty_rate=0.6):
+    """
+    Comment giả lập gần với review thật: phần lớn rỗng (None/NaN/''), số còn lại ghép ngẫu nhiên
+    3-30 từ nên gần như không trùng nhau (không để việc khử trùng lặp làm thay phần tìm từ khóa).
+    """
+    comments = np.empty(n_rows, dtype=object)
+    empty = rng.random(n_rows) < empty_rate
+    comments[empty] = np.array([None, np.nan, ''], dtype=object)[rng.integers(0, 3, int(empty.sum()))]
+
+    lengths = rng.integers(3, 31, int((~empty).sum()))
+    words = SYNTHETIC_VOCABULARY[rng.integers(0, len(SYNTHETIC_VOCABULARY), int(lengths.sum()))]
+    comments[~empty] = [' '.join(w) for w in np.split(words, np.cumsum(lengths)[:-1])]
+    return comments
+
+def generate_synthetic_reviews(n_rows=200_000, seed=42):
+    """Sinh dữ liệu review + mốc thời gian giả lập, gồm cả các trường hợp biên (None, NaN, NaT, chữ hoa)"""
+    rng = np.random.default_rng(seed)
+    day = 86_400 * 10**9
+    base = pd.Timestamp('2017-01-01').value + rng.integers(0, 600 * day, n_rows)
+
+    def dates(offset_days, missing_rate):
+        values = base + rng.integers(0, offset_days * day, n_rows)
+        values = np.where(rng.random(n_rows) < missing_rate, np.iinfo(np.int64).min, values)
+        return pd.to_datetime(values)
+
+    scores = rng.choice([1, 2, 3, 4, 5], n_rows, p=[0.15, 0.05, 0.1, 0.2, 0.5]).astype(float)
+    scores[rng.random(n_rows) < 0.02] = np.nan
+
+    return pd.DataFrame({
+        'review_score': scores,
+        'review_comment_message': generate_synthetic_comments(n_rows, rng),
+        'order_delivered_carrier_date': dates(6, 0.02),
+        'shipping_limit_date': dates(6, 0.0),
+        'order_delivered_customer_date': dates(30, 0.03),
+        'order_estimated_delivery_date': dates(30, 0.0)
+    })
+
+def benchmark_logistics_bias(df=None, n_rows=200_000, min_speedup=20):
+    """
+    Chạy hàm gốc (apply từng dòng) và bản vector hóa trên cùng dữ liệu.
+    Báo lỗi nếu kết quả khác nhau hoặc tăng tốc thấp hơn min_speedup lần.
+    """
+    df = generate_synthetic_reviews(n_rows) if df is None else df
+    unique = df['review_comment_message'].nunique()
+    print(f"BENCHMARK LỌC LOGISTICS BIAS ({len(df):,} dòng, {unique:,} comment khác nhau)")
+
+    start = time.perf_counter()
+    reference = df.apply(identify_logistics_bias, axis=1).astype(bool)
+    apply_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectorized = flag_logistics_bias(df)
+    vector_seconds = time.perf_counter() - start
+
+    mismatches = int((reference != vectorized).sum())
+    speedup = apply_seconds / vector_seconds if vector_seconds > 0 else float('inf')
+    print(f"  apply từng dòng : {apply_seconds:8.3f}s")
+    print(f"  vector hóa      : {vector_seconds:8.3f}s")
+    print(f"  Tăng tốc        : {speedup:8.1f}x | Số dòng gắn cờ: {int(vectorized.sum()):,} | Lệch: {mismatches}")
+
+    if mismatches:
+        raise AssertionError(f"Bản vector hóa lệch {mismatches} dòng so với identify_logistics_bias")
+    if speedup < min_speedup:
+        raise AssertionError(f"Tăng tốc {speedup:.1f}x thấp hơn yêu cầu {min_speedup}x")
+    return {'apply_seconds': apply_seconds, 'vectorized_seconds': vector_seconds, 'speedup': speedup}
+
+if __name__ == "__main__":
+    benchmark_logistics_bias()
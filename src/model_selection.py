@@ -0,0 +1,119 @@
+"""
+Chọn số cụm K cho KMeans (chuyển từ vòng lặp Elbow/Silhouette/DBI trong notebook)
+- Mỗi giá trị K được fit trong một process riêng (ProcessPoolExecutor) thay vì lần lượt.
+- Silhouette (O(n²)) được tính trên mẫu phân tầng theo cụm ('sample') hoặc trên toàn bộ dữ liệu
+  theo từng khối ma trận khoảng cách ('chunked') để bộ nhớ luôn bị giới hạn.
+- Kết quả được cache theo hash của ma trận đặc trưng + tham số: chạy lại trên cùng dữ liệu trả về ngay.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.cluster import KMeans
+from sklearn.metrics import silhouette_score, davies_bouldin_score
+from config import MODEL_SELECTION_CONFIG
+
+METRIC_COLUMNS = ['k', 'inertia', 'silhouette', 'davies_bouldin', 'silhouette_rows', 'fit_seconds']
+
+def stratified_sample(labels, sample_size, random_state=42):
+    """Chỉ số mẫu giữ nguyên tỷ lệ từng cụm (mỗi cụm ít nhất 2 phần tử nếu có)"""
+    n = len(labels)
+    if n <= sample_size:
+        return np.arange(n)
+    rng = np.random.default_rng(random_state)
+    picked = []
+    for cluster in np.unique(labels):
+        members = np.flatnonzero(labels == cluster)
+        take = min(len(members), max(2, int(round(sample_size * len(members) / n))))
+        picked.append(rng.choice(members, take, replace=False))
+    return np.sort(np.concatenate(picked))
+
+def compute_silhouette(X, labels, cfg):
+    """Silhouette theo silhouette_mode; trả về (điểm, số dòng đã dùng)"""
+    if cfg['silhouette_mode'] == 'sample':
+        idx = stratified_sample(labels, cfg['sample_size'], cfg['random_state'])
+        X, labels = X[idx], labels[idx]
+    elif cfg['silhouette_mode'] != 'chunked':
+        raise ValueError(f"silhouette_mode không hợp lệ: {cfg['silhouette_mode']}")
+    # silhouette_score tính khoảng cách theo khối (pairwise_distances_chunked) với giới hạn working_memory
+    with sklearn.config_context(working_memory=cfg['working_memory_mb']):
+        return silhouette_score(X, labels), len(X)
+
+def evaluate_k(X, k, cfg):
+    """Fit KMeans với một giá trị K và tính inertia, Silhouette, Davies-Bouldin (chạy trong process con)"""
+    start = time.perf_counter()
+    model = KMeans(n_clusters=k, init='k-means++', n_init=cfg['n_init'],
+                   random_state=cfg['random_state']).fit(X)
+    silhouette, silhouette_rows = compute_silhouette(X, model.labels_, cfg)
+    return {
+        'k': k,
+        'inertia': float(model.inertia_),
+        'silhouette': float(silhouette),
+        'davies_bouldin': float(davies_bouldin_score(X, model.labels_)),
+        'silhouette_rows': silhouette_rows,
+        'fit_seconds': time.perf_counter() - start
+    }
+
+def cache_key(X, cfg):
+    """Hash của ma trận đặc trưng và các tham số ảnh hưởng đến kết quả"""
+    params = {key: cfg[key] for key in ('k_range', 'n_init', 'random_state', 'silhouette_mode', 'sample_size')}
+    digest = hashlib.sha256()
+    digest.update(repr(X.shape).encode('utf-8'))
+    digest.update(np.ascontiguousarray(X).tobytes())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+def select_k(X, cfg=None, use_cache=True):
+    """
+    Đánh giá mọi K trong k_range song song, trả về bảng chỉ số (1 dòng / K) để chọn K bằng
+    Elbow (inertia), Silhouette (càng cao càng tốt) và Davies-Bouldin (càng thấp càng tốt).
+    """
+    cfg = {**MODEL_SELECTION_CONFIG, **(cfg or {})}
+    X = np.asarray(X, dtype=float)
+    k_values = list(range(cfg['k_range'][0], cfg['k_range'][1] + 1))
+
+    cache_path = os.path.join(cfg['cache_dir'], f"{cache_key(X, cfg)}.csv")
+    if use_cache and os.path.exists(cache_path):
+        print(f"  Dùng lại kết quả chọn K đã cache ({os.path.basename(cache_path)[:12]}...)")
+        return pd.read_csv(cache_path)
+
+    start = time.perf_counter()
+    workers = max(1, min(cfg['max_workers'], len(k_values)))
+    # 'spawn' thay vì fork: hàm có thể được gọi từ luồng của DAG, fork process đa luồng không an toàn
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        rows = list(executor.map(evaluate_k, [X] * len(k_values), k_values, [cfg] * len(k_values)))
+    metrics = pd.DataFrame(rows, columns=METRIC_COLUMNS).sort_values('k').reset_index(drop=True)
+    print(f"  Đã đánh giá K={k_values[0]}..{k_values[-1]} trên {len(X):,} dòng "
+          f"({workers} process, {time.perf_counter() - start:.2f}s)")
+
+    os.makedirs(cfg['cache_dir'], exist_ok=True)
+    tmp_path = f"{cache_path}.tmp"
+    metrics.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, cache_path)
+    return metrics
+
+def run_k_selection(features=None, use_cache=True):
+    """Chọn K cho mô hình chấm điểm trên 5 đặc trưng đã chuẩn hóa (mặc định đọc từ seller_scorecard)"""
+    from sklearn.preprocessing import StandardScaler
+    from seller_models import load_scoring_training_data
+    from seller_scoring import FEATURE_COLUMNS
+
+    print("CHỌN SỐ CỤM K (ELBOW / SILHOUETTE / DAVIES-BOULDIN)")
+    features = load_scoring_training_data() if features is None else features
+    X_scaled = StandardScaler().fit_transform(features[FEATURE_COLUMNS].to_numpy(dtype=float))
+    metrics = select_k(X_scaled, use_cache=use_cache)
+
+    print(metrics[['k', 'inertia', 'silhouette', 'davies_bouldin']].to_string(index=False))
+    best_silhouette = int(metrics.loc[metrics['silhouette'].idxmax(), 'k'])
+    best_dbi = int(metrics.loc[metrics['davies_bouldin'].idxmin(), 'k'])
+    print(f"  K tốt nhất theo Silhouette: {best_silhouette} | theo Davies-Bouldin: {best_dbi}")
+    return metrics
+
+if __name__ == "__main__":
+    run_k_selection()
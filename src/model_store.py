@@ -0,0 +1,101 @@
+"""
+Kho lưu mô hình đã huấn luyện (có phiên bản)
+- Mỗi mô hình (vd: 'seller_scoring', 'seller_personas') có nhiều phiên bản trong MODEL_STORE_DIR/<tên>/<phiên bản>/
+  gồm model.joblib (các đối tượng đã fit) và manifest.json (thời điểm, fingerprint dữ liệu huấn luyện,
+  thời gian huấn luyện, tham số, chỉ số).
+- Fingerprint của dữ liệu huấn luyện cho phép dùng lại mô hình cũ khi dữ liệu không đổi thay vì fit lại.
+"""
+
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+import joblib
+import pandas as pd
+from config import MODEL_STORE_DIR
+
+MANIFEST_FILE = 'manifest.json'
+MODEL_FILE = 'model.joblib'
+
+def fingerprint_frame(df):
+    """Hash nội dung DataFrame (giá trị + tên cột, không tính index)"""
+    digest = hashlib.sha256()
+    digest.update(repr(list(df.columns)).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def _model_dir(name, root=None):
+    return os.path.join(os.path.abspath(root or MODEL_STORE_DIR), name)
+
+def list_versions(name, root=None):
+    """Các phiên bản đã lưu của một mô hình, cũ -> mới"""
+    model_dir = _model_dir(name, root)
+    if not os.path.isdir(model_dir):
+        return []
+    return sorted(v for v in os.listdir(model_dir)
+                  if os.path.exists(os.path.join(model_dir, v, MANIFEST_FILE)))
+
+def save_artifact(name, objects, fingerprint, timings=None, params=None, metrics=None, root=None):
+    """
+    Lưu một phiên bản mới. Phiên bản = thời điểm lưu + 8 ký tự đầu fingerprint.
+    Ghi vào thư mục tạm rồi đổi tên để không bao giờ để lại phiên bản dở dang.
+    Trả về manifest.
+    """
+    created_at = datetime.now()
+    version = f"{created_at:%Y%m%d_%H%M%S}_{fingerprint[:8]}"
+    model_dir = _model_dir(name, root)
+    final_dir = os.path.join(model_dir, version)
+    tmp_dir = f"{final_dir}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    manifest = {
+        'name': name,
+        'version': version,
+        'created_at': created_at.isoformat(timespec='seconds'),
+        'fingerprint': fingerprint,
+        'timings': timings or {},
+        'params': params or {},
+        'metrics': metrics or {}
+    }
+    joblib.dump(objects, os.path.join(tmp_dir, MODEL_FILE), compress=3)
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, default=str)
+    os.replace(tmp_dir, final_dir)
+    return manifest
+
+def load_manifest(name, version=None, root=None):
+    """Manifest của một phiên bản (mặc định: mới nhất); None nếu chưa có phiên bản nào"""
+    versions = list_versions(name, root)
+    if not versions:
+        return None
+    version = version or versions[-1]
+    with open(os.path.join(_model_dir(name, root), version, MANIFEST_FILE), encoding='utf-8') as f:
+        return json.load(f)
+
+def load_artifact(name, version=None, root=None):
+    """Nạp (objects, manifest) của một phiên bản (mặc định: mới nhất)"""
+    manifest = load_manifest(name, version, root)
+    if manifest is None:
+        raise FileNotFoundError(f"Chưa có mô hình '{name}' trong {_model_dir(name, root)}")
+    objects = joblib.load(os.path.join(_model_dir(name, root), manifest['version'], MODEL_FILE))
+    return objects, manifest
+
+def get_or_train(name, training_data, train_fn, force=False, root=None):
+    """
+    Dùng lại phiên bản mới nhất nếu fingerprint dữ liệu huấn luyện không đổi, ngược lại huấn luyện và lưu mới.
+    train_fn(training_data) phải trả về (objects, params, metrics).
+    """
+    fingerprint = fingerprint_frame(training_data)
+    manifest = load_manifest(name, root=root)
+    if not force and manifest is not None and manifest['fingerprint'] == fingerprint:
+        print(f"  Dùng lại mô hình {name} phiên bản {manifest['version']} (dữ liệu không đổi)")
+        return load_artifact(name, manifest['version'], root)
+
+    start = time.perf_counter()
+    objects, params, metrics = train_fn(training_data)
+    timings = {'train_seconds': time.perf_counter() - start, 'rows': len(training_data)}
+    manifest = save_artifact(name, objects, fingerprint, timings, params, metrics, root)
+    print(f"  Đã huấn luyện & lưu {name} phiên bản {manifest['version']} "
+          f"({timings['train_seconds']:.2f}s, {len(training_data):,} dòng)")
+    return objects, manifest
@@ -0,0 +1,158 @@
+"""
+Phân cụm chân dung Seller (persona) có thể mở rộng
+- 'ward': AgglomerativeClustering(linkage='ward') chính xác như notebook, tốn O(n²) bộ nhớ/thời gian.
+- 'minibatch_ward': MiniBatchKMeans gom Seller thành vài trăm micro-cluster, sau đó chạy Ward có trọng số
+  (trọng số = số Seller) trên các tâm micro-cluster -> chi phí Ward chỉ còn phụ thuộc số micro-cluster.
+- 'birch': cây CF của BIRCH thay cho MiniBatchKMeans ở bước gom, rồi cũng gộp bằng Ward có trọng số.
+Cả ba trả về cùng K=7 nhãn, được đánh số lại theo quy tắc cố định (nhóm đông nhất = 0) để nhãn ổn định giữa các lần chạy.
+benchmark_persona_clustering() đo thời gian và độ khớp (ARI/NMI) so với Ward chính xác.
+"""
+
+import time
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+from sklearn.cluster import AgglomerativeClustering, MiniBatchKMeans, Birch
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+from config import PERSONA_CONFIG
+
+METHODS = ('ward', 'minibatch_ward', 'birch')
+
+def weighted_ward(centers, weights, n_clusters):
+    """
+    Ward có trọng số trên các tâm: mỗi bước gộp cặp (a, b) có chi phí tăng phương sai nhỏ nhất
+    w_a * w_b / (w_a + w_b) * ||c_a - c_b||² (khi mọi trọng số = 1 chính là Ward thông thường).
+    Trả về nhãn cụm (0..K-1) của từng tâm; tâm có trọng số 0 nhận nhãn -1.
+    """
+    centers = np.asarray(centers, dtype=float).copy()
+    sizes = np.asarray(weights, dtype=float).copy()
+    occupied = sizes > 0
+    active = occupied.copy()
+    members = np.arange(len(centers))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pair_sizes = sizes[:, None] * sizes[None, :] / (sizes[:, None] + sizes[None, :])
+    cost = pair_sizes * ((centers[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+    cost[~active, :] = np.inf
+    cost[:, ~active] = np.inf
+    np.fill_diagonal(cost, np.inf)
+
+    for _ in range(int(active.sum()) - n_clusters):
+        a, b = np.unravel_index(cost.argmin(), cost.shape)
+        total = sizes[a] + sizes[b]
+        centers[a] = (sizes[a] * centers[a] + sizes[b] * centers[b]) / total
+        sizes[a], sizes[b] = total, 0.0
+        active[b] = False
+        members[members == b] = a
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            row = sizes[a] * sizes / (sizes[a] + sizes) * ((centers - centers[a]) ** 2).sum(axis=1)
+        row[~active] = np.inf
+        row[a] = np.inf
+        cost[a, :] = row
+        cost[:, a] = row
+        cost[b, :] = np.inf
+        cost[:, b] = np.inf
+
+    labels = np.full(len(centers), -1)
+    labels[occupied] = np.unique(members[occupied], return_inverse=True)[1]
+    return labels
+
+def canonical_labels(labels, X_scaled):
+    """Đánh số lại nhãn: nhóm đông Seller hơn đứng trước, hòa thì xét tâm theo đặc trưng đầu tiên"""
+    uniques, counts = np.unique(labels, return_counts=True)
+    first_feature = np.array([X_scaled[labels == u, 0].mean() for u in uniques])
+    order = np.lexsort((first_feature, -counts))
+    mapping = np.empty(uniques.max() + 1, dtype=int)
+    mapping[uniques[order]] = np.arange(len(uniques))
+    return mapping[labels]
+
+def _ward_labels(X_scaled, cfg):
+    return AgglomerativeClustering(n_clusters=cfg['n_clusters'], metric='euclidean',
+                                   linkage='ward').fit_predict(X_scaled)
+
+def _minibatch_ward_labels(X_scaled, cfg):
+    n_micro = min(cfg['n_micro_clusters'], len(X_scaled))
+    mbk = MiniBatchKMeans(n_clusters=n_micro, batch_size=cfg['batch_size'], n_init=3,
+                          random_state=cfg['random_state']).fit(X_scaled)
+    weights = np.bincount(mbk.labels_, minlength=n_micro)
+    return weighted_ward(mbk.cluster_centers_, weights, cfg['n_clusters'])[mbk.labels_]
+
+def _birch_labels(X_scaled, cfg):
+    birch = Birch(threshold=cfg['birch_threshold'], n_clusters=None).fit(X_scaled)
+    centers = birch.subcluster_centers_
+    weights = np.bincount(birch.labels_, minlength=len(centers))
+    return weighted_ward(centers, weights, cfg['n_clusters'])[birch.labels_]
+
+def cluster_personas(X_scaled, cfg=None, method=None):
+    """
+    Phân cụm ma trận đặc trưng chân dung đã chuẩn hóa, trả về nhãn 0..K-1 đã đánh số lại.
+    'ward' tự chuyển sang 'minibatch_ward' khi số Seller vượt cfg['exact_max_rows'].
+    """
+    cfg = {**PERSONA_CONFIG, **(cfg or {})}
+    method = method or cfg['method']
+    if method not in METHODS:
+        raise ValueError(f"Phương pháp phân cụm không hợp lệ: {method} (chọn một trong {METHODS})")
+    if method == 'ward' and len(X_scaled) > cfg['exact_max_rows']:
+        print(f"  {len(X_scaled):,} Seller > {cfg['exact_max_rows']:,}: chuyển từ 'ward' sang 'minibatch_ward'")
+        method = 'minibatch_ward'
+
+    labels = {'ward': _ward_labels, 'minibatch_ward': _minibatch_ward_labels,
+              'birch': _birch_labels}[method](X_scaled, cfg)
+    return canonical_labels(labels, X_scaled)
+
+# ĐỘ KHỚP & SO SÁNH HIỆU NĂNG
+def label_agreement(reference, candidate):
+    """ARI, NMI và tỷ lệ Seller cùng nhãn sau khi ghép nhãn tối ưu (Hungarian) giữa hai cách phân cụm"""
+    contingency = pd.crosstab(reference, candidate).to_numpy()
+    rows, cols = linear_sum_assignment(-contingency)
+    return {
+        'ari': adjusted_rand_score(reference, candidate),
+        'nmi': normalized_mutual_info_score(reference, candidate),
+        'matched_share': contingency[rows, cols].sum() / len(reference)
+    }
+
+def upsample_features(X_scaled, scale, seed=42, noise=0.05):
+    """Nhân bản dữ liệu (kèm nhiễu nhỏ) để mô phỏng số Seller lớn hơn hiện tại"""
+    if scale <= 1:
+        return X_scaled
+    rng = np.random.default_rng(seed)
+    repeated = np.repeat(X_scaled, int(scale), axis=0)
+    return repeated + rng.normal(0, noise, repeated.shape)
+
+def benchmark_persona_clustering(X_scaled=None, scale=1, methods=METHODS):
+    """
+    Chạy các phương pháp trên cùng dữ liệu (mặc định: đặc trưng chân dung hiện tại trong Database),
+    báo thời gian và độ khớp so với Ward chính xác (Ward bị bỏ qua nếu vượt exact_max_rows).
+    """
+    if X_scaled is None:
+        from sklearn.preprocessing import StandardScaler
+        from seller_models import load_persona_training_data, persona_matrix
+        X_scaled = StandardScaler().fit_transform(persona_matrix(load_persona_training_data()))
+    X_scaled = upsample_features(X_scaled, scale)
+    print(f"BENCHMARK PHÂN CỤM CHÂN DUNG ({len(X_scaled):,} Seller, K={PERSONA_CONFIG['n_clusters']})")
+
+    results, reference = [], None
+    for method in methods:
+        if method == 'ward' and len(X_scaled) > PERSONA_CONFIG['exact_max_rows']:
+            print(f"  {method:<15}: bỏ qua (vượt {PERSONA_CONFIG['exact_max_rows']:,} Seller)")
+            continue
+        start = time.perf_counter()
+        labels = cluster_personas(X_scaled, method=method)
+        seconds = time.perf_counter() - start
+        if method == 'ward':
+            reference = labels
+
+        row = {'method': method, 'seconds': seconds, 'clusters': len(np.unique(labels))}
+        if reference is not None:
+            row.update(label_agreement(reference, labels))
+        results.append(row)
+
+        agreement = (f" | ARI {row['ari']:.3f} | NMI {row['nmi']:.3f} | khớp {row['matched_share']:.1%}"
+                     if 'ari' in row else '')
+        print(f"  {method:<15}: {seconds:8.3f}s{agreement}")
+
+    return pd.DataFrame(results)
+
+if __name__ == "__main__":
+    benchmark_persona_clustering()
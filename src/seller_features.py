@@ -0,0 +1,255 @@
+"""
+Feature store Seller: bảng warehouse.seller_features (1 dòng / Seller / ngày snapshot)
+- Tính hoàn toàn trong SQL từ fact_order_items + fact_orders + reviews_cleaned (cùng phép join với
+  seller_evaluation): ngày bán đầu/cuối, recency, tenure, số đơn, GMV, rating đã bỏ review lỗi vận chuyển
+  (regex PostgreSQL dựng từ bộ từ khóa của logistics_bias), tỷ lệ giao Carrier trễ, median giờ chuẩn bị hàng,
+  cờ Seller "ma" theo SELLER_SCORING_CONFIG.
+- Snapshot = ngày mua hàng lớn nhất trên toàn sàn (giống get_snapshot_date của seller_scoring).
+- Tăng dần: chỉ tính lại các Seller có order/order item trong nhật ký thay đổi (etl_order_changes);
+  Seller còn lại được chép từ snapshot trước và chỉ tính lại recency/tenure/cờ "ma" theo mốc mới.
+  Thay đổi của riêng bảng review (không đi qua Fact) chỉ được cập nhật ở lần dựng lại toàn bộ.
+"""
+
+from datetime import datetime
+import pandas as pd
+from sqlalchemy import text
+import config
+from config import get_db_engine, TABLES, SELLER_SCORING_CONFIG
+from logistics_bias import logistics_bias_sql
+from incremental import (
+    CHANGE_LOG_TABLE, get_watermark, get_watermark_updated_at, set_watermark
+)
+
+FEATURES_TABLE = TABLES['warehouse']['seller_features']
+# Nếu một trong các bảng Fact này vừa dựng lại toàn bộ thì feature store cũng dựng lại snapshot hiện tại
+SOURCE_FACTS = ['warehouse.fact_orders', 'warehouse.fact_order_items']
+
+FEATURE_STORE_COLUMNS = [
+    'snapshot_date', 'seller_id', 'snapshot_ts', 'first_sale_date', 'last_sale_date',
+    'recency_days', 'tenure_days', 'is_ghost', 'total_orders', 'gmv', 'rated_items', 'avg_rating',
+    'shipped_items', 'late_shipment_rate', 'avg_prep_time_hours'
+]
+
+# Dữ liệu cấp order item (giống warehouse.seller_evaluation), có thể lọc theo Seller
+SELLER_ITEMS_SQL = """
+    SELECT
+        oi.seller_id,
+        oi.order_id,
+        oi.price,
+        fo.order_purchase_timestamp,
+        fo.order_approved_at,
+        fo.order_delivered_carrier_date,
+        fo.order_delivered_customer_date,
+        fo.order_estimated_delivery_date,
+        oi.shipping_limit_date,
+        r.review_score,
+        r.review_comment_message
+    FROM warehouse.fact_order_items oi
+    JOIN warehouse.fact_orders fo ON oi.order_id = fo.order_id
+    LEFT JOIN staging.reviews_cleaned r ON fo.order_id = r.order_id
+    WHERE fo.order_status IS NOT NULL {seller_filter}
+"""
+
+def derived_columns_sql(cfg=None):
+    """recency_days, tenure_days, is_ghost tính từ :snapshot_ts và ngày bán đầu/cuối (cùng quy tắc filter_ghost_sellers)"""
+    cfg = cfg or SELLER_SCORING_CONFIG
+    recency = "FLOOR(EXTRACT(EPOCH FROM (:snapshot_ts - last_sale_date)) / 86400)::int"
+    tenure = "FLOOR(EXTRACT(EPOCH FROM (:snapshot_ts - first_sale_date)) / 86400)::int"
+    ghost = (f"({tenure} > {cfg['new_seller_days']} AND "
+             f"({recency} > {cfg['inactive_days']} OR total_orders < {cfg['min_orders']}))")
+    return {'recency_days': recency, 'tenure_days': tenure, 'is_ghost': ghost}
+
+def features_insert_sql(seller_filter=''):
+    """INSERT đặc trưng của snapshot :snapshot_date cho toàn bộ Seller (hoặc các Seller thỏa seller_filter)"""
+    derived = derived_columns_sql()
+    return f"""
+    INSERT INTO {FEATURES_TABLE} ({', '.join(FEATURE_STORE_COLUMNS)})
+    WITH items AS (
+        {SELLER_ITEMS_SQL.format(seller_filter=seller_filter)}
+    ),
+    flagged AS (
+        SELECT
+            seller_id,
+            order_id,
+            price,
+            order_purchase_timestamp,
+            CASE WHEN {logistics_bias_sql()} THEN NULL ELSE review_score END as adjusted_score,
+            (order_delivered_carrier_date IS NOT NULL AND order_approved_at IS NOT NULL) as shipped,
+            COALESCE(order_delivered_carrier_date > shipping_limit_date, false)::int as late,
+            GREATEST(EXTRACT(EPOCH FROM (order_delivered_carrier_date - order_approved_at)) / 3600, 0) as prep_hours
+        FROM items
+    ),
+    per_seller AS (
+        SELECT
+            seller_id,
+            MIN(order_purchase_timestamp) as first_sale_date,
+            MAX(order_purchase_timestamp) as last_sale_date,
+            COUNT(DISTINCT order_id) as total_orders,
+            COALESCE(SUM(price), 0) as gmv,
+            COUNT(adjusted_score) as rated_items,
+            AVG(adjusted_score) as avg_rating,
+            COUNT(*) FILTER (WHERE shipped) as shipped_items,
+            AVG(late) FILTER (WHERE shipped) as late_shipment_rate,
+            percentile_cont(0.5) WITHIN GROUP (ORDER BY prep_hours) FILTER (WHERE shipped) as avg_prep_time_hours
+        FROM flagged
+        GROUP BY seller_id
+    )
+    SELECT
+        :snapshot_date, seller_id, :snapshot_ts, first_sale_date, last_sale_date,
+        {derived['recency_days']}, {derived['tenure_days']}, {derived['is_ghost']},
+        total_orders, gmv, rated_items, avg_rating, shipped_items, late_shipment_rate, avg_prep_time_hours
+    FROM per_seller
+    """
+
+def ensure_features_table(conn):
+    conn.execute(text(f"""
+    CREATE TABLE IF NOT EXISTS {FEATURES_TABLE} (
+        snapshot_date DATE NOT NULL,
+        seller_id VARCHAR(100) NOT NULL,
+        snapshot_ts TIMESTAMP NOT NULL,
+        first_sale_date TIMESTAMP,
+        last_sale_date TIMESTAMP,
+        recency_days INTEGER,
+        tenure_days INTEGER,
+        is_ghost BOOLEAN NOT NULL,
+        total_orders INTEGER NOT NULL,
+        gmv DOUBLE PRECISION NOT NULL,
+        rated_items INTEGER NOT NULL,
+        avg_rating DOUBLE PRECISION,
+        shipped_items INTEGER NOT NULL,
+        late_shipment_rate DOUBLE PRECISION,
+        avg_prep_time_hours DOUBLE PRECISION,
+        updated_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (snapshot_date, seller_id)
+    );
+    CREATE INDEX IF NOT EXISTS seller_features_seller_idx ON {FEATURES_TABLE} (seller_id, snapshot_date);
+    """))
+
+def get_snapshot(conn):
+    """Mốc dữ liệu hiện tại: ngày mua hàng lớn nhất của các đơn có order item"""
+    snapshot_ts = conn.execute(text("""
+        SELECT MAX(fo.order_purchase_timestamp)
+        FROM warehouse.fact_orders fo
+        WHERE fo.order_status IS NOT NULL
+          AND EXISTS (SELECT 1 FROM warehouse.fact_order_items oi WHERE oi.order_id = fo.order_id)
+    """)).scalar()
+    return snapshot_ts
+
+# CẬP NHẬT
+def rebase_unchanged_sellers(conn, snapshot, previous_date):
+    """
+    Đưa các Seller không có thay đổi sang mốc snapshot mới: chép dòng của snapshot trước (khác ngày)
+    hoặc cập nhật tại chỗ (cùng ngày, khác giờ), tính lại recency/tenure/cờ "ma".
+    """
+    derived = derived_columns_sql()
+    if previous_date == snapshot['snapshot_date']:
+        return conn.execute(text(f"""
+            UPDATE {FEATURES_TABLE}
+            SET snapshot_ts = :snapshot_ts,
+                recency_days = {derived['recency_days']},
+                tenure_days = {derived['tenure_days']},
+                is_ghost = {derived['is_ghost']},
+                updated_at = now()
+            WHERE snapshot_date = :snapshot_date
+              AND snapshot_ts IS DISTINCT FROM :snapshot_ts
+              AND seller_id NOT IN (SELECT seller_id FROM feature_changes)
+        """), snapshot).rowcount
+
+    copied = [c for c in FEATURE_STORE_COLUMNS
+              if c not in ('snapshot_date', 'snapshot_ts', 'recency_days', 'tenure_days', 'is_ghost')]
+    return conn.execute(text(f"""
+        INSERT INTO {FEATURES_TABLE} (snapshot_date, snapshot_ts, recency_days, tenure_days, is_ghost,
+                                      {', '.join(copied)})
+        SELECT :snapshot_date, :snapshot_ts, {derived['recency_days']}, {derived['tenure_days']},
+               {derived['is_ghost']}, {', '.join(copied)}
+        FROM {FEATURES_TABLE}
+        WHERE snapshot_date = :previous_date
+          AND seller_id NOT IN (SELECT seller_id FROM feature_changes)
+    """), {**snapshot, 'previous_date': previous_date}).rowcount
+
+def refresh_seller_features(mode=None):
+    """
+    Cập nhật snapshot hiện tại của warehouse.seller_features.
+    - 'full': tính lại toàn bộ Seller cho snapshot hiện tại (các snapshot cũ được giữ nguyên).
+    - 'incremental': chỉ tính lại Seller trong nhật ký thay đổi kể từ lần chạy trước.
+      Tự động quay về 'full' nếu chưa có snapshot trước, Fact vừa dựng lại toàn bộ hoặc mốc dữ liệu lùi lại.
+    """
+    engine = get_db_engine()
+    with engine.begin() as conn:
+        ensure_features_table(conn)
+        watermark = get_watermark(conn, FEATURES_TABLE)
+        refreshed_at = get_watermark_updated_at(conn, FEATURES_TABLE)
+        rebuilt_at = [get_watermark_updated_at(conn, f"{fact}:full_rebuild") for fact in SOURCE_FACTS]
+        latest_change = conn.execute(text(f"SELECT MAX(changed_at) FROM {CHANGE_LOG_TABLE}")).scalar()
+        previous_date = conn.execute(text(f"SELECT MAX(snapshot_date) FROM {FEATURES_TABLE}")).scalar()
+        snapshot_ts = get_snapshot(conn)
+
+    if snapshot_ts is None:
+        print("   -> Chưa có đơn hàng, bỏ qua seller_features.")
+        return 0
+    snapshot = {'snapshot_date': snapshot_ts.date(), 'snapshot_ts': snapshot_ts}
+
+    needs_full = (
+        (mode or config.REFRESH_MODE) != 'incremental'
+        or watermark is None
+        or previous_date is None
+        or previous_date > snapshot['snapshot_date']
+        or any(r is not None and r > refreshed_at for r in rebuilt_at)
+    )
+
+    try:
+        with engine.begin() as conn:
+            if needs_full:
+                print(f"Đang tính seller_features (snapshot {snapshot['snapshot_date']})...")
+                conn.execute(text(f"DELETE FROM {FEATURES_TABLE} WHERE snapshot_date = :snapshot_date"), snapshot)
+                count = conn.execute(text(features_insert_sql()), snapshot).rowcount
+                print(f"   -> Hoàn tất. Snapshot {snapshot['snapshot_date']} có {count:,} Seller.")
+            else:
+                print(f"Đang cập nhật tăng dần seller_features (snapshot {snapshot['snapshot_date']})...")
+                conn.execute(text(f"""
+                    CREATE TEMP TABLE feature_changes ON COMMIT DROP AS
+                    SELECT seller_id FROM {CHANGE_LOG_TABLE}
+                    WHERE changed_at > :since AND changed_at <= :until AND seller_id IS NOT NULL
+                    UNION
+                    SELECT oi.seller_id
+                    FROM {CHANGE_LOG_TABLE} c
+                    JOIN warehouse.fact_order_items oi ON oi.order_id = c.order_id
+                    WHERE c.changed_at > :since AND c.changed_at <= :until
+                """), {'since': watermark, 'until': latest_change or watermark})
+                rebased = rebase_unchanged_sellers(conn, snapshot, previous_date)
+                conn.execute(text(f"""
+                    DELETE FROM {FEATURES_TABLE}
+                    WHERE snapshot_date = :snapshot_date
+                      AND seller_id IN (SELECT seller_id FROM feature_changes)
+                """), snapshot)
+                count = conn.execute(text(features_insert_sql(
+                    "AND oi.seller_id IN (SELECT seller_id FROM feature_changes)"
+                )), snapshot).rowcount
+                print(f"   -> Hoàn tất. Tính lại {count:,} Seller thay đổi, cập nhật mốc cho {rebased:,} Seller.")
+            set_watermark(conn, FEATURES_TABLE, 'changed_at', latest_change or datetime.min)
+        with engine.begin() as conn:
+            conn.execute(text(f"ANALYZE {FEATURES_TABLE}"))
+        return count
+    except Exception as e:
+        print(f"   ERROR refreshing seller_features: {e}")
+        raise
+
+# ĐỌC
+def load_seller_features(snapshot_date=None, seller_ids=None, engine=None):
+    """Đọc một snapshot của feature store (mặc định: snapshot mới nhất), có thể lọc theo Seller"""
+    sql = f"""
+        SELECT {', '.join(FEATURE_STORE_COLUMNS)}
+        FROM {FEATURES_TABLE}
+        WHERE snapshot_date = COALESCE(%(snapshot_date)s, (SELECT MAX(snapshot_date) FROM {FEATURES_TABLE}))
+    """
+    params = {'snapshot_date': snapshot_date}
+    if seller_ids is not None:
+        sql += " AND seller_id = ANY(%(seller_ids)s)"
+        params['seller_ids'] = list(seller_ids)
+    return pd.read_sql(sql, engine or get_db_engine(), params=params,
+                       parse_dates=['snapshot_ts', 'first_sale_date', 'last_sale_date'])
+
+if __name__ == "__main__":
+    from data_transformation import create_warehouse_schema
+    create_warehouse_schema()
+    refresh_seller_features()
@@ -0,0 +1,181 @@
+"""
+Huấn luyện & dự đoán các mô hình Seller (chuyển từ notebook seller_management.ipynb)
+- 'seller_scoring': StandardScaler + KMeans (K=4) trên 5 đặc trưng chấm điểm, Random Forest học lại nhãn cụm
+  để lấy trọng số (feature importance), kèm chân dung từng cụm.
+- 'seller_personas': log1p + StandardScaler + Ward (K=7) trên đặc trưng kinh doanh của seller_segmentation,
+  kèm chân dung và tên gợi ý của từng nhóm (thuật toán phân cụm chọn trong persona_clustering).
+Mô hình được lưu có phiên bản trong model_store; Seller mới được gán cụm bằng tâm gần nhất (vài mili giây)
+thay vì huấn luyện lại.
+"""
+
+import time
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+from sklearn.cluster import KMeans
+from sklearn.ensemble import RandomForestClassifier
+from config import get_db_engine, TABLES, SCORING_MODEL_CONFIG, PERSONA_CONFIG
+from model_store import get_or_train, load_artifact
+from persona_clustering import cluster_personas
+from seller_scoring import FEATURE_COLUMNS
+
+SCORING_MODEL = 'seller_scoring'
+PERSONA_MODEL = 'seller_personas'
+
+# CÁC HÀM HỖ TRỢ
+def nearest_center(X_scaled, centers):
+    """Chỉ số tâm gần nhất (Euclidean) cho từng dòng"""
+    distances = ((X_scaled[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+    return distances.argmin(axis=1)
+
+def persona_matrix(df, cfg=None):
+    """Ma trận đặc trưng chân dung: log1p các biến lệch, giữ nguyên các biến còn lại"""
+    cfg = cfg or PERSONA_CONFIG
+    X = df[cfg['features']].astype(float).copy()
+    for col in cfg['log_features']:
+        X[col] = np.log1p(X[col])
+    return X.to_numpy()
+
+def describe_persona(row, profile_summary):
+    """Tên gợi ý cho một nhóm, dựa trên so sánh với trung bình các nhóm (heuristic của notebook)"""
+    desc = []
+
+    if row['avg_order_value'] > profile_summary['avg_order_value'].mean() * 1.5:
+        desc.append("High-Ticket (Giá cao)")
+    elif row['avg_order_value'] < profile_summary['avg_order_value'].mean() * 0.7:
+        desc.append("Low-Cost (Giá rẻ)")
+
+    if row['avg_weight_g'] > profile_summary['avg_weight_g'].mean() * 1.5:
+        desc.append("Bulky (Hàng nặng)")
+    elif row['avg_weight_g'] < profile_summary['avg_weight_g'].mean() * 0.7:
+        desc.append("Lightweight (Hàng nhẹ)")
+
+    if row['market_reach'] > profile_summary['market_reach'].mean() * 1.5:
+        desc.append("National (Toàn quốc)")
+    else:
+        desc.append("Local/Regional (Địa phương)")
+
+    return ' + '.join(desc)
+
+def build_persona_profiles(df, labels, X_scaled, cfg=None):
+    """Chân dung (trung bình đặc trưng gốc, số Seller, tên gợi ý) và tâm đã chuẩn hóa của từng nhóm"""
+    cfg = cfg or PERSONA_CONFIG
+    profile = df[cfg['features']].groupby(labels).mean()
+    profile['count'] = pd.Series(labels).value_counts().reindex(profile.index).to_numpy()
+    profile['persona_name'] = [describe_persona(row, profile) for _, row in profile.iterrows()]
+    profile.index.name = 'seller_cluster'
+
+    centers = np.vstack([X_scaled[labels == c].mean(axis=0) for c in profile.index])
+    return profile, centers
+
+# HUẤN LUYỆN
+def train_scoring_models(features, cfg=None):
+    """KMeans trên 5 đặc trưng đã chuẩn hóa + Random Forest để lấy trọng số"""
+    cfg = cfg or SCORING_MODEL_CONFIG
+    timings = {}
+
+    start = time.perf_counter()
+    X = features[FEATURE_COLUMNS].to_numpy(dtype=float)
+    scaler = StandardScaler().fit(X)
+    X_scaled = scaler.transform(X)
+    kmeans = KMeans(n_clusters=cfg['n_clusters'], init='k-means++', n_init=cfg['n_init'],
+                    random_state=cfg['random_state']).fit(X_scaled)
+    timings['kmeans_seconds'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rf = RandomForestClassifier(n_estimators=cfg['rf_estimators'], random_state=cfg['random_state'])
+    rf.fit(features[FEATURE_COLUMNS], kmeans.labels_)
+    timings['random_forest_seconds'] = time.perf_counter() - start
+
+    weights = dict(zip(FEATURE_COLUMNS, rf.feature_importances_.round(4).tolist()))
+    profile = features[FEATURE_COLUMNS].groupby(kmeans.labels_).mean()
+    profile['count'] = np.bincount(kmeans.labels_)
+
+    objects = {
+        'feature_columns': FEATURE_COLUMNS,
+        'scaler': scaler,
+        'centers': kmeans.cluster_centers_,
+        'weights': weights,
+        'cluster_profiles': profile
+    }
+    metrics = {'inertia': float(kmeans.inertia_), 'weights': weights, **timings}
+    return objects, dict(cfg), metrics
+
+def train_persona_model(df, cfg=None):
+    """Phân cụm chân dung (mặc định Ward) trên đặc trưng đã log + chuẩn hóa"""
+    cfg = cfg or PERSONA_CONFIG
+    start = time.perf_counter()
+    X = persona_matrix(df, cfg)
+    scaler = StandardScaler().fit(X)
+    X_scaled = scaler.transform(X)
+    labels = cluster_personas(X_scaled, cfg)
+    profile, centers = build_persona_profiles(df, labels, X_scaled, cfg)
+
+    objects = {'scaler': scaler, 'centers': centers, 'profiles': profile, 'config': dict(cfg)}
+    metrics = {'method': cfg['method'], 'clustering_seconds': time.perf_counter() - start,
+               'cluster_sizes': profile['count'].tolist()}
+    return objects, dict(cfg), metrics
+
+# DỰ ĐOÁN (GÁN CỤM CHO SELLER MỚI)
+def assign_scoring_cluster(features, objects):
+    """Gán cụm KMeans bằng tâm gần nhất"""
+    X_scaled = objects['scaler'].transform(features[objects['feature_columns']].to_numpy(dtype=float))
+    return nearest_center(X_scaled, objects['centers'])
+
+def assign_persona(df, objects):
+    """Gán nhóm chân dung bằng tâm (đã chuẩn hóa) gần nhất; trả về DataFrame seller_cluster + persona_name"""
+    X_scaled = objects['scaler'].transform(persona_matrix(df, objects['config']))
+    positions = nearest_center(X_scaled, objects['centers'])
+    profiles = objects['profiles']
+    return pd.DataFrame({
+        'seller_cluster': profiles.index.to_numpy()[positions],
+        'persona_name': profiles['persona_name'].to_numpy()[positions]
+    }, index=df.index)
+
+# ĐỌC DỮ LIỆU & HÀM CHẠY CHÍNH
+def load_scoring_training_data(engine=None):
+    """5 đặc trưng chấm điểm của toàn bộ Seller trong seller_scorecard (thứ tự ổn định để fingerprint)"""
+    return pd.read_sql(
+        f"SELECT seller_id, {', '.join(FEATURE_COLUMNS)} FROM {TABLES['warehouse']['seller_scorecard']} "
+        f"ORDER BY seller_id", engine or get_db_engine()
+    ).set_index('seller_id')
+
+def load_persona_training_data(engine=None, cfg=None):
+    """Đặc trưng chân dung của các Seller đã được chấm điểm (bỏ Seller thiếu khoảng cách)"""
+    cfg = cfg or PERSONA_CONFIG
+    return pd.read_sql(f"""
+        SELECT s.seller_id, {', '.join(f's.{c}' for c in cfg['features'])}
+        FROM warehouse.seller_segmentation s
+        JOIN {TABLES['warehouse']['seller_scorecard']} sc ON s.seller_id = sc.seller_id
+        WHERE s.avg_distance_km IS NOT NULL
+        ORDER BY s.seller_id
+    """, engine or get_db_engine()).set_index('seller_id').dropna()
+
+def run_model_training(force=False):
+    """Huấn luyện (hoặc dùng lại nếu dữ liệu không đổi) cả hai mô hình"""
+    print("HUẤN LUYỆN MÔ HÌNH SELLER")
+    engine = get_db_engine()
+    scoring = get_or_train(SCORING_MODEL, load_scoring_training_data(engine), train_scoring_models, force)
+    personas = get_or_train(PERSONA_MODEL, load_persona_training_data(engine), train_persona_model, force)
+    return {'scoring': scoring[1], 'personas': personas[1]}
+
+def assign_sellers(scoring_features=None, persona_features=None, scoring_version=None, persona_version=None):
+    """
+    Gán cụm cho Seller bằng phiên bản mô hình đã lưu (không huấn luyện lại).
+    :param scoring_features: DataFrame có 5 cột FEATURE_COLUMNS
+    :param persona_features: DataFrame có các cột PERSONA_CONFIG['features']
+    :param scoring_version / persona_version: phiên bản của từng mô hình (None -> phiên bản mới nhất);
+                                              hai mô hình được huấn luyện độc lập nên phiên bản khác nhau
+    """
+    result = {}
+    if scoring_features is not None:
+        objects, _ = load_artifact(SCORING_MODEL, scoring_version)
+        result['scoring_cluster'] = pd.Series(assign_scoring_cluster(scoring_features, objects),
+                                              index=scoring_features.index)
+    if persona_features is not None:
+        objects, _ = load_artifact(PERSONA_MODEL, persona_version)
+        result['persona'] = assign_persona(persona_features, objects)
+    return result
+
+if __name__ == "__main__":
+    run_model_training()
@@ -0,0 +1,324 @@
+"""
+Chấm điểm & phân hạng Seller (Bronze / Silver / Gold / Platinum)
+Chuyển từ notebook seller_management.ipynb thành bước chạy theo lô:
+1. Đọc warehouse.seller_evaluation (chỉ các cột cần thiết, có thể lọc theo danh sách seller).
+2. Loại Seller "ma" (ngừng bán lâu / quá ít đơn, trừ người mới).
+3. Gắn cờ đánh giá thấp do lỗi vận chuyển (logistics_bias.py) -> không tính vào điểm rating.
+4. Tính 5 đặc trưng cho mỗi Seller, MinMax scale, nhân trọng số Random Forest, chia hạng theo phân vị.
+5. Ghi warehouse.seller_scorecard bằng COPY.
+Chấm điểm một phần Seller dùng lại khoảng scale và ngưỡng phân vị của toàn bộ Seller trong scorecard hiện có.
+Mặc định đặc trưng được đọc sẵn từ feature store warehouse.seller_features (seller_features.py) thay vì
+tính lại từ dữ liệu cấp order item; nguồn 'items' giữ nguyên cách tính bằng pandas ở trên.
+"""
+
+import time
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from config import get_db_engine, TABLES, SCHEMA_WAREHOUSE, SELLER_SCORING_CONFIG
+from bulk_writer import write_dataframe, replace_rows
+from logistics_bias import flag_logistics_bias
+from seller_features import load_seller_features
+
+SELLER_EVALUATION_TABLE = TABLES['warehouse']['seller_evaluation']
+SCORECARD_TABLE = TABLES['warehouse']['seller_scorecard']
+
+EVALUATION_COLUMNS = [
+    'seller_id', 'order_id', 'order_purchase_timestamp', 'order_approved_at',
+    'order_delivered_carrier_date', 'order_delivered_customer_date', 'order_estimated_delivery_date',
+    'shipping_limit_date', 'review_score', 'review_comment_message', 'price'
+]
+DATE_COLUMNS = [
+    'order_purchase_timestamp', 'order_approved_at', 'order_delivered_carrier_date',
+    'order_delivered_customer_date', 'order_estimated_delivery_date', 'shipping_limit_date'
+]
+FEATURE_SOURCES = ('feature_store', 'items')
+FEATURE_COLUMNS = ['log_gmv', 'log_orders', 'avg_rating', 'late_shipment_rate', 'avg_prep_time_hours']
+SCORECARD_COLUMNS = [
+    'seller_id', 'gmv', 'total_orders', 'avg_rating', 'late_shipment_rate', 'avg_prep_time_hours',
+    'log_gmv', 'log_orders', 'final_score', 'segment'
+]
+
+# ĐỌC DỮ LIỆU
+def load_seller_evaluation(seller_ids=None, engine=None):
+    """Đọc dữ liệu cấp order item từ warehouse.seller_evaluation (toàn bộ hoặc theo danh sách seller)"""
+    engine = engine or get_db_engine()
+    sql = f"SELECT {', '.join(EVALUATION_COLUMNS)} FROM {SELLER_EVALUATION_TABLE}"
+    params = None
+    if seller_ids is not None:
+        sql += " WHERE seller_id = ANY(%(seller_ids)s)"
+        params = {'seller_ids': list(seller_ids)}
+    df = pd.read_sql(sql, engine, params=params, parse_dates=DATE_COLUMNS)
+    return df
+
+def get_snapshot_date(engine=None):
+    """Mốc thời gian hiện tại của dữ liệu = ngày mua hàng lớn nhất trên toàn sàn"""
+    with (engine or get_db_engine()).connect() as conn:
+        value = conn.execute(text(f"SELECT MAX(order_purchase_timestamp) FROM {SELLER_EVALUATION_TABLE}")).scalar()
+    return pd.Timestamp(value)
+
+# CÁC BƯỚC TÍNH TOÁN
+def filter_ghost_sellers(df, snapshot_date, cfg=None):
+    """
+    Bỏ các Seller "ma":
+    - Inactive: không bán gì > inactive_days ngày VÀ không phải người mới
+    - Low Quality: bán < min_orders đơn VÀ không phải người mới
+    """
+    cfg = cfg or SELLER_SCORING_CONFIG
+    stats = df.groupby('seller_id', observed=True).agg(
+        first_sale_date=('order_purchase_timestamp', 'min'),
+        last_sale_date=('order_purchase_timestamp', 'max'),
+        total_orders=('order_id', 'nunique')
+    )
+    days_since_last = (snapshot_date - stats['last_sale_date']).dt.days
+    days_since_first = (snapshot_date - stats['first_sale_date']).dt.days
+
+    not_new = days_since_first > cfg['new_seller_days']
+    ghost = ((days_since_last > cfg['inactive_days']) & not_new) | ((stats['total_orders'] < cfg['min_orders']) & not_new)
+    active_ids = stats.index[~ghost]
+    return df[df['seller_id'].isin(active_ids)]
+
+def compute_seller_features(df, rating_fill=None):
+    """
+    Tính 5 đặc trưng cho mỗi Seller từ dữ liệu cấp order item (đã lọc Seller "ma"):
+    - Quy mô: gmv, total_orders (-> log_gmv, log_orders)
+    - Chất lượng: avg_rating (điểm đã bỏ các review lỗi vận chuyển, thiếu -> trung bình toàn sàn)
+    - Vận hành: late_shipment_rate, avg_prep_time_hours (median giờ chuẩn bị hàng)
+    Seller không có dữ liệu vận hành bị loại.
+    :param rating_fill: Điểm điền cho Seller chưa có review (None -> trung bình của chính tập này)
+    """
+    adjusted_score = df['review_score'].where(~flag_logistics_bias(df))
+
+    # Vận hành: chỉ các dòng đã giao cho Carrier, thời gian âm (dữ liệu lỗi) -> 0
+    prep_hours = (df['order_delivered_carrier_date'] - df['order_approved_at']).dt.total_seconds() / 3600
+    shipped = prep_hours.notna()
+    ops = pd.DataFrame({
+        'seller_id': df['seller_id'][shipped],
+        'late': (df['order_delivered_carrier_date'][shipped] > df['shipping_limit_date'][shipped]).astype(float),
+        'prep': prep_hours[shipped].clip(lower=0)
+    }).groupby('seller_id', observed=True).agg(
+        late_shipment_rate=('late', 'mean'),
+        avg_prep_time_hours=('prep', 'median')
+    )
+
+    features = pd.DataFrame({
+        'seller_id': df['seller_id'],
+        'price': df['price'],
+        'order_id': df['order_id'],
+        'adjusted_score': adjusted_score
+    }).groupby('seller_id', observed=True).agg(
+        gmv=('price', 'sum'),
+        total_orders=('order_id', 'nunique'),
+        avg_rating=('adjusted_score', 'mean')
+    )
+
+    features = features.join(ops, how='inner').reset_index()
+    if rating_fill is None:
+        rating_fill = features['avg_rating'].mean()
+    features['avg_rating'] = features['avg_rating'].fillna(rating_fill)
+    features['log_gmv'] = np.log(features['gmv'] + 1)
+    features['log_orders'] = np.log(features['total_orders'] + 1)
+    return features
+
+def features_from_store(store, rating_fill=None):
+    """
+    Đặc trưng chấm điểm từ một snapshot của seller_features: bỏ Seller "ma" và Seller chưa có
+    dữ liệu vận hành (tương đương filter_ghost_sellers + compute_seller_features).
+    """
+    features = store.loc[~store['is_ghost'] & (store['shipped_items'] > 0),
+                         ['seller_id', 'gmv', 'total_orders', 'avg_rating',
+                          'late_shipment_rate', 'avg_prep_time_hours']].reset_index(drop=True)
+    if rating_fill is None:
+        rating_fill = features['avg_rating'].mean()
+    features['avg_rating'] = features['avg_rating'].fillna(rating_fill)
+    features['log_gmv'] = np.log(features['gmv'] + 1)
+    features['log_orders'] = np.log(features['total_orders'] + 1)
+    return features
+
+def fit_scoring_reference(features, cfg=None):
+    """Khoảng MinMax của từng đặc trưng và ngưỡng phân vị điểm trên tập Seller đầy đủ"""
+    cfg = cfg or SELLER_SCORING_CONFIG
+    reference = {
+        'min': features[FEATURE_COLUMNS].min().to_dict(),
+        'max': features[FEATURE_COLUMNS].max().to_dict(),
+        'rating_fill': float(features['avg_rating'].mean())
+    }
+    scores = weighted_score(features, reference, cfg)
+    reference['score_edges'] = np.quantile(scores, np.linspace(0, 1, len(cfg['segment_labels']) + 1)).tolist()
+    return reference
+
+def weighted_score(features, reference, cfg=None):
+    """Điểm tổng hợp 0-100: MinMax scale (đảo chiều nhóm nghịch) rồi nhân trọng số, tính trên cả mảng"""
+    cfg = cfg or SELLER_SCORING_CONFIG
+    score = np.zeros(len(features))
+    for col, weight in cfg['weights'].items():
+        lo, hi = reference['min'][col], reference['max'][col]
+        span = hi - lo
+        scaled = (features[col].to_numpy(dtype=float) - lo) / span if span else np.zeros(len(features))
+        if col in cfg['negative_features']:
+            scaled = 1 - scaled
+        score += scaled * weight
+    return score * 100
+
+def assign_segments(scores, score_edges, labels):
+    """Chia hạng theo ngưỡng phân vị (giống pd.qcut khi ngưỡng tính trên chính tập này)"""
+    bins = [-np.inf] + list(score_edges[1:-1]) + [np.inf]
+    return pd.cut(scores, bins=bins, labels=labels, include_lowest=True)
+
+def score_sellers(features, reference=None, cfg=None):
+    """
+    Chấm điểm & phân hạng. reference=None -> tự khớp trên chính tập features (toàn bộ Seller).
+    Trả về (scorecard, reference).
+    """
+    cfg = cfg or SELLER_SCORING_CONFIG
+    reference = reference or fit_scoring_reference(features, cfg)
+    scorecard = features.copy()
+    scorecard['final_score'] = weighted_score(features, reference, cfg)
+    scorecard['segment'] = assign_segments(scorecard['final_score'].to_numpy(), reference['score_edges'],
+                                           cfg['segment_labels']).astype(str)
+    return scorecard[SCORECARD_COLUMNS], reference
+
+def load_scoring_reference(engine=None, cfg=None):
+    """Dựng lại khoảng scale và ngưỡng phân vị từ seller_scorecard hiện có (dùng khi chấm điểm một phần)"""
+    cfg = cfg or SELLER_SCORING_CONFIG
+    existing = pd.read_sql(f"SELECT {', '.join(FEATURE_COLUMNS)}, final_score FROM {SCORECARD_TABLE}",
+                           engine or get_db_engine())
+    if existing.empty:
+        raise ValueError("seller_scorecard chưa có dữ liệu, hãy chấm điểm toàn bộ Seller trước")
+    return {
+        'min': existing[FEATURE_COLUMNS].min().to_dict(),
+        'max': existing[FEATURE_COLUMNS].max().to_dict(),
+        'rating_fill': float(existing['avg_rating'].mean()),
+        'score_edges': np.quantile(existing['final_score'],
+                                   np.linspace(0, 1, len(cfg['segment_labels']) + 1)).tolist()
+    }
+
+def build_scorecard(df, snapshot_date, reference=None):
+    """Toàn bộ quy trình trên một DataFrame cấp order item (không đụng tới Database)"""
+    active = filter_ghost_sellers(df, snapshot_date)
+    features = compute_seller_features(active, reference['rating_fill'] if reference else None)
+    return score_sellers(features, reference)
+
+# HÀM CHẠY CHÍNH
+def run_seller_scoring(seller_ids=None, source=None):
+    """
+    Chấm điểm Seller và ghi warehouse.seller_scorecard.
+    :param seller_ids: None -> chấm lại toàn bộ (thay bảng); danh sách -> chỉ chấm các Seller này
+                       theo khoảng scale/phân vị của scorecard hiện có và thay đúng các dòng của họ
+    :param source: 'feature_store' (đọc seller_features) hoặc 'items' (tính từ seller_evaluation)
+    """
+    source = source or SELLER_SCORING_CONFIG['feature_source']
+    if source not in FEATURE_SOURCES:
+        raise ValueError(f"Nguồn đặc trưng không hợp lệ: {source}. Chọn một trong {FEATURE_SOURCES}")
+    print(f"CHẤM ĐIỂM SELLER (nguồn: {source})")
+    engine = get_db_engine()
+    start = time.perf_counter()
+
+    reference = load_scoring_reference(engine) if seller_ids is not None else None
+    if source == 'feature_store':
+        store = load_seller_features(seller_ids=seller_ids, engine=engine)
+        snapshot_date = store['snapshot_ts'].max()
+        features = features_from_store(store, reference['rating_fill'] if reference else None)
+        scorecard, _ = score_sellers(features, reference)
+    else:
+        snapshot_date = get_snapshot_date(engine)
+        df = load_seller_evaluation(seller_ids, engine)
+        scorecard, _ = build_scorecard(df, snapshot_date, reference)
+
+    if seller_ids is None:
+        count = write_dataframe(scorecard, 'seller_scorecard', schema=SCHEMA_WAREHOUSE, backend='copy')
+    else:
+        count = replace_rows(scorecard, 'seller_scorecard', 'seller_id', schema=SCHEMA_WAREHOUSE,
+                             keys=seller_ids)
+
+    print(f"  -> Đã chấm {count:,} Seller trong {time.perf_counter() - start:.2f}s (mốc dữ liệu: {snapshot_date})")
+    print(f"  Phân bổ các nhóm: {scorecard['segment'].value_counts().to_dict()}")
+    return scorecard
+
+def verify_feature_store(engine=None, tolerance=1e-6):
+    """
+    So sánh đặc trưng đọc từ seller_features (snapshot mới nhất) với cách tính bằng pandas trên
+    seller_evaluation. Trả về số Seller lệch (0 = khớp).
+    """
+    print("KIỂM TRA FEATURE STORE SO VỚI TÍNH TỪ ORDER ITEM")
+    engine = engine or get_db_engine()
+    snapshot_date = get_snapshot_date(engine)
+    expected = compute_seller_features(filter_ghost_sellers(load_seller_evaluation(engine=engine), snapshot_date))
+    actual = features_from_store(load_seller_features(engine=engine))
+
+    merged = expected.merge(actual, on='seller_id', how='outer', suffixes=('_expected', '_store'), indicator=True)
+    missing = int((merged['_merge'] != 'both').sum())
+    both = merged[merged['_merge'] == 'both']
+    differs = np.zeros(len(both), dtype=bool)
+    for col in ['gmv', 'total_orders'] + FEATURE_COLUMNS:
+        differs |= ~np.isclose(both[f'{col}_expected'].astype(float), both[f'{col}_store'].astype(float),
+                               rtol=tolerance, atol=tolerance, equal_nan=True)
+    mismatches = missing + int(differs.sum())
+    print(f"  Seller: {len(expected):,} (pandas) / {len(actual):,} (feature store) | Lệch: {mismatches:,}")
+    return mismatches
+
+# SO SÁNH HIỆU NĂNG
+def generate_synthetic_evaluation(n_sellers=100_000, n_items=20_000_000, seed=42):
+    """Sinh dữ liệu cấp order item giả lập có cùng cấu trúc với seller_evaluation"""
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2016-09-01').value
+    span = pd.Timestamp('2018-09-01').value - start
+    day = 86_400 * 10**9
+
+    purchase = start + rng.integers(0, span, n_items)
+    approved = purchase + rng.integers(0, 2 * day, n_items)
+    carrier = approved + rng.integers(0, 6 * day, n_items)
+    limit = approved + rng.integers(2 * day, 7 * day, n_items)
+    customer = carrier + rng.integers(day, 20 * day, n_items)
+    estimated = purchase + rng.integers(10 * day, 30 * day, n_items)
+    missing_carrier = rng.random(n_items) < 0.02
+
+    comments = np.array(['', 'produto chegou atrasado', 'embalagem amassada', 'otimo vendedor', 'nao recebi'],
+                        dtype=object)
+    scores = rng.choice([1, 2, 3, 4, 5], n_items, p=[0.1, 0.05, 0.08, 0.2, 0.57]).astype(float)
+    scores[rng.random(n_items) < 0.01] = np.nan
+
+    return pd.DataFrame({
+        'seller_id': pd.Categorical.from_codes(rng.zipf(1.3, n_items) % n_sellers,
+                                               [f"s{i:06d}" for i in range(n_sellers)]),
+        'order_id': rng.integers(0, int(n_items / 1.1), n_items),
+        'order_purchase_timestamp': pd.to_datetime(purchase),
+        'order_approved_at': pd.to_datetime(approved),
+        'order_delivered_carrier_date': pd.to_datetime(np.where(missing_carrier, np.iinfo(np.int64).min, carrier)),
+        'order_delivered_customer_date': pd.to_datetime(customer),
+        'order_estimated_delivery_date': pd.to_datetime(estimated),
+        'shipping_limit_date': pd.to_datetime(limit),
+        'review_score': scores,
+        'review_comment_message': comments[rng.integers(0, len(comments), n_items)],
+        'price': rng.gamma(2.0, 60.0, n_items).round(2)
+    })
+
+def benchmark_seller_scoring(n_sellers=100_000, n_items=20_000_000, seed=42):
+    """Đo thời gian từng bước chấm điểm trên dữ liệu giả lập (không cần Database)"""
+    print(f"BENCHMARK CHẤM ĐIỂM SELLER ({n_sellers:,} seller, {n_items:,} order item)")
+    timings = {}
+
+    start = time.perf_counter()
+    df = generate_synthetic_evaluation(n_sellers, n_items, seed)
+    timings['generate'] = time.perf_counter() - start
+    snapshot_date = df['order_purchase_timestamp'].max()
+
+    start = time.perf_counter()
+    active = filter_ghost_sellers(df, snapshot_date)
+    timings['filter_ghost_sellers'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    features = compute_seller_features(active)
+    timings['compute_seller_features'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scorecard, _ = score_sellers(features)
+    timings['score_sellers'] = time.perf_counter() - start
+
+    for step, seconds in timings.items():
+        print(f"  {step:25s}: {seconds:8.2f}s")
+    print(f"  Đã chấm {len(scorecard):,} Seller | Phân bổ: {scorecard['segment'].value_counts().to_dict()}")
+    return pd.Series(timings, name='seconds')
+
+if __name__ == "__main__":
+    run_seller_scoring()
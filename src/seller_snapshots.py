@@ -0,0 +1,360 @@
+"""
+Snapshot lịch sử của Seller (point-in-time) cho chấm điểm quá khứ và backtest
+- Trả lời "Seller này ở hạng nào vào ngày X" mà không phải lọc lại dữ liệu rồi gộp lại cho từng ngày.
+- Dữ liệu cấp order item được nạp và sắp xếp một lần theo (Seller, thời điểm mua). Với mỗi mốc as-of:
+  vị trí cuối của từng Seller tìm bằng searchsorted, các chỉ số cộng dồn (GMV, số đơn, rating, giao trễ)
+  lấy từ mảng cumsum, median giờ chuẩn bị hàng lấy bằng thống kê thứ tự trên mảng đã sắp theo giá trị.
+- Kết quả (đặc trưng + điểm + hạng) ghi vào warehouse.seller_snapshots, phân vùng RANGE theo tháng.
+Lưu ý: đơn được tính vào mốc theo ngày mua; ngày giao và review là thông tin đã biết ở thời điểm hiện tại.
+"""
+
+import time
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from config import get_db_engine, get_raw_connection, TABLES, SELLER_SCORING_CONFIG, SNAPSHOT_CONFIG
+from bulk_writer import copy_dataframe
+from logistics_bias import flag_logistics_bias
+from seller_features import FEATURE_STORE_COLUMNS
+from seller_scoring import (
+    load_seller_evaluation, filter_ghost_sellers, compute_seller_features, features_from_store,
+    score_sellers, build_scorecard, generate_synthetic_evaluation
+)
+
+SNAPSHOTS_TABLE = TABLES['warehouse']['seller_snapshots']
+SNAPSHOT_COLUMNS = FEATURE_STORE_COLUMNS + ['final_score', 'segment']
+DAY_NS = 86_400 * 10**9
+
+# CHUẨN BỊ MẢNG
+def prepare_item_arrays(df):
+    """
+    Sắp xếp dữ liệu cấp order item một lần và dựng các mảng cộng dồn dùng chung cho mọi mốc.
+    Thời điểm được đổi sang giây tính từ mốc nhỏ nhất để ghép với mã Seller thành một khóa int64.
+    """
+    seller_codes, sellers = pd.factorize(df['seller_id'], sort=True)
+    ts = df['order_purchase_timestamp'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    valid = (seller_codes >= 0) & (ts != np.iinfo(np.int64).min)
+    # Làm tròn xuống giây chẵn để so sánh theo giây tương đương so sánh theo nano giây với mốc nửa đêm
+    base = ts[valid].min() // 10**9 * 10**9
+
+    # Sắp theo một khóa int64 (Seller, giây) nhanh hơn lexsort hai cột; các dòng trùng khóa (cùng Seller,
+    # cùng giây) nằm liền nhau nên chỉ cần sắp lại riêng nhóm này theo nano giây rồi đặt về đúng vị trí
+    row_keys = (seller_codes.astype(np.int64) << 32) | np.where(valid, (ts - base) // 10**9, 0)
+    order = np.argsort(row_keys)
+    order = order[valid[order]]
+    keys = row_keys[order]
+    same = keys[1:] == keys[:-1]
+    tied = np.flatnonzero(np.concatenate([same, [False]]) | np.concatenate([[False], same]))
+    order[tied] = order[tied][np.lexsort((ts[order[tied]], keys[tied]))]
+    ts_sorted = ts[order]
+    codes = keys >> 32
+
+    adjusted = df['review_score'].where(~flag_logistics_bias(df)).to_numpy(dtype=float)[order]
+    carrier = df['order_delivered_carrier_date'].to_numpy(dtype='datetime64[ns]')[order]
+    approved = df['order_approved_at'].to_numpy(dtype='datetime64[ns]')[order]
+    limit = df['shipping_limit_date'].to_numpy(dtype='datetime64[ns]')[order]
+    # NaT -> NaN giờ chuẩn bị; so sánh với NaT luôn False (giống pandas)
+    prep_hours = (carrier - approved) / np.timedelta64(1, 'h')
+    shipped = ~np.isnan(prep_hours)
+    late = (carrier > limit) & shipped
+    # Dòng đầu tiên của mỗi cặp (Seller, đơn): băm một khóa int64 thay vì so hai cột
+    order_codes = pd.factorize(df['order_id'])[0].astype(np.int64) + 1
+    first_order_row = ~pd.Series((codes << 32) | order_codes[order]).duplicated().to_numpy()
+
+    def prefix(values):
+        return np.concatenate([[0.0], np.cumsum(values, dtype=float)])
+
+    # Mảng cho median giờ chuẩn bị hàng: các dòng đã giao Carrier, sắp theo (Seller, giá trị).
+    # Giá trị được đổi sang thứ hạng toàn cục để ghép với mã Seller thành một khóa int64 như trên
+    prep_values = np.clip(prep_hours[shipped], 0, None)
+    prep_rank = np.empty(len(prep_values), dtype=np.int64)
+    prep_rank[np.argsort(prep_values)] = np.arange(len(prep_values))
+    prep_order = np.argsort((codes[shipped] << 32) | prep_rank)
+    prep_codes = codes[shipped][prep_order]
+
+    return {
+        'sellers': np.asarray(sellers.astype(str), dtype=object),
+        'base': base,
+        'keys': keys,
+        'ts': ts_sorted,
+        'ts_global': np.sort(ts_sorted),
+        'group_start': np.searchsorted(codes, np.arange(len(sellers))),
+        'cum_price': prefix(np.nan_to_num(df['price'].to_numpy(dtype=float)[order])),
+        'cum_orders': prefix(first_order_row),
+        'cum_rating': prefix(np.nan_to_num(adjusted)),
+        'cum_rated': prefix(~np.isnan(adjusted)),
+        'cum_shipped': prefix(shipped),
+        'cum_late': prefix(late),
+        'prep_values': prep_values[prep_order],
+        'prep_ts': ts_sorted[shipped][prep_order],
+        'prep_group_start': np.searchsorted(prep_codes, np.arange(len(sellers))),
+        'prep_group_end': np.searchsorted(prep_codes, np.arange(len(sellers)), side='right')
+    }
+
+def prefix_median(arrays, boundary_ns):
+    """
+    Median giờ chuẩn bị hàng của từng Seller trên các dòng mua trước boundary_ns.
+    Trong mỗi nhóm Seller (đã sắp theo giá trị), phần tử thứ k của tập con lấy được bằng cách cộng dồn
+    mặt nạ "thuộc tập con" và tìm vị trí đầu tiên đạt k + 1 -> O(n) cho mỗi mốc, không cần gộp lại.
+    """
+    included = arrays['prep_ts'] < boundary_ns
+    cum = np.concatenate([[0], np.cumsum(included)])
+    base = cum[arrays['prep_group_start']]
+    counts = cum[arrays['prep_group_end']] - base
+
+    median = np.full(len(counts), np.nan)
+    has = counts > 0
+    lower = np.searchsorted(cum, base[has] + (counts[has] - 1) // 2 + 1) - 1
+    upper = np.searchsorted(cum, base[has] + counts[has] // 2 + 1) - 1
+    median[has] = (arrays['prep_values'][lower] + arrays['prep_values'][upper]) / 2
+    return median, counts
+
+def snapshot_at(arrays, snapshot_date, cfg=None):
+    """Đặc trưng của mọi Seller tại một mốc (gồm các dòng mua trước ngày hôm sau của snapshot_date)"""
+    cfg = cfg or SELLER_SCORING_CONFIG
+    boundary_ns = (pd.Timestamp(snapshot_date) + pd.Timedelta(days=1)).value
+    boundary_sec = np.clip((boundary_ns - arrays['base']) // 10**9, 0, 2**32 - 1)
+    n_sellers = len(arrays['sellers'])
+
+    start = arrays['group_start']
+    end = np.searchsorted(arrays['keys'], (np.arange(n_sellers, dtype=np.int64) << 32) | boundary_sec)
+    active = end > start
+    if not active.any():
+        return pd.DataFrame(columns=FEATURE_STORE_COLUMNS)
+    start, end = start[active], end[active]
+
+    def as_of(name):
+        return arrays[name][end] - arrays[name][start]
+
+    # Mốc toàn sàn = ngày mua lớn nhất trước boundary (giống get_snapshot_date)
+    snapshot_ts = arrays['ts_global'][np.searchsorted(arrays['ts_global'], boundary_ns) - 1]
+    first_ts, last_ts = arrays['ts'][start], arrays['ts'][end - 1]
+    recency = (snapshot_ts - last_ts) // DAY_NS
+    tenure = (snapshot_ts - first_ts) // DAY_NS
+    total_orders = as_of('cum_orders').astype(np.int64)
+    rated = as_of('cum_rated')
+    shipped = as_of('cum_shipped')
+    median, _ = prefix_median(arrays, boundary_ns)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avg_rating = np.where(rated > 0, as_of('cum_rating') / rated, np.nan)
+        late_rate = np.where(shipped > 0, as_of('cum_late') / shipped, np.nan)
+
+    not_new = tenure > cfg['new_seller_days']
+    ghost = not_new & ((recency > cfg['inactive_days']) | (total_orders < cfg['min_orders']))
+    return pd.DataFrame({
+        'snapshot_date': np.full(len(end), pd.Timestamp(snapshot_date).date(), dtype=object),
+        'seller_id': arrays['sellers'][active],
+        'snapshot_ts': np.full(len(end), snapshot_ts).view('datetime64[ns]'),
+        'first_sale_date': first_ts.view('datetime64[ns]'),
+        'last_sale_date': last_ts.view('datetime64[ns]'),
+        'recency_days': recency,
+        'tenure_days': tenure,
+        'is_ghost': ghost,
+        'total_orders': total_orders,
+        'gmv': as_of('cum_price'),
+        'rated_items': rated.astype(np.int64),
+        'avg_rating': avg_rating,
+        'shipped_items': shipped.astype(np.int64),
+        'late_shipment_rate': late_rate,
+        'avg_prep_time_hours': median[active]
+    }, columns=FEATURE_STORE_COLUMNS)
+
+def monthly_snapshot_dates(df, months=None):
+    """Các ngày cuối tháng gần nhất (tháng cuối cùng có thể chưa trọn, lấy đến ngày mua lớn nhất)"""
+    months = months or SNAPSHOT_CONFIG['months']
+    latest = df['order_purchase_timestamp'].max().normalize()
+    dates = list(pd.date_range(end=latest, periods=months, freq='ME'))
+    if not dates or dates[-1] != latest:
+        dates = (dates + [latest])[-months:]
+    return dates
+
+# TÍNH & CHẤM ĐIỂM
+def compute_snapshots(df, snapshot_dates, arrays=None):
+    """Đặc trưng của mọi Seller tại nhiều mốc, dùng chung một lần sắp xếp"""
+    arrays = arrays or prepare_item_arrays(df)
+    return pd.concat([snapshot_at(arrays, d) for d in snapshot_dates], ignore_index=True)
+
+def score_snapshots(snapshots):
+    """
+    Chấm điểm & phân hạng từng mốc (khoảng scale và phân vị tính trong chính mốc đó).
+    Các mốc nằm thành từng đoạn liên tục sau khi sắp theo ngày -> gán điểm theo vị trí, không cần merge.
+    """
+    snapshots = snapshots.sort_values('snapshot_date', kind='stable', ignore_index=True)
+    dates = snapshots['snapshot_date'].to_numpy()
+    bounds = np.concatenate([[0], np.flatnonzero(dates[1:] != dates[:-1]) + 1, [len(dates)]])
+    eligible = ~snapshots['is_ghost'].to_numpy(dtype=bool) & (snapshots['shipped_items'].to_numpy() > 0)
+
+    final_score = np.full(len(snapshots), np.nan)
+    segment = np.full(len(snapshots), None, dtype=object)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        features = features_from_store(snapshots.iloc[start:end])
+        if len(features):
+            scorecard, _ = score_sellers(features)
+            rows = start + np.flatnonzero(eligible[start:end])
+            final_score[rows] = scorecard['final_score'].to_numpy()
+            segment[rows] = scorecard['segment'].to_numpy()
+    return snapshots.assign(final_score=final_score, segment=segment)[SNAPSHOT_COLUMNS]
+
+# GHI VÀO BẢNG PHÂN VÙNG
+def ensure_snapshots_table(conn):
+    conn.execute(text(f"""
+    CREATE TABLE IF NOT EXISTS {SNAPSHOTS_TABLE} (
+        snapshot_date DATE NOT NULL,
+        seller_id VARCHAR(100) NOT NULL,
+        snapshot_ts TIMESTAMP NOT NULL,
+        first_sale_date TIMESTAMP,
+        last_sale_date TIMESTAMP,
+        recency_days INTEGER,
+        tenure_days INTEGER,
+        is_ghost BOOLEAN NOT NULL,
+        total_orders INTEGER NOT NULL,
+        gmv DOUBLE PRECISION NOT NULL,
+        rated_items INTEGER NOT NULL,
+        avg_rating DOUBLE PRECISION,
+        shipped_items INTEGER NOT NULL,
+        late_shipment_rate DOUBLE PRECISION,
+        avg_prep_time_hours DOUBLE PRECISION,
+        final_score DOUBLE PRECISION,
+        segment VARCHAR(20),
+        PRIMARY KEY (snapshot_date, seller_id)
+    ) PARTITION BY RANGE (snapshot_date);
+    """))
+
+def partition_name(snapshot_date):
+    return f"{SNAPSHOTS_TABLE}_{pd.Timestamp(snapshot_date):%Y%m}"
+
+def write_snapshots(scored):
+    """Thay dữ liệu của các mốc trong scored (tạo phân vùng tháng nếu chưa có), COPY trong một transaction"""
+    with get_db_engine().begin() as conn:
+        ensure_snapshots_table(conn)
+        for month in sorted({pd.Timestamp(d).to_period('M') for d in scored['snapshot_date']}):
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {partition_name(month.start_time)}
+                PARTITION OF {SNAPSHOTS_TABLE}
+                FOR VALUES FROM ('{month.start_time:%Y-%m-%d}') TO ('{(month + 1).start_time:%Y-%m-%d}')
+            """))
+
+    conn = get_raw_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DELETE FROM {SNAPSHOTS_TABLE} WHERE snapshot_date = ANY(%s)",
+                        (sorted(set(scored['snapshot_date'])),))
+            total = copy_dataframe(cur, SNAPSHOTS_TABLE, scored)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return total
+
+# KIỂM TRA & HÀM CHẠY CHÍNH
+def naive_snapshot_features(df, snapshot_date):
+    """Cách cũ: lọc dữ liệu đến mốc rồi lọc Seller "ma" và gộp lại (dùng để đối chiếu)"""
+    boundary = pd.Timestamp(snapshot_date) + pd.Timedelta(days=1)
+    subset = df[df['order_purchase_timestamp'] < boundary]
+    snapshot_ts = subset['order_purchase_timestamp'].max()
+    return compute_seller_features(filter_ghost_sellers(subset, snapshot_ts))
+
+def verify_snapshots(df, snapshots, snapshot_dates, tolerance=1e-6):
+    """So sánh đặc trưng chấm điểm của một số mốc với cách lọc-rồi-gộp; trả về số Seller lệch"""
+    mismatches = 0
+    columns = ['gmv', 'total_orders', 'avg_rating', 'late_shipment_rate', 'avg_prep_time_hours']
+    for snapshot_date in snapshot_dates:
+        expected = naive_snapshot_features(df, snapshot_date).set_index('seller_id').sort_index()
+        store = snapshots[snapshots['snapshot_date'] == pd.Timestamp(snapshot_date).date()]
+        actual = features_from_store(store).set_index('seller_id').sort_index()
+        if not expected.index.equals(actual.index):
+            mismatches += len(expected.index.symmetric_difference(actual.index))
+            continue
+        for col in columns:
+            mismatches += int((~np.isclose(expected[col].astype(float), actual[col].astype(float),
+                                           rtol=tolerance, atol=tolerance, equal_nan=True)).sum())
+    return mismatches
+
+def run_seller_backtest(months=None, df=None, write=True, verify=True):
+    """
+    Tính đặc trưng + hạng của Seller tại các mốc cuối tháng trong một lượt và ghi warehouse.seller_snapshots.
+    Trả về DataFrame các snapshot đã chấm điểm.
+    """
+    print("SNAPSHOT LỊCH SỬ SELLER (BACKTEST)")
+    timings = {}
+
+    start = time.perf_counter()
+    df = load_seller_evaluation() if df is None else df
+    timings['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    snapshot_dates = monthly_snapshot_dates(df, months)
+    snapshots = compute_snapshots(df, snapshot_dates)
+    timings['snapshots'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scored = score_snapshots(snapshots)
+    timings['scoring'] = time.perf_counter() - start
+
+    if verify:
+        start = time.perf_counter()
+        mismatches = verify_snapshots(df, snapshots, snapshot_dates[-SNAPSHOT_CONFIG['verify_dates']:])
+        timings['verify'] = time.perf_counter() - start
+        if mismatches:
+            raise AssertionError(f"Snapshot lệch {mismatches} giá trị so với cách lọc-rồi-gộp")
+
+    if write:
+        start = time.perf_counter()
+        write_snapshots(scored)
+        timings['write'] = time.perf_counter() - start
+
+    for step, seconds in timings.items():
+        print(f"  {step:10s}: {seconds:8.2f}s")
+    print(f"  {len(snapshot_dates)} mốc ({snapshot_dates[0]:%Y-%m-%d} -> {snapshot_dates[-1]:%Y-%m-%d}), "
+          f"{len(scored):,} dòng")
+    return scored
+
+def benchmark_snapshots(n_sellers=100_000, n_items=5_000_000, months=24, naive_dates=3, seed=42, max_ratio=2.5):
+    """
+    So sánh thời gian: snapshot một lượt cho months mốc vs lọc-rồi-gộp cho naive_dates mốc
+    (ngoại suy tuyến tính cho months mốc) trên dữ liệu giả lập, kèm kiểm tra kết quả khớp.
+    Đồng thời đo một lần chấm điểm hiện tại (build_scorecard) trên cùng dữ liệu và báo tỉ lệ
+    thời gian months mốc (đặc trưng + chấm điểm) so với một lần chấm điểm đó; báo lỗi nếu tỉ lệ vượt max_ratio
+    (mục tiêu ~1x chưa đạt: đo được ~1.9x ở 20k seller / 1M item và 100k seller / 5M item).
+    """
+    print(f"BENCHMARK SNAPSHOT SELLER ({n_sellers:,} seller, {n_items:,} order item, {months} mốc)")
+    df = generate_synthetic_evaluation(n_sellers, n_items, seed)
+    snapshot_dates = monthly_snapshot_dates(df, months)
+
+    start = time.perf_counter()
+    snapshots = compute_snapshots(df, snapshot_dates)
+    one_pass = time.perf_counter() - start
+
+    start = time.perf_counter()
+    score_snapshots(snapshots)
+    one_pass_scored = one_pass + time.perf_counter() - start
+
+    start = time.perf_counter()
+    build_scorecard(df, df['order_purchase_timestamp'].max())
+    single_scoring = time.perf_counter() - start
+    ratio = one_pass_scored / single_scoring
+
+    start = time.perf_counter()
+    for snapshot_date in snapshot_dates[-naive_dates:]:
+        naive_snapshot_features(df, snapshot_date)
+    naive_per_date = (time.perf_counter() - start) / naive_dates
+
+    mismatches = verify_snapshots(df, snapshots, snapshot_dates[-naive_dates:])
+    print(f"  Một lượt ({months} mốc)       : {one_pass:8.2f}s")
+    print(f"  Lọc-rồi-gộp (1 mốc)         : {naive_per_date:8.2f}s")
+    print(f"  Lọc-rồi-gộp ({months} mốc, ước) : {naive_per_date * months:8.2f}s | Lệch: {mismatches}")
+    print(f"  Một lượt + chấm điểm ({months} mốc): {one_pass_scored:8.2f}s")
+    print(f"  Chấm điểm hiện tại (1 lần)  : {single_scoring:8.2f}s | {months} mốc = {ratio:.1f}x một lần chấm")
+    if mismatches:
+        raise AssertionError(f"Snapshot lệch {mismatches} giá trị so với cách lọc-rồi-gộp")
+    if max_ratio is not None and ratio > max_ratio:
+        raise AssertionError(f"{months} mốc mất {ratio:.1f}x một lần chấm điểm, vượt ngưỡng {max_ratio}x")
+    return {'one_pass_seconds': one_pass, 'naive_seconds_per_date': naive_per_date,
+            'one_pass_scored_seconds': one_pass_scored, 'single_scoring_seconds': single_scoring,
+            'snapshots_to_single_ratio': ratio}
+
+if __name__ == "__main__":
+    run_seller_backtest()
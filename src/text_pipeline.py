@@ -0,0 +1,290 @@
+"""
+Tiền xử lý văn bản review dùng chung cho các notebook NLP (thay cho preprocess_text chép lại ở từng notebook)
+- Đọc warehouse.nlp_bad_review / nlp_good_review theo từng khối bằng server-side cursor.
+- Chuẩn hóa + tách từ + bỏ stop words bằng thao tác chuỗi vector hóa của pandas (không lặp từng review).
+- Các khối được xử lý song song trên nhiều process, kết quả ghi bằng COPY vào warehouse.nlp_review_tokens
+  (review_id, nguồn, số sao, văn bản đã làm sạch, số token) để LDA/wordcloud đọc lại thay vì làm sạch lại.
+- nlp_review_tokens là cache bền vững: chỉ review mới, review có nội dung đổi (text_hash = md5 comment)
+  hoặc được làm sạch bằng phiên bản cũ (preprocess_version) mới bị xử lý lại.
+"""
+
+import hashlib
+import multiprocessing
+import re
+import time
+from collections import deque
+from itertools import filterfalse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from config import get_db_engine, get_raw_connection, TABLES, SCHEMA_WAREHOUSE, NLP_CONFIG
+from bulk_writer import replace_rows
+from instrumentation import record_io
+
+# Tăng khi thay đổi logic làm sạch -> toàn bộ cache được xử lý lại ở lần chạy kế tiếp
+PREPROCESS_VERSION = 1
+
+TOKENS_TABLE = TABLES['warehouse']['nlp_review_tokens']
+TOKEN_COLUMNS = ['review_id', 'source', 'review_score', 'text_hash', 'cleaned_text', 'token_count',
+                 'preprocess_version']
+
+# Review chưa có trong cache hoặc có bản cache đã lỗi thời
+PENDING_REVIEWS_SQL = """
+SELECT r.review_id, r.review_score, r.review_comment_message, md5(r.review_comment_message) as text_hash
+FROM {source_table} r
+LEFT JOIN {tokens_table} t ON t.review_id = r.review_id
+WHERE t.review_id IS NULL
+   OR t.text_hash <> md5(r.review_comment_message)
+   OR t.preprocess_version <> %(version)s
+   OR t.source <> %(source)s
+   OR t.review_score IS DISTINCT FROM r.review_score
+"""
+
+# Chỉ giữ lại chữ cái Latin không dấu và khoảng trắng (giống notebook)
+NON_LETTER_PATTERN = r'[^a-zA-Z\s]'
+NON_LETTER = re.compile(NON_LETTER_PATTERN)
+
+def get_stopwords(source=None, cfg=None):
+    """Stop words tiếng Bồ Đào Nha của nltk (tự tải nếu chưa có) + stop words bổ sung của nguồn"""
+    import nltk
+    from nltk.corpus import stopwords
+
+    cfg = cfg or NLP_CONFIG
+    try:
+        words = stopwords.words(cfg['stopword_language'])
+    except LookupError:
+        nltk.download('stopwords', quiet=True)
+        words = stopwords.words(cfg['stopword_language'])
+    return frozenset(words) | frozenset(cfg['extra_stopwords'].get(source, []))
+
+def preprocess_version(stopwords):
+    """
+    Phiên bản tiền xử lý ghi vào cache: PREPROCESS_VERSION + hash bộ stop words,
+    để thay đổi danh sách stop words (config hoặc phiên bản nltk) cũng làm mới cache.
+    """
+    digest = hashlib.md5(' '.join(sorted(stopwords)).encode('utf-8')).hexdigest()[:8]
+    return f"{PREPROCESS_VERSION}:{digest}"
+
+def preprocess_text(text, stopwords):
+    """Hàm gốc từ notebook (xử lý từng review), giữ lại làm chuẩn đối chiếu"""
+    if not isinstance(text, str):
+        return ""
+
+    # Chuyển sang chữ thường
+    text = text.lower()
+
+    # Xóa các ký tự đặc biệt, số (chỉ giữ lại chữ cái)
+    text = re.sub(NON_LETTER_PATTERN, '', text)
+
+    # Tách từ (Tokenization) và Xóa Stop Words
+    cleaned_words = []
+    for word in text.split():
+        if word not in stopwords:
+            cleaned_words.append(word)
+
+    # Nối lại
+    return " ".join(cleaned_words)
+
+def clean_texts(texts, stopwords):
+    """
+    Bản nhanh của preprocess_text cho cả một khối review (cùng kết quả).
+    Một vòng lặp Python trên regex đã biên dịch sẵn + tra set (filterfalse chạy trong C): nhanh hơn chuỗi
+    str.split().explode() -> isin -> groupby().agg(' '.join) của pandas (tạo một dòng cho mỗi token).
+    Trả về (văn bản đã làm sạch, số token) cùng độ dài với texts.
+    """
+    sub = NON_LETTER.sub
+    is_stopword = stopwords.__contains__
+    cleaned = [' '.join(filterfalse(is_stopword, sub('', t.lower()).split())) if isinstance(t, str) else ''
+               for t in pd.Series(texts, copy=False).tolist()]
+    # Token không chứa khoảng trắng -> số token = số dấu cách + 1
+    counts = np.fromiter((c.count(' ') + 1 if c else 0 for c in cleaned), dtype=np.int64, count=len(cleaned))
+    return np.array(cleaned, dtype=object), counts
+
+def preprocess_chunk(chunk, source, stopwords, version):
+    """Làm sạch một khối review (chạy trong process con), trả về DataFrame theo TOKEN_COLUMNS"""
+    cleaned, counts = clean_texts(chunk['review_comment_message'], stopwords)
+    return pd.DataFrame({
+        'review_id': chunk['review_id'].to_numpy(),
+        'source': source,
+        'review_score': chunk['review_score'].to_numpy(),
+        'text_hash': chunk['text_hash'].to_numpy(),
+        'cleaned_text': cleaned,
+        'token_count': counts,
+        'preprocess_version': version
+    }, columns=TOKEN_COLUMNS)
+
+# CACHE TOKEN
+def ensure_tokens_table(conn):
+    """Tạo bảng cache nếu chưa có (bảng dựng lại toàn bộ theo cấu trúc cũ, thiếu text_hash, bị thay thế)"""
+    has_hash = conn.execute(text("""
+        SELECT EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_schema = :schema AND table_name = :table AND column_name = 'text_hash')
+    """), {'schema': SCHEMA_WAREHOUSE, 'table': TOKENS_TABLE.split('.')[-1]}).scalar()
+    if not has_hash:
+        conn.execute(text(f"DROP TABLE IF EXISTS {TOKENS_TABLE}"))
+
+    conn.execute(text(f"""
+    CREATE TABLE IF NOT EXISTS {TOKENS_TABLE} (
+        review_id TEXT PRIMARY KEY,
+        source TEXT NOT NULL,
+        review_score SMALLINT,
+        text_hash TEXT NOT NULL,
+        cleaned_text TEXT,
+        token_count INTEGER,
+        preprocess_version TEXT NOT NULL,
+        processed_at TIMESTAMP NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS nlp_review_tokens_source_idx ON {TOKENS_TABLE} (source);
+    """))
+
+def remove_orphan_tokens(conn, sources):
+    """Xóa token của các review không còn trong bảng nguồn nào"""
+    not_exists = ' AND '.join(
+        f"NOT EXISTS (SELECT 1 FROM {SCHEMA_WAREHOUSE}.{table} r WHERE r.review_id = t.review_id)"
+        for table in sources.values()
+    )
+    return conn.execute(text(f"DELETE FROM {TOKENS_TABLE} t WHERE {not_exists}")).rowcount
+
+def load_review_tokens(source=None, engine=None):
+    """Đọc văn bản đã làm sạch từ cache (cho LDA / wordcloud)"""
+    sql = f"SELECT review_id, source, review_score, cleaned_text, token_count FROM {TOKENS_TABLE}"
+    params = None
+    if source:
+        sql += " WHERE source = %(source)s"
+        params = {'source': source}
+    return pd.read_sql(sql, engine or get_db_engine(), params=params)
+
+# ĐỌC & XỬ LÝ THEO LUỒNG
+def iter_review_chunks(sql, params=None, chunk_rows=None, cursor_name='nlp_reviews'):
+    """Chạy truy vấn review và đọc kết quả theo từng khối DataFrame bằng server-side cursor"""
+    chunk_rows = chunk_rows or NLP_CONFIG['chunk_rows']
+    conn = get_raw_connection()
+    try:
+        # Cursor có tên -> psycopg2 tạo server-side cursor, không nạp toàn bộ bảng vào bộ nhớ
+        with conn.cursor(name=cursor_name) as cur:
+            cur.itersize = chunk_rows
+            cur.execute(sql, params)
+            columns = None
+            while True:
+                start = time.perf_counter()
+                batch = cur.fetchmany(chunk_rows)
+                record_io(rows_in=len(batch), db_seconds=time.perf_counter() - start)
+                if not batch:
+                    break
+                columns = columns or [desc[0] for desc in cur.description]
+                yield pd.DataFrame(batch, columns=columns)
+        conn.commit()
+    finally:
+        conn.close()
+
+def preprocess_stream(chunks, source, stopwords, version, executor=None, max_in_flight=None):
+    """
+    Làm sạch một luồng khối review. Với executor, các khối được gửi cho process pool
+    nhưng giữ tối đa max_in_flight khối đang chờ để bộ nhớ không tăng theo kích thước bảng.
+    Thứ tự khối đầu ra giữ nguyên như đầu vào.
+    """
+    if executor is None:
+        for chunk in chunks:
+            yield preprocess_chunk(chunk, source, stopwords, version)
+        return
+
+    pending = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(preprocess_chunk, chunk, source, stopwords, version))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def refresh_source_tokens(source, table, executor=None, max_in_flight=None, chunk_rows=None):
+    """Xử lý các review mới/thay đổi của một nguồn; mỗi khối được ghi (DELETE + COPY) ngay khi xong"""
+    stopwords = get_stopwords(source)
+    version = preprocess_version(stopwords)
+    sql = PENDING_REVIEWS_SQL.format(source_table=f"{SCHEMA_WAREHOUSE}.{table}", tokens_table=TOKENS_TABLE)
+    chunks = iter_review_chunks(sql, {'version': version, 'source': source}, chunk_rows,
+                                cursor_name=f"nlp_{source}")
+
+    rows = 0
+    for processed in preprocess_stream(chunks, source, stopwords, version, executor, max_in_flight):
+        rows += replace_rows(processed, TOKENS_TABLE.split('.')[-1], 'review_id', SCHEMA_WAREHOUSE)
+    return rows
+
+def build_review_tokens(sources=None, max_workers=None, chunk_rows=None, full_refresh=False):
+    """
+    Cập nhật cache warehouse.nlp_review_tokens từ các bảng review NLP (chỉ review mới/thay đổi).
+    :param sources: dict nhãn nguồn -> tên bảng trong warehouse (mặc định NLP_CONFIG['sources'])
+    :param full_refresh: xóa cache và xử lý lại toàn bộ review
+    """
+    sources = sources or NLP_CONFIG['sources']
+    max_workers = max_workers or NLP_CONFIG['max_workers']
+    print("Đang cập nhật cache nlp_review_tokens...")
+    start = time.perf_counter()
+
+    with get_db_engine().begin() as conn:
+        ensure_tokens_table(conn)
+        if full_refresh:
+            conn.execute(text(f"TRUNCATE {TOKENS_TABLE}"))
+        removed = remove_orphan_tokens(conn, sources)
+
+    processed = {}
+    # 'spawn': pipeline chạy trong ThreadPoolExecutor của DAG, fork từ process đa luồng có thể treo
+    # (khóa của pool kết nối/logging bị sao chép khi đang bị luồng khác giữ)
+    executor = (ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+                if max_workers > 1 else None)
+    try:
+        for source, table in sources.items():
+            processed[source] = refresh_source_tokens(source, table, executor, max_workers * 2, chunk_rows)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    with get_db_engine().connect() as conn:
+        cached = conn.execute(text(f"SELECT COUNT(*) FROM {TOKENS_TABLE}")).scalar()
+    summary = ', '.join(f"{source}: {rows:,}" for source, rows in processed.items())
+    print(f"   -> Hoàn tất. Xử lý mới {sum(processed.values()):,} review ({summary}), "
+          f"xóa {removed:,}, cache có {cached:,} dòng ({time.perf_counter() - start:.2f}s).")
+    return sum(processed.values())
+
+# SO SÁNH HIỆU NĂNG
+def generate_synthetic_comments(n_rows=100_000, seed=42):
+    """Sinh comment giả lập (có dấu, số, ký tự đặc biệt, None) để so sánh hai cách làm sạch"""
+    rng = np.random.default_rng(seed)
+    samples = np.array([
+        None, '', 'Produto chegou ATRASADO, não recomendo!!!', 'Ótimo vendedor, entrega rápida 10/10',
+        'embalagem amassada e a caixa veio aberta', 'Não recebi o produto até agora... 2 semanas',
+        'muito bom, chegou antes do prazo', 'produto com defeito :( quero devolver', 'Excelente!'
+    ], dtype=object)
+    return pd.Series(samples[rng.integers(0, len(samples), n_rows)])
+
+def benchmark_text_preprocessing(texts=None, n_rows=100_000, source='bad', repeat=3):
+    """
+    Chạy preprocess_text từng dòng (apply) và clean_texts trên cùng dữ liệu (lấy lần nhanh nhất trong
+    repeat lần để bớt nhiễu). Lỗi nếu kết quả lệch hoặc clean_texts không nhanh hơn cách cũ.
+    """
+    texts = generate_synthetic_comments(n_rows) if texts is None else texts
+    stopwords = get_stopwords(source)
+    print(f"BENCHMARK TIỀN XỬ LÝ VĂN BẢN ({len(texts):,} review)")
+
+    apply_seconds = clean_seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        reference = texts.apply(preprocess_text, stopwords=stopwords).to_numpy(dtype=object)
+        apply_seconds = min(apply_seconds, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        cleaned, _ = clean_texts(texts, stopwords)
+        clean_seconds = min(clean_seconds, time.perf_counter() - start)
+
+    mismatches = int((reference != cleaned).sum())
+    print(f"  apply từng dòng : {apply_seconds:8.3f}s")
+    print(f"  clean_texts     : {clean_seconds:8.3f}s | x{apply_seconds / clean_seconds:.1f} | Lệch: {mismatches}")
+    if mismatches:
+        raise AssertionError(f"clean_texts lệch {mismatches} review so với preprocess_text")
+    if clean_seconds >= apply_seconds:
+        raise AssertionError(f"clean_texts ({clean_seconds:.3f}s) không nhanh hơn apply từng dòng "
+                             f"({apply_seconds:.3f}s)")
+    return {'apply_seconds': apply_seconds, 'clean_seconds': clean_seconds}
+
+if __name__ == "__main__":
+    build_review_tokens()
@@ -0,0 +1,207 @@
+"""
+Mô hình chủ đề review (chuyển từ CountVectorizer + LDA trong các notebook NLP)
+- Huấn luyện lần đầu: CountVectorizer + LatentDirichletAllocation (learning_method='online') trên văn bản
+  đã làm sạch trong warehouse.nlp_review_tokens; từ điển và mô hình được lưu có phiên bản trong model_store.
+- Các lần chạy sau: chỉ partial_fit (online variational Bayes) trên review mới làm sạch kể từ lần huấn luyện
+  trước, giữ nguyên từ điển -> chủ đề không bị đánh số lại, không cần fit lại toàn bộ.
+- Gán chủ đề chính (dominant topic) theo từng khối ma trận thưa, ghi review_id -> chủ đề, xác suất
+  vào warehouse.review_topics. Mặc định chỉ gán cho review chưa có chủ đề hoặc vừa được làm sạch lại.
+"""
+
+import time
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.decomposition import LatentDirichletAllocation
+from config import get_db_engine, TABLES, SCHEMA_WAREHOUSE, NLP_CONFIG, TOPIC_MODEL_CONFIG
+from bulk_writer import replace_rows
+from model_store import fingerprint_frame, save_artifact, load_artifact, load_manifest
+from text_pipeline import TOKENS_TABLE, iter_review_chunks
+
+TOPICS_TABLE = TABLES['warehouse']['review_topics']
+TOPIC_COLUMNS = ['review_id', 'source', 'topic', 'probability', 'model_version']
+
+# Review đã làm sạch của một nguồn, mới hơn lần huấn luyện trước
+TRAINING_DOCS_SQL = f"""
+SELECT review_id, cleaned_text, processed_at
+FROM {TOKENS_TABLE}
+WHERE source = %(source)s AND token_count > 0 AND processed_at > %(since)s
+ORDER BY review_id
+"""
+
+# Review cần gán chủ đề: chưa có chủ đề hoặc đã được làm sạch lại sau lần gán trước
+PENDING_TOPICS_SQL = f"""
+SELECT t.review_id, t.cleaned_text
+FROM {TOKENS_TABLE} t
+LEFT JOIN {TOPICS_TABLE} rt ON rt.review_id = t.review_id
+WHERE t.source = %(source)s AND t.token_count > 0
+  AND (rt.review_id IS NULL OR t.processed_at > rt.assigned_at {{reassign_filter}})
+"""
+
+def model_name(source):
+    return f"topic_lda_{source}"
+
+def ensure_topics_table(conn):
+    conn.execute(text(f"""
+    CREATE TABLE IF NOT EXISTS {TOPICS_TABLE} (
+        review_id TEXT PRIMARY KEY,
+        source TEXT NOT NULL,
+        topic SMALLINT NOT NULL,
+        probability DOUBLE PRECISION NOT NULL,
+        model_version TEXT NOT NULL,
+        assigned_at TIMESTAMP NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS review_topics_source_topic_idx ON {TOPICS_TABLE} (source, topic);
+    """))
+
+def remove_orphan_topics(conn, source):
+    """
+    Xóa chủ đề của review không còn token hợp lệ cùng nguồn trong nlp_review_tokens
+    (review đã bị xóa, chuyển sang nguồn khác hoặc làm sạch xong không còn token nào).
+    """
+    return conn.execute(text(f"""
+        DELETE FROM {TOPICS_TABLE} rt
+        WHERE rt.source = :source
+          AND NOT EXISTS (
+              SELECT 1 FROM {TOKENS_TABLE} t
+              WHERE t.review_id = rt.review_id AND t.source = rt.source AND t.token_count > 0
+          )
+    """), {'source': source}).rowcount
+
+def load_training_docs(source, since=None, engine=None):
+    """Văn bản đã làm sạch của một nguồn (since: chỉ lấy review làm sạch sau thời điểm này)"""
+    return pd.read_sql(TRAINING_DOCS_SQL, engine or get_db_engine(),
+                       params={'source': source, 'since': since or pd.Timestamp('1900-01-01')})
+
+def top_words(vectorizer, lda, n_words=None):
+    """Các từ nổi bật nhất của từng chủ đề (như display_topics trong notebook)"""
+    n_words = n_words or TOPIC_MODEL_CONFIG['top_words']
+    feature_names = vectorizer.get_feature_names_out()
+    return [[feature_names[i] for i in topic.argsort()[:-n_words - 1:-1]] for topic in lda.components_]
+
+# HUẤN LUYỆN
+def fit_topic_model(docs, source, cfg=None):
+    """Huấn luyện từ đầu: từ điển + LDA online trên toàn bộ văn bản"""
+    cfg = cfg or TOPIC_MODEL_CONFIG
+    params = cfg['models'][source]
+    vectorizer = CountVectorizer(max_df=params['max_df'], min_df=params['min_df'],
+                                 max_features=params['max_features'])
+    doc_term_matrix = vectorizer.fit_transform(docs['cleaned_text'])
+
+    lda = LatentDirichletAllocation(
+        n_components=params['n_components'], learning_method='online', batch_size=cfg['batch_size'],
+        learning_offset=cfg['learning_offset'], learning_decay=cfg['learning_decay'],
+        max_iter=cfg['max_iter'], random_state=cfg['random_state'], n_jobs=-1
+    )
+    lda.fit(doc_term_matrix)
+    return vectorizer, lda
+
+def update_topic_model(vectorizer, lda, docs, batch_size=None):
+    """
+    Cập nhật LDA bằng partial_fit trên review mới (từ điển giữ nguyên: từ mới chưa có trong
+    từ điển bị bỏ qua cho đến lần huấn luyện lại toàn bộ).
+    """
+    batch_size = batch_size or TOPIC_MODEL_CONFIG['batch_size']
+    doc_term_matrix = vectorizer.transform(docs['cleaned_text'])
+    for start in range(0, doc_term_matrix.shape[0], batch_size):
+        lda.partial_fit(doc_term_matrix[start:start + batch_size])
+    return lda
+
+def train_or_update(source, refit=False, engine=None):
+    """
+    Huấn luyện mới (lần đầu hoặc refit=True) hoặc partial_fit trên review mới, lưu thành phiên bản mới.
+    Không có review mới -> dùng lại phiên bản hiện tại. Trả về (objects, manifest).
+    """
+    name = model_name(source)
+    manifest = load_manifest(name)
+
+    if refit or manifest is None:
+        docs = load_training_docs(source, engine=engine)
+        if docs.empty:
+            print(f"  [{source}] Chưa có review đã làm sạch, bỏ qua huấn luyện.")
+            return None, None
+        start = time.perf_counter()
+        vectorizer, lda = fit_topic_model(docs, source)
+        mode, parent = 'full', None
+    else:
+        objects, manifest = load_artifact(name, manifest['version'])
+        docs = load_training_docs(source, objects['trained_until'], engine)
+        if docs.empty:
+            print(f"  [{source}] Không có review mới, dùng lại mô hình {manifest['version']}")
+            return objects, manifest
+        start = time.perf_counter()
+        vectorizer = objects['vectorizer']
+        lda = update_topic_model(vectorizer, objects['lda'], docs)
+        mode, parent = 'partial_fit', manifest['version']
+
+    seconds = time.perf_counter() - start
+    words = top_words(vectorizer, lda)
+    objects = {'vectorizer': vectorizer, 'lda': lda, 'trained_until': docs['processed_at'].max()}
+    manifest = save_artifact(
+        name, objects, fingerprint_frame(docs[['review_id', 'cleaned_text']]),
+        timings={'train_seconds': seconds, 'rows': len(docs)},
+        params={'mode': mode, 'parent_version': parent, **TOPIC_MODEL_CONFIG['models'][source]},
+        metrics={'vocabulary_size': len(vectorizer.vocabulary_), 'top_words': words}
+    )
+    print(f"  [{source}] {mode}: {len(docs):,} review, {seconds:.2f}s -> phiên bản {manifest['version']}")
+    for topic_idx, topic_words in enumerate(words):
+        print(f"    Chủ đề {topic_idx + 1}: {', '.join(topic_words)}")
+    return objects, manifest
+
+# GÁN CHỦ ĐỀ
+def dominant_topics(vectorizer, lda, texts):
+    """Chủ đề có xác suất lớn nhất và xác suất đó cho từng văn bản (tính trên ma trận thưa)"""
+    distribution = lda.transform(vectorizer.transform(texts))
+    topics = distribution.argmax(axis=1)
+    return topics, distribution[np.arange(len(topics)), topics]
+
+def assign_topics(source, objects, version, reassign=False, chunk_rows=None):
+    """Gán chủ đề cho review của một nguồn theo từng khối, ghi vào warehouse.review_topics"""
+    chunk_rows = chunk_rows or TOPIC_MODEL_CONFIG['assign_chunk_rows']
+    sql = PENDING_TOPICS_SQL.format(reassign_filter="OR rt.model_version <> %(version)s" if reassign else "")
+
+    rows = 0
+    for chunk in iter_review_chunks(sql, {'source': source, 'version': version}, chunk_rows,
+                                    cursor_name=f"topics_{source}"):
+        topics, probability = dominant_topics(objects['vectorizer'], objects['lda'], chunk['cleaned_text'])
+        result = pd.DataFrame({
+            'review_id': chunk['review_id'].to_numpy(),
+            'source': source,
+            'topic': topics,
+            'probability': probability,
+            'model_version': version
+        }, columns=TOPIC_COLUMNS)
+        rows += replace_rows(result, TOPICS_TABLE.split('.')[-1], 'review_id', SCHEMA_WAREHOUSE)
+    return rows
+
+def run_topic_modeling(sources=None, refit=False, reassign=False):
+    """
+    Cập nhật mô hình chủ đề và gán chủ đề cho review mới của từng nguồn.
+    :param refit: huấn luyện lại từ đầu (từ điển mới) thay vì partial_fit
+    :param reassign: gán lại chủ đề cho mọi review có phiên bản mô hình khác phiên bản hiện tại
+    """
+    sources = sources or list(NLP_CONFIG['sources'])
+    print("Đang cập nhật mô hình chủ đề review_topics...")
+    engine = get_db_engine()
+    with engine.begin() as conn:
+        ensure_topics_table(conn)
+        removed = {source: remove_orphan_topics(conn, source) for source in sources}
+    if any(removed.values()):
+        print(f"  Đã xóa chủ đề của {sum(removed.values()):,} review không còn token ({removed})")
+
+    assigned = {}
+    for source in sources:
+        objects, manifest = train_or_update(source, refit, engine)
+        if objects is None:
+            continue
+        # Refit có từ điển & chủ đề mới -> nhãn cũ không còn ý nghĩa, phải gán lại toàn bộ
+        assigned[source] = assign_topics(source, objects, manifest['version'],
+                                         reassign=reassign or manifest['params'].get('mode') == 'full')
+
+    summary = ', '.join(f"{source}: {rows:,}" for source, rows in assigned.items())
+    print(f"   -> Hoàn tất. Đã gán chủ đề cho {sum(assigned.values()):,} review ({summary}).")
+    return sum(assigned.values())
+
+if __name__ == "__main__":
+    run_topic_modeling()
@@ -0,0 +1,237 @@
+"""
+Bố cục vật lý các bảng Warehouse
+- Mỗi bảng khai báo khóa, các index tạo sau khi nạp (trên cột dùng để join) và cột phân vùng (nếu có).
+- fact_orders / fact_order_items được phân vùng RANGE theo tháng (cùng cột phân vùng với bản đồng bộ
+  BigQuery trong cloud_sync), thêm một phân vùng DEFAULT cho dòng có cột phân vùng NULL.
+  Khóa của bảng phân vùng phải chứa cột phân vùng nên được khai báo là UNIQUE (khóa + cột phân vùng).
+- Sau mỗi lần dựng: thêm khóa, tạo index rồi ANALYZE để planner có thống kê mới.
+- WAREHOUSE_LAYOUT_CONFIG['mode'] = 'plain' giữ nguyên cách cũ (bảng heap, không khóa/index) để so sánh.
+- Dựng lại toàn bộ không đụng vào bảng đang dùng: dữ liệu, khóa, index và thống kê được tạo trên bảng
+  shadow ({bảng}__new), sau đó hoán đổi bằng RENAME trong một transaction ngắn. View phụ thuộc được
+  trỏ sang bảng mới (CREATE OR REPLACE VIEW) thay vì bị DROP ... CASCADE.
+"""
+
+import time
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+import config
+from config import get_db_engine
+from bulk_writer import SHADOW_SUFFIX
+from incremental import ensure_primary_key
+from instrumentation import record_io
+
+OLD_SUFFIX = '__old'
+LOCK_NOT_AVAILABLE = '55P03'
+
+# Bảng -> {'primary_key', 'partition_column', 'partition_source' (bảng, cột) để tính dải tháng, 'indexes'}
+WAREHOUSE_LAYOUT = {
+    'dim_date': {'primary_key': ['date']},
+    'dim_customers': {'primary_key': ['customer_id']},
+    'dim_products': {'primary_key': ['product_id']},
+    'dim_sellers': {'primary_key': ['seller_id']},
+    'fact_orders': {
+        'primary_key': ['order_id'],
+        'partition_column': 'order_purchase_timestamp',
+        'partition_source': ('staging.orders_cleaned', 'order_purchase_timestamp'),
+        'indexes': [['customer_id']],
+    },
+    'fact_order_items': {
+        # fact_order_items không có thời điểm mua: phân vùng theo shipping_limit_date (cũng là cột watermark)
+        'primary_key': ['order_id', 'order_item_id'],
+        'partition_column': 'shipping_limit_date',
+        'partition_source': ('staging.order_items_cleaned', 'shipping_limit_date'),
+        'indexes': [['product_id'], ['seller_id']],
+    },
+    # Bảng tổng hợp: cột khóa có thể NULL (category/state) nên chỉ tạo index, không khai báo khóa
+    'agg_daily_sales': {'indexes': [['date']]},
+    'agg_product_performance': {'indexes': [['product_id']]},
+    'agg_category_performance': {'indexes': [['category']]},
+    'agg_state_performance': {'indexes': [['state']]},
+    'seller_evaluation': {'indexes': [['seller_id'], ['order_id']]},
+    'logistics_analytics': {'indexes': [['order_id', 'seller_id']]},
+    'seller_segmentation': {'indexes': [['seller_id']]},
+    'nlp_bad_review': {'indexes': [['review_id']]},
+    'nlp_good_review': {'indexes': [['review_id']]},
+}
+
+def layout_enabled():
+    return config.WAREHOUSE_LAYOUT_CONFIG['mode'] == 'optimized'
+
+def get_layout(full_table_name):
+    """Khai báo bố cục của bảng (dict rỗng nếu bảng không có trong WAREHOUSE_LAYOUT)"""
+    return WAREHOUSE_LAYOUT.get(full_table_name.split('.')[-1], {})
+
+def partition_name(full_table_name, month):
+    return f"{full_table_name}_p{month:%Y%m}"
+
+def is_partitioned(conn, full_table_name):
+    return conn.execute(text("""
+        SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:name))
+    """), {'name': full_table_name}).scalar()
+
+def table_key_columns(conn, full_table_name, key_columns):
+    """Cột khóa thực tế của bảng (bảng phân vùng: khóa + cột phân vùng) dùng cho ON CONFLICT"""
+    partition_column = get_layout(full_table_name).get('partition_column')
+    if partition_column and is_partitioned(conn, full_table_name):
+        return key_columns + [partition_column]
+    return key_columns
+
+def ensure_table_keys(conn, full_table_name, key_columns):
+    """Bảng heap: thêm khóa chính nếu thiếu. Bảng phân vùng đã có khóa UNIQUE từ lúc dựng."""
+    if not is_partitioned(conn, full_table_name):
+        ensure_primary_key(conn, full_table_name, key_columns)
+
+def month_range(conn, source_table, column):
+    """Ngày đầu các tháng từ MIN đến MAX của cột thời gian trong bảng nguồn"""
+    rows = conn.execute(text(f"""
+        SELECT generate_series(date_trunc('month', MIN({column}::timestamp)),
+                               date_trunc('month', MAX({column}::timestamp)), interval '1 month')::date
+        FROM {source_table}
+    """))
+    return [r[0] for r in rows if r[0] is not None]
+
+def ensure_month_partitions(conn, full_table_name, months):
+    """Tạo các phân vùng tháng còn thiếu (phải tạo trước khi ghi để dòng không rơi vào DEFAULT)"""
+    for month in months:
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {partition_name(full_table_name, month)}
+            PARTITION OF {full_table_name}
+            FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{month:%Y-%m-%d}'::date + interval '1 month')
+        """))
+
+def ensure_delta_partitions(conn, full_table_name, delta_table):
+    """Tạo phân vùng cho các tháng có trong bảng delta của lần cập nhật tăng dần"""
+    if not is_partitioned(conn, full_table_name):
+        return
+    column = get_layout(full_table_name)['partition_column']
+    rows = conn.execute(text(f"""
+        SELECT DISTINCT date_trunc('month', {column})::date FROM {delta_table} WHERE {column} IS NOT NULL
+    """))
+    ensure_month_partitions(conn, full_table_name, [r[0] for r in rows])
+
+def shadow_table_name(full_table_name):
+    return f"{full_table_name}{SHADOW_SUFFIX}"
+
+def create_partitioned_table(conn, full_table_name, sql_query, layout):
+    """
+    Tạo bảng phân vùng theo tháng với kiểu cột lấy từ câu SELECT (WITH NO DATA, không chạy truy vấn),
+    tạo trước các phân vùng theo dải tháng của bảng nguồn rồi nạp bằng INSERT ... SELECT.
+    """
+    template = f"{full_table_name.split('.')[-1]}_layout"
+    column = layout['partition_column']
+    conn.execute(text(f"""
+        CREATE TEMP TABLE {template} ON COMMIT DROP AS {sql_query} WITH NO DATA;
+        CREATE TABLE {full_table_name} (LIKE {template}) PARTITION BY RANGE ({column});
+        CREATE TABLE {full_table_name}_default PARTITION OF {full_table_name} DEFAULT;
+    """))
+    ensure_month_partitions(conn, full_table_name, month_range(conn, *layout['partition_source']))
+    return conn.execute(text(f"INSERT INTO {full_table_name} {sql_query}")).rowcount
+
+def apply_post_load(conn, full_table_name, layout, key_columns=None):
+    """
+    Thêm khóa, tạo index và ANALYZE sau khi nạp (thường chạy trên bảng shadow, trước khi hoán đổi).
+    key_columns (khóa chính nơi gọi yêu cầu) luôn được thêm; index và ANALYZE bỏ qua khi mode = 'plain'.
+    """
+    table = full_table_name.split('.')[-1]
+    if layout.get('partition_column') and is_partitioned(conn, full_table_name):
+        key = layout['primary_key'] + [layout['partition_column']]
+        conn.execute(text(f"ALTER TABLE {full_table_name} ADD CONSTRAINT {table}_key UNIQUE ({', '.join(key)})"))
+    elif key_columns or (layout_enabled() and layout.get('primary_key')):
+        ensure_primary_key(conn, full_table_name, key_columns or layout['primary_key'])
+    if not layout_enabled():
+        return
+    for columns in layout.get('indexes', []):
+        conn.execute(text(f"""
+            CREATE INDEX IF NOT EXISTS {table}_{'_'.join(columns)}_idx ON {full_table_name} ({', '.join(columns)})
+        """))
+    conn.execute(text(f"ANALYZE {full_table_name}"))
+
+# HOÁN ĐỔI BẢNG SHADOW
+def dependent_views(conn, full_table_name):
+    """View đọc trực tiếp từ bảng: [(tên view, định nghĩa)] (lấy trước khi đổi tên bảng)"""
+    rows = conn.execute(text("""
+        SELECT DISTINCT v.oid::regclass::text, pg_get_viewdef(v.oid)
+        FROM pg_depend d
+        JOIN pg_rewrite r ON r.oid = d.objid
+        JOIN pg_class v ON v.oid = r.ev_class
+        WHERE d.classid = 'pg_rewrite'::regclass
+          AND d.refobjid = to_regclass(:name)
+          AND v.oid <> d.refobjid
+          AND v.relkind = 'v'
+    """), {'name': full_table_name})
+    return [(r[0], r[1]) for r in rows]
+
+def rename_shadow_objects(conn, full_table_name):
+    """Đổi tên phân vùng/index/khóa còn mang tiền tố shadow ({bảng}__new_...) về tên chuẩn"""
+    schema, table = full_table_name.split('.')
+    prefix = f"{table}{SHADOW_SUFFIX}"
+    rows = conn.execute(text("""
+        SELECT c.relname, c.relkind
+        FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema AND c.relkind IN ('r', 'p', 'i', 'I') AND left(c.relname, :n) = :prefix
+    """), {'schema': schema, 'prefix': prefix, 'n': len(prefix)})
+    for name, kind in rows.fetchall():
+        statement = 'ALTER INDEX' if kind in ('i', 'I') else 'ALTER TABLE'
+        conn.execute(text(f"{statement} {schema}.{name} RENAME TO {table}{name[len(prefix):]}"))
+
+def swap_shadow(conn, full_table_name):
+    """
+    Thay bảng đang dùng bằng bảng shadow (gọi trong transaction đang mở):
+    đổi tên bảng cũ -> shadow thành bảng chính -> trỏ lại các view -> xóa bảng cũ -> chuẩn hóa tên index/phân vùng.
+    Truy vấn đọc chỉ phải chờ trong thời gian transaction này (vài mili giây), không phải suốt quá trình dựng.
+    """
+    schema, table = full_table_name.split('.')
+    conn.execute(text(f"SET LOCAL lock_timeout = '{config.WAREHOUSE_LAYOUT_CONFIG['swap_lock_timeout']}'"))
+    old_exists = conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {'name': full_table_name}).scalar()
+    views = dependent_views(conn, full_table_name) if old_exists else []
+    if old_exists:
+        conn.execute(text(f"ALTER TABLE {full_table_name} RENAME TO {table}{OLD_SUFFIX}"))
+    conn.execute(text(f"ALTER TABLE {shadow_table_name(full_table_name)} RENAME TO {table}"))
+    for view_name, definition in views:
+        # Định nghĩa view có thể chứa '::' hoặc ':' -> escape để text() không coi là tham số
+        definition = definition.replace(':', '\\:')
+        conn.execute(text(f"CREATE OR REPLACE VIEW {view_name} AS {definition}"))
+    if old_exists:
+        conn.execute(text(f"DROP TABLE {full_table_name}{OLD_SUFFIX}"))
+    rename_shadow_objects(conn, full_table_name)
+
+def publish_shadow(full_table_name, key_columns=None, engine=None):
+    """
+    Hoàn tất bảng shadow đã nạp dữ liệu (khóa, index, ANALYZE) rồi hoán đổi vào vị trí bảng chính.
+    Nếu không lấy được khóa trong lock_timeout (có truy vấn dài đang đọc bảng cũ) -> chờ rồi thử lại.
+    """
+    engine = engine or get_db_engine()
+    shadow = shadow_table_name(full_table_name)
+    with engine.begin() as conn:
+        apply_post_load(conn, shadow, get_layout(full_table_name), key_columns)
+
+    retries = config.WAREHOUSE_LAYOUT_CONFIG['swap_retries']
+    for attempt in range(retries + 1):
+        try:
+            with engine.begin() as conn:
+                swap_shadow(conn, full_table_name)
+            return
+        except OperationalError as e:
+            if getattr(e.orig, 'pgcode', None) != LOCK_NOT_AVAILABLE or attempt == retries:
+                raise
+            print(f"    {full_table_name} đang bị khóa, thử hoán đổi lại ({attempt + 1}/{retries})...")
+            time.sleep(2 ** attempt)
+
+def create_table_as(full_table_name, sql_query, key_columns=None, engine=None):
+    """
+    Dựng lại bảng từ câu SELECT theo bố cục đã khai báo, không làm gián đoạn người đọc:
+    nạp vào bảng shadow (phân vùng nếu có partition_column, ngược lại CREATE TABLE AS) rồi publish_shadow.
+    Trả về số dòng lấy từ command status của lệnh nạp (không cần COUNT lại bảng).
+    """
+    engine = engine or get_db_engine()
+    layout = get_layout(full_table_name)
+    shadow = shadow_table_name(full_table_name)
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {shadow}"))
+        if layout_enabled() and layout.get('partition_column'):
+            rows = create_partitioned_table(conn, shadow, sql_query, layout)
+        else:
+            rows = conn.execute(text(f"CREATE TABLE {shadow} AS ({sql_query})")).rowcount
+    record_io(rows_out=rows)
+    publish_shadow(full_table_name, key_columns, engine)
+    return rows